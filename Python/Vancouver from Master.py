@@ -1,8 +1,11 @@
 #!/usr/bin/python
 # Copyright Luca de Alfaro, 2013.
 
+from __future__ import print_function
+
 import numpy as np
 import unittest
+from array import array
 
 # Do we debias grades?
 DEBIAS = False
@@ -18,22 +21,24 @@ class User:
     def __init__(self, name):
         """Initializes a user."""
         self.name = name
+        self.index = None
         self.items = set()
         self.grade = {}
 
     def add_item(self, it, grade):
-        self.items = self.items | set([it])
+        self.items.add(it)
         self.grade[it] = grade
 
 
 class Item:
     def __init__(self, id):
         self.id = id
+        self.index = None
         self.users = set()
         self.grade = None
 
     def add_user(self, u):
-        self.users = self.users | set([u])
+        self.users.add(u)
 
 
 class Graph:
@@ -45,6 +50,14 @@ class Graph:
         self.item_dict = {}
         self.basic_precision = basic_precision
         self.use_all_data = use_all_data
+        # Users and items by index, and the reviews as edge arrays
+        # (user index, item index, grade), with the edge of each (user, item).
+        self.user_list = []
+        self.item_list = []
+        self.edge_user = array('l')
+        self.edge_item = array('l')
+        self.edge_grade = array('d')
+        self.edge_index = {}
 
     def add_review(self, username, item_id, grade):
         # Gets, or creates, the user.
@@ -52,16 +65,29 @@ class Graph:
             u = self.user_dict[username]
         else:
             u = User(username)
+            u.index = len(self.user_list)
             self.user_dict[username] = u
-            self.users = self.users | set([u])
+            self.users.add(u)
+            self.user_list.append(u)
         # Gets, or creates, the item.
         if item_id in self.item_dict:
             it = self.item_dict[item_id]
         else:
             it = Item(item_id)
+            it.index = len(self.item_list)
             self.item_dict[item_id] = it
-            self.items = self.items | set([it])
-        # Adds the connection between the two.
+            self.items.add(it)
+            self.item_list.append(it)
+        # Adds the connection between the two (a second review of the same
+        # item by the same user replaces the grade).
+        e = self.edge_index.get((u.index, it.index))
+        if e is None:
+            self.edge_index[(u.index, it.index)] = len(self.edge_grade)
+            self.edge_user.append(u.index)
+            self.edge_item.append(it.index)
+            self.edge_grade.append(grade)
+        else:
+            self.edge_grade[e] = grade
         u.add_item(it, grade)
         it.add_user(u)
 
@@ -72,23 +98,101 @@ class Graph:
         return self.item_dict.get(item_id)
 
     def evaluate_items(self, n_iterations=20):
-        """Evaluates items using the reputation system iterations."""
+        """Evaluates items using the reputation system iterations.
+        There is one message per edge in each direction; the messages are
+        kept in arrays over the edges (ordered by item), and with average
+        aggregation the iterations work in place on preallocated arrays."""
+        bp = self.basic_precision
+        ed = _Edges(self)
+        g = ed.grade
+        n_edges = len(g)
         # Builds the initial messages from users to items.
-        for it in self.items:
-            it.msgs = []
-            for u in it.users:
-                m = Msg()
-                m.user = u
-                m.grade = u.grade[it]
-                m.variance = 1.0
-                it.msgs.append(m)
+        ig = g.copy()
+        iv = np.ones(n_edges)
+        # Messages from items to users.
+        ug = g.copy()
+        uv = np.ones(n_edges)
+        # Work arrays.
+        w = np.empty(n_edges)
+        d = np.empty(n_edges)
+        bias = np.zeros(n_edges)
+        tmp = np.empty(n_edges)
+        s0 = np.empty(n_edges)
+        s1 = np.empty(n_edges)
+        s2 = np.empty(n_edges)
+        rest = np.empty(n_edges)
+        if AGGREGATE_BY_MEDIAN:
+            ipairs = ed.item_pairs()
+            upairs = ed.user_pairs()
         # Does the propagation iterations.
         for i in range(n_iterations):
-            self._propagate_from_items()
-            self._propagate_from_users()
+            # Propagates the information from items to users: the grade and
+            # variance of the item from (the other) users' messages.
+            np.add(bp, iv, out=w)
+            np.reciprocal(w, out=w)
+            ed.item_sums(w, s0, tmp)
+            np.multiply(w, w, out=s2)
+            s2 *= iv
+            ed.item_sums(s2, s2, tmp)
+            np.multiply(s0, s0, out=uv)
+            np.divide(s2, uv, out=uv)
+            if AGGREGATE_BY_MEDIAN:
+                (pe, pf) = ipairs
+                ug[:] = segment_aggregate(ig[pf], w[pf], pe, n_edges)
+            else:
+                np.multiply(w, ig, out=s1)
+                ed.item_sums(s1, s1, tmp)
+                np.divide(s1, s0, out=ug)
+            # Propagates the information from users to items: the user
+            # looks at the messages from (the other) items to compute its
+            # bias and variance.
+            np.add(bp, uv, out=w)
+            np.reciprocal(w, out=w)
+            np.subtract(g, ug, out=d)
+            if AGGREGATE_BY_MEDIAN:
+                (pe, pf) = upairs
+                if DEBIAS:
+                    bias[:] = segment_aggregate(d[pf], w[pf], pe, n_edges)
+                iv[:] = segment_aggregate((d[pf] - bias[pe]) ** 2.0, w[pf], pe, n_edges)
+            elif DEBIAS:
+                # With m the weighted mean of d over all the edges of the
+                # user and dm = d - m, the bias is the mean without the own
+                # edge, m - w dm / (W - w), and the variance estimate is
+                # (sum w dm^2 - w dm^2 W / (W - w)) / (W - w).  (The own
+                # edge only counts when it is left out.)
+                ed.user_sums(w, s0, tmp, leave_out=False)
+                np.multiply(w, d, out=s1)
+                ed.user_sums(s1, s1, tmp, leave_out=False)
+                s1 /= s0
+                d -= s1
+                np.multiply(d, d, out=s2)
+                s2 *= w
+                ed.user_sums(s2, s2, tmp, leave_out=False)
+                np.multiply(w, ed.user_excluded, out=tmp)
+                np.subtract(s0, tmp, out=rest)
+                np.multiply(tmp, d, out=bias)
+                bias /= rest
+                np.subtract(s1, bias, out=bias)
+                tmp *= d
+                tmp *= d
+                tmp *= s0
+                tmp /= rest
+                np.subtract(s2, tmp, out=iv)
+                iv /= rest
+                np.maximum(iv, 0.0, out=iv)
+                # (exactly 0 for a single other item)
+                np.putmask(iv, ed.user_single, 0.0)
+            else:
+                ed.user_sums(w, s0, tmp)
+                np.multiply(w, d, out=s2)
+                s2 *= d
+                ed.user_sums(s2, s2, tmp)
+                np.divide(s2, s0, out=iv)
+            # The grade is the grade given, de-biased.
+            np.subtract(g, bias, out=ig)
         # Does the final aggregation step.
-        self._aggregate_item_messages()
-        self._aggregate_user_messages()
+        item_grade = self._aggregate_item_messages(ed, ig, iv)
+        self._aggregate_user_messages(ed, ug, uv, item_grade)
 
     # Evaluates each item via average voting.
     def avg_evaluate_items(self):
@@ -99,130 +203,41 @@ class Graph:
                 grades.append(u.grade[it])
             it.grade = aggregate(grades)
 
-    def _propagate_from_items(self):
-        """Propagates the information from items to users."""
-        # First, clears all incoming messages.
-        for u in self.users:
-            u.msgs = []
-        # For each item, gives feedback to the users.
-        for it in self.items:
-            # For each user that evaluated the item, reports to that user the following
-            # quantities, computed from other users:
-            # Average/median
-            # Standard deviation
-            # Total weight
-            for u in it.users:
-                if len(it.msgs) > 0:
-                    grades = []
-                    variances = []
-                    for m in it.msgs:
-                        if self.use_all_data or m.user != u or len(it.msgs) < 2:
-                            grades.append(m.grade)
-                            variances.append(m.variance)
-                    variances = np.array(variances)
-                    weights = 1.0 / (self.basic_precision + variances)
-                    weights /= np.sum(weights)
-                    msg = Msg()
-                    msg.item = it
-                    msg.grade = aggregate(grades, weights=weights)
-                    # Now I need to estimate the standard deviation of the grade.
-                    msg.variance = np.sum(variances * weights * weights)
-                    u.msgs.append(msg)
-
-    def _propagate_from_users(self):
-        """Propagates the information from users to items."""
-        # First, clears the messages received in the items.
-        for it in self.items:
-            it.msgs = []
-        # Sends information from users to items.
-        # The information to be sent is a grade, and an estimated standard deviation.
-        for u in self.users:
-            for it in u.items:
-                if len(u.msgs) > 0:
-                    # The user looks at the messages from other items, and computes
-                    # what has been the bias of its evaluation.
-                    msg = Msg()
-                    msg.user = u
-                    biases = []
-                    weights = []
-                    if DEBIAS:
-                        for m in u.msgs:
-                            if self.use_all_data or m.item != it or len(u.msgs) < 2:
-                                weights.append(1 / (self.basic_precision + m.variance))
-                                given_grade = u.grade[m.item]
-                                other_grade = m.grade
-                                biases.append(given_grade - other_grade)
-                        u.bias = aggregate(biases, weights=weights)
-                    else:
-                        u.bias = 0.0
-                    # The grade is the grade given, de-biased.
-                    msg.grade = u.grade[it] - u.bias
-                    # Estimates the standard deviation of the user, from the
-                    # other judged items.
-                    variance_estimates = []
-                    weights = []
-                    for m in u.msgs:
-                        if self.use_all_data or m.item != it or len(u.msgs) < 2:
-                            it_grade = u.grade[m.item] - u.bias
-                            variance_estimates.append((it_grade - m.grade) ** 2.0)
-                            weights.append(1.0 / (self.basic_precision + m.variance))
-                    msg.variance = aggregate(variance_estimates, weights=weights)
-                    # The message is ready for enqueuing.
-                    it.msgs.append(msg)
-
-    def _aggregate_item_messages(self):
+    def _aggregate_item_messages(self, ed, ig, iv):
         """Aggregates the information on an item, computing the grade
         and the variance of the grade."""
-        for it in self.items:
-            it.grade = None
-            it.variance = None
-            if len(it.msgs) > 0:
-                grades = []
-                variances = []
-                for m in it.msgs:
-                    grades.append(m.grade)
-                    variances.append(m.variance)
-                variances = np.array(variances)
-                weights = 1.0 / (self.basic_precision + variances)
-                weights /= np.sum(weights)
-                it.grade = aggregate(grades, weights=weights)
-                it.variance = np.sum(variances * weights * weights)
-
-    def _aggregate_user_messages(self):
+        n_items = len(self.item_list)
+        w = 1.0 / (self.basic_precision + iv)
+        weight = np.bincount(ed.item, w, n_items)
+        grade = segment_aggregate(ig, w, ed.item, n_items)
+        variance = np.bincount(ed.item, iv * w * w, n_items) / (weight * weight)
+        for (it, x, v) in zip(self.item_list, grade.tolist(), variance.tolist()):
+            it.grade = x
+            it.variance = v
+        return grade
+
+    def _aggregate_user_messages(self, ed, ug, uv, item_grade):
         """Aggregates the information on a user, computing the
         variance and bias of a user."""
-        for u in self.users:
-            u.variance = None
-            if len(u.msgs) > 0:
-                biases = []
-                weights = []
-                # Estimates the bias.
-                if DEBIAS:
-                    for m in u.msgs:
-                        weights.append(1 / (self.basic_precision + m.variance))
-                        given_grade = u.grade[m.item]
-                        other_grade = m.grade
-                        biases.append(given_grade - other_grade)
-                    u.bias = aggregate(biases, weights=weights)
-                else:
-                    u.bias = 0.0
-                # Estimates the grade for each item.
-                variance_estimates = []
-                weights = []
-                for m in u.msgs:
-                    it_grade = u.grade[m.item] - u.bias
-                    variance_estimates.append((it_grade - m.item.grade) ** 2.0)
-                    weights.append(1.0 / (self.basic_precision + m.variance))
-                u.variance = aggregate(variance_estimates, weights=weights)
+        n_users = len(self.user_list)
+        w = 1.0 / (self.basic_precision + uv)
+        # Estimates the bias.
+        if DEBIAS:
+            bias = segment_aggregate(ed.grade - ug, w, ed.user, n_users)
+        else:
+            bias = np.zeros(n_users)
+        # Estimates the grade for each item.
+        variance_estimates = (ed.grade - bias[ed.user] - item_grade[ed.item]) ** 2.0
+        variance = segment_aggregate(variance_estimates, w, ed.user, n_users)
+        for (u, b, v) in zip(self.user_list, bias.tolist(), variance.tolist()):
+            u.bias = b
+            u.variance = v
 
     def evaluate_users(self):
         """Evaluates users by comparing their variance with the one computed by
         giving grades at random."""
         # Computes the standard deviation of all grades ever given.
-        all_grades = []
-        for u in self.users:
-            all_grades.extend(u.grade.values())
-        overall_stdev = np.std(all_grades)
+        overall_stdev = np.std(np.array(self.edge_grade, dtype=float))
         # The stdev of the difference between two numbers is sqrt(2) times the
         # stdev of the numbers, assuming normal distribution.
         overall_stdev *= 2 ** 0.5
@@ -248,6 +263,80 @@ class Graph:
             u.quality = max(0.0, 1.0 - (u.variance ** 0.5) / overall_stdev)
 
 
+class _Edges:
+    """The reviews of a graph as arrays over the edges, ordered by item,
+    with the segments of the edges of each item and of each user."""
+
+    def __init__(self, graph):
+        item = np.array(graph.edge_item, dtype=np.intp)
+        order = np.argsort(item, kind='mergesort')
+        self.item = item[order]
+        self.user = np.array(graph.edge_user, dtype=np.intp)[order]
+        self.grade = np.array(graph.edge_grade, dtype=float)[order]
+        # Edges of item k are item_start[k]:item_start[k] + item_degree[k];
+        # edges of user k are user_order[user_start[k]:user_start[k] + user_degree[k]].
+        self.item_degree = np.bincount(self.item, minlength=len(graph.item_list))
+        self.item_start = np.cumsum(self.item_degree) - self.item_degree
+        self.user_order = np.argsort(self.user, kind='mergesort')
+        self.user_degree = np.bincount(self.user, minlength=len(graph.user_list))
+        self.user_start = np.cumsum(self.user_degree) - self.user_degree
+        # Without use_all_data, the message sent along an edge leaves out
+        # the data of that edge (unless it is the only one).
+        use_all_data = graph.use_all_data
+        self.item_excluded = (self.item_degree[self.item] >= 2) & (not use_all_data)
+        self.user_excluded = (self.user_degree[self.user] >= 2) & (not use_all_data)
+        self.user_single = (self.user_degree[self.user] == 2) & (not use_all_data)
+        self.item_total = np.empty(len(self.item_degree))
+        self.user_total = np.empty(len(self.user_degree))
+
+    def item_sums(self, x, out, tmp, leave_out=True):
+        """out[e] = sum of x over the (other) edges of the item of edge e."""
+        np.add.reduceat(x, self.item_start, out=self.item_total)
+        if leave_out:
+            np.multiply(x, self.item_excluded, out=tmp)
+        np.take(self.item_total, self.item, out=out)
+        if leave_out:
+            out -= tmp
+
+    def user_sums(self, x, out, tmp, leave_out=True):
+        """out[e] = sum of x over the (other) edges of the user of edge e."""
+        np.take(x, self.user_order, out=tmp)
+        np.add.reduceat(tmp, self.user_start, out=self.user_total)
+        if leave_out:
+            np.multiply(x, self.user_excluded, out=tmp)
+        np.take(self.user_total, self.user, out=out)
+        if leave_out:
+            out -= tmp
+
+    def item_pairs(self):
+        """(e, f) for each edge e and (other) edge f of its item."""
+        return _segment_pairs(np.arange(len(self.item)), self.item_start, self.item_degree, self.item_excluded)
+
+    def user_pairs(self):
+        """(e, f) for each edge e and (other) edge f of its user."""
+        return _segment_pairs(self.user_order, self.user_start, self.user_degree, self.user_excluded)
+
+
+def _segment_pairs(order, start, degree, excluded):
+    """Pairs (e, f) of edges in the same segment (the edges of segment k are
+    order[start[k]:start[k] + degree[k]]), leaving out f == e if excluded[e]."""
+    seg = np.repeat(np.arange(len(degree)), degree)
+    reps = degree[seg]
+    a = np.repeat(np.arange(len(seg)), reps)
+    b = start[seg[a]] + np.arange(len(a)) - np.repeat(np.cumsum(reps) - reps, reps)
+    (pe, pf) = (order[a], order[b])
+    keep = (pe != pf) | ~excluded[pe]
+    return (pe[keep], pf[keep])
+
+
+def segment_aggregate(values, weights, seg, n):
+    """Aggregates values with weights within each of n segments (seg[k] is
+    the segment of values[k]), using either average or median."""
+    if AGGREGATE_BY_MEDIAN:
+        return segment_median(values, weights, seg, n)
+    return np.bincount(seg, weights * values, n) / np.bincount(seg, weights, n)
+
+
 class Msg():
     def __init__(self):
         pass
@@ -316,6 +405,65 @@ def median_aggregate(values, weights=None):
             return (beta * v[i] + alpha * (v[i] + v[i + 1]) / 2.0) / (alpha + beta)
 
 
+def segment_median(values, weights, seg, n):
+    """Weighted median of the values within each of n segments (seg[k] is
+    the segment of values[k]), as median_aggregate() of each segment:
+    one lexsort by (segment, value, weight), then the same walk along the
+    cumulative weights and the same interpolation, for all segments at once.
+    Segments without values get nan."""
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    seg = np.asarray(seg, dtype=np.intp)
+    out = np.full(n, np.nan)
+    # A segment without positive weights gets its first value.
+    order = np.argsort(seg, kind='mergesort')
+    count = np.bincount(seg, minlength=n)
+    nonempty = count > 0
+    out[nonempty] = values[order[(np.cumsum(count) - count)[nonempty]]]
+    keep = weights > 0
+    if not np.any(keep):
+        return out
+    (v, w, s) = (values[keep], weights[keep], seg[keep])
+    order = np.lexsort((w, v, s))
+    (v, w, s) = (v[order], w[order], s[order])
+    count = np.bincount(s, minlength=n)
+    end = np.cumsum(count)
+    start = end - count
+    # Weight below (and up to) each value of its segment, summed in order
+    # within the segment, rank by rank.
+    rank = np.arange(len(s)) - start[s]
+    by_rank = np.argsort(rank, kind='mergesort')
+    rank_end = np.cumsum(np.bincount(rank))
+    below = np.zeros(len(w))
+    upto = w.copy()
+    for r in range(1, len(rank_end)):
+        at = by_rank[rank_end[r - 1]:rank_end[r]]
+        below[at] = upto[at - 1]
+        upto[at] = below[at] + w[at]
+    # The first value with half the weight of its segment up to it.
+    segs = np.nonzero(count)[0]
+    (start, end) = (start[segs], end[segs])
+    half = upto[end - 1] / 2.0
+    short = upto < np.repeat(half, count[segs])
+    i = np.minimum(start + np.bincount(s, short, n)[segs].astype(np.intp), end - 1)
+    (b, wi, vi) = (below[i], w[i], v[i])
+    v_prev = v[np.maximum(i - 1, start)]
+    v_next = v[np.minimum(i + 1, end - 1)]
+    lower = half < b + 0.5 * wi
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # The value falls between the previous value and this one.
+        alpha = half - b
+        beta = b + 0.5 * wi - half
+        m_lower = (beta * (vi + v_prev) / 2.0 + alpha * vi) / (alpha + beta)
+        # The value falls between this value and the next one.
+        alpha = half - b - 0.5 * wi
+        beta = b + wi - half
+        m_upper = (beta * vi + alpha * (vi + v_next) / 2.0) / (alpha + beta)
+    out[segs] = np.where(lower, np.where(i == start, vi, m_lower),
+                         np.where(i == end - 1, vi, m_upper))
+    return out
+
+
 class TestMedian(unittest.TestCase):
     def test_median_0(self):
         values = [1.0, 3.0, 2.0]
@@ -341,6 +489,16 @@ class TestMedian(unittest.TestCase):
         m = median_aggregate(values, weights=weights)
         self.assertAlmostEqual(m, 2.25, 4)
 
+    def test_segment_median(self):
+        # The cases above, as four segments (in mixed order), plus a single
+        # value and a segment without positive weights.
+        values = [1.0, 3.0, 1.0, 2.0, 3.0, 1.0, 2.0, 3.0, 2.0, 1.0, 3.0, 2.0, 5.0, 4.0, 6.0]
+        weights = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 1.0, 1.0, 2.0, 2.0, 0.0, 0.0, 0.0]
+        seg = [0, 0, 1, 0, 1, 2, 1, 2, 2, 3, 3, 3, 4, 5, 5]
+        m = segment_median(values, weights, seg, 6)
+        for (x, y) in zip(m, [2.0, 2.0, 2.5, 2.25, 5.0, 4.0]):
+            self.assertAlmostEqual(x, y, 4)
+
 
 class test_reputation(unittest.TestCase):
     def test_rep_1(self):
@@ -359,20 +517,20 @@ class test_reputation(unittest.TestCase):
         g.add_review('carl', 'pollo', 5.4)
         g.add_review('luca', 'steak', 6.0)
         g.evaluate_items()
-        print 'pasta', g.get_item('pasta').grade
-        print 'pizza', g.get_item('pizza').grade
-        print 'pollo', g.get_item('pollo').grade
-        print 'variances:'
-        print 'luca', g.get_user('luca').variance
-        print 'mike', g.get_user('mike').variance
-        print 'hugo', g.get_user('hugo').variance
-        print 'anna', g.get_user('anna').variance
-        print 'qualities:'
+        print('pasta', g.get_item('pasta').grade)
+        print('pizza', g.get_item('pizza').grade)
+        print('pollo', g.get_item('pollo').grade)
+        print('variances:')
+        print('luca', g.get_user('luca').variance)
+        print('mike', g.get_user('mike').variance)
+        print('hugo', g.get_user('hugo').variance)
+        print('anna', g.get_user('anna').variance)
+        print('qualities:')
         g.evaluate_users()
-        print 'luca', g.get_user('luca').quality
-        print 'mike', g.get_user('mike').quality
-        print 'hugo', g.get_user('hugo').quality
-        print 'anna', g.get_user('anna').quality
+        print('luca', g.get_user('luca').quality)
+        print('mike', g.get_user('mike').quality)
+        print('hugo', g.get_user('hugo').quality)
+        print('anna', g.get_user('anna').quality)
 
 
 if __name__ == '__main__':
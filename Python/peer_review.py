@@ -1,6 +1,11 @@
 import random
 import math
 
+import numpy as np
+
+from peer_review_util import (AssignmentState, ExclusionIndex, ReviewGraph, cover_assignment, random_assignments,
+                              review_noise)
+
 
 # average elements in list
 def avg(lst):
@@ -14,157 +19,179 @@ def invert_dictlist(d):
 
 # invert a dictionary of lists (with duplicates)
 def invert_dictlist_dup(d):
-    values = set(a for b in d.values() for a in b)
-    reverse_d = dict((new_key, [key for key, value in d.items() if new_key in value]) for new_key in values)
+    reverse_d = {}
+    for key in d:
+        for value in d[key]:
+            keys = reverse_d.setdefault(value, [])
+            # a key lists a value at most once, even if it has it repeatedly.
+            if not keys or keys[-1] != key:
+                keys.append(key)
     return reverse_d
 
 
 # wrapper for backwards compatibility
-def peer_assignment(groups, k, debug=False):
-    return peer_assignment_return_cover(groups, k, debug)[0]
+def peer_assignment(groups, k, debug=False, exclusions=None):
+    return peer_assignment_return_cover(groups, k, debug, exclusions)[0]
+
+
+# the test of whether student s may not review submission x: their own
+# submission, or the exclusions of an ExclusionIndex (if not None).
+def exclusion_test(groups, exclusions=None):
+    if exclusions is not None:
+        return exclusions.is_excluded
+    exclude = invert_dictlist(groups)
+    return lambda s, x: x == exclude[s]
 
 
 # assign students in groups to k submissions, and return the assignments and the generated cover
-def peer_assignment_return_cover(groups, k, debug=False):
+def peer_assignment_return_cover(groups, k, debug=False, exclusions=None):
     """Given no cover, first generate a cover with the first few submissions"""
     """Then, generate the rest of the assignments"""
-    for i in range(1000):
-        submissions = groups.keys()
-
-        # lookup for which submissions to exclude from a particular student.
-        exclude = invert_dictlist(groups)
-        students = exclude.keys()
-        studentList = list(students);
+    submissions = groups.keys()
 
-        # load = ceil(number of students * k / number of submissions)
-        # this is how many copies of random submission lists we need.
-        load = int(math.ceil((len(students) * k) / len(submissions)))
-
-        # Repeat the submissions so that they each occur load times.
-        repeatedSubmissions = [x for x in submissions for i in range(load)]
-
-        # initialize empty assignment and cover
-        assignments = {s: [] for s in students}
-        cover = {s: [] for s in students}
-
-        # cover with the first few submissions. Every time a submission is used, remove it.
-        # This way, each submission is repeated at most load # of times.
-        for s in students:
-            for currentSubmission in repeatedSubmissions:
-                if currentSubmission not in exclude[s]:
-                    assignments[s].append(currentSubmission);
-                    repeatedSubmissions.remove(currentSubmission);
-                    cover[s].append(currentSubmission);
-                    break;
-
-        assignments = peer_assignment_with_cover(groups, k, cover);
-
-        if (assignments != -1):
-            break;
+    # lookup for which submissions to exclude from a particular student.
+    exclude = invert_dictlist(groups)
+    students = exclude.keys()
+    excluded = exclusion_test(groups, exclusions)
+
+    # load = ceil(number of students * k / number of submissions)
+    # this is how many copies of random submission lists we need.
+    load = int(math.ceil((len(students) * k) / len(submissions)))
+
+    # cover with the first few submissions, each used at most load times:
+    # every student takes the first submission in line that is not their own.
+    #   slots[h] = [submission, times it can still be used]
+    slots = [[x, load] for x in submissions]
+    h = 0
+    cover = {s: [] for s in students}
+    covered = {}
+    for s in students:
+        while h < len(slots) and slots[h][1] == 0:
+            h += 1
+        for c in range(h, len(slots)):
+            x = slots[c][0]
+            if slots[c][1] > 0 and not excluded(s, x):
+                slots[c][1] -= 1
+                cover[s].append(x)
+                covered.setdefault(x, []).append(s)
+                break
+
+    assignments = peer_assignment_with_cover(groups, k, cover, debug, exclusions)
 
     if (assignments == -1) and debug:
         print("Couldn't generate good cover!");
 
-    return assignments, invert_dictlist_dup(cover)
+    return assignments, covered
 
 
-def peer_assignment_with_cover_submissions(groups, k, coverSubmissions, debug=False):
-    """Given a list of submissions, generate a cover using those submissions"""
+# assign students in groups to k submissions, num_trials times at once
+# (see random_assignments() in peer_review_util).
+# returns:
+#    (students, submissions, assignments, cover): the ids of the students
+#    and submissions, assignments[t, i] = the k submission indices of
+#    student i in trial t (the first from the cover), and cover[t] = the
+#    indices of the cover submissions of trial t.
+def peer_assignment_trials(groups, k, num_trials, rng=None):
+    submissions = list(groups.keys())
+    students = [s for x in submissions for s in groups[x]]
+    own = np.repeat(np.arange(len(submissions)), [len(groups[x]) for x in submissions])
+    (assignments, cover) = random_assignments(num_trials, own, len(submissions), k, rng)
+    return (students, submissions, assignments, cover)
+
+
+def peer_assignment_with_cover_submissions(groups, k, coverSubmissions, debug=False, exclusions=None):
+    """Given a list of submissions, generate a cover using as few of those submissions as possible"""
     """Then, generate the rest of the assignments"""
+    submissions = groups.keys()
 
-    for i in range(1000):
-        submissions = groups.keys()
-
-        # lookup for which submissions to exclude from a particular student.
-        exclude = invert_dictlist(groups)
-        students = exclude.keys()
-        studentList = list(students);
-
-        # load = ceil(number of students * k / number of submissions)
-        # this is how many copies of random submission lists we need.
-        load = int(math.ceil((len(students) * k) / len(submissions)))
-
-        repeatedCoverSubmissions = [x for x in coverSubmissions for i in range(load)]
-
-        # initialize empty cover
-        cover = {s: [] for s in students}
+    # lookup for which submissions to exclude from a particular student.
+    exclude = invert_dictlist(groups)
+    students = list(exclude.keys())
 
-        # cover with the first few of coverSubmissions
-        for s in students:
-            for currentSubmission in repeatedCoverSubmissions:
-                if currentSubmission not in exclude[s]:
-                    repeatedCoverSubmissions.remove(currentSubmission);
-                    cover[s].append(currentSubmission);
-                    break;
+    # load = ceil(number of students * k / number of submissions)
+    # this is how many copies of random submission lists we need.
+    load = int(math.ceil((len(students) * k) / len(submissions)))
 
-        for s in students:
-            if len(assignments[s]) == 0:
-                if (debug):
-                    print("Error: Submissions cannot cover students!")
-                return -1;
+    if exclusions is None:
+        exclusions = {s: [exclude[s]] for s in students}
+    cover, certificate = cover_assignment(students, coverSubmissions, exclusions, load)
+    if cover is None:
+        if debug:
+            print("Error: Submissions cannot cover students! " + str(len(certificate[0])) + " students (e.g. " +
+                  str(certificate[0][0]) + ") may only review " + str(len(certificate[1])) + " of them.")
+        return -1
 
-        assignments = peer_assignment_with_cover(groups, k, cover);
-        if (assignments == -1):
-            break;
+    assignments = peer_assignment_with_cover(groups, k, {s: [x] for (s, x) in cover.items()}, debug,
+                                             exclusions if isinstance(exclusions, ExclusionIndex) else None)
 
     if (assignments == -1) and debug:
         print("Couldn't generate good cover!");
 
-    return assignments;
+    return assignments
 
 
-def peer_assignment_with_cover(groups, k, cover, debug=False):
+def peer_assignment_with_cover(groups, k, cover, debug=False, exclusions=None):
     """Given an entire cover of (student,submission) pairs, generate the rest of the assignments"""
+    """Returns -1 (with a diagnostic if debug) only if no valid assignment extends the cover"""
+    submissions = list(groups.keys())
 
-    for i in range(1000):
-
-        submissions = groups.keys()
-
-        # lookup for which submissions to exclude from a particular student.
-        exclude = invert_dictlist(groups)
-        students = exclude.keys()
-        studentList = list(students);
-
-        # load = ceil(number of students * k / number of submissions)
-        # this is how many copies of random submission lists we need.
-        load = int(math.ceil((len(students) * k) / len(submissions)))
-
-        # Repeat the submissions so that they each occur load times.
-        repeatedSubmissions = [x for x in submissions for i in range(load)]
-
-        # Assign cover, and remove covered submissions from submissions list
-        assignments = cover;
-        for s in students:
-            for currentSubmission in assignments[s]:
-                repeatedSubmissions.remove(currentSubmission);
-
-        permutedSubmissions = random.sample(repeatedSubmissions, len(repeatedSubmissions));
-        repeatedStudents = [x for x in studentList for i in range(k - 1)]
-        permutedStudents = random.sample(repeatedStudents, len(repeatedStudents));
-
-        for s in permutedStudents:
-            for currentSubmission in permutedSubmissions:
-                assignments[s].append(currentSubmission);
-                if not (check_assignment(groups, assignments)):
-                    assignments[s].remove(currentSubmission);
-                else:
-                    permutedSubmissions.remove(currentSubmission);
-                    break;
-
-        done = True;
-        for s in students:
-            if (len(assignments[s]) < k):
-                done = False;
-        if done:
-            break;
-
-    done = True;
-    for s in students:
-        if (len(assignments[s]) < k):
-            done = False;
-    if not (done) and debug:
-        print("Bad Cover!")
-        return -1;
+    # lookup for which submissions to exclude from a particular student.
+    exclude = invert_dictlist(groups)
+    students = list(exclude.keys())
+    excluded = exclusion_test(groups, exclusions)
+
+    # start from a copy of the cover (the cover itself is left alone).
+    state = AssignmentState(groups, {s: list(cover.get(s, [])) for s in students}, exclusions)
+    assignments = state.assignments
+
+    # the assignment can be completed iff the cover is valid and every student
+    # has enough other submissions left to review.
+    if exclusions is None:
+        bad = [s for s in students if len(submissions) - 1 < k]
+    else:
+        counts = exclusions.counts()
+        bad = [s for s in students if len(submissions) - counts[exclusions.pindex[s]] < k]
+    if not state.is_valid() or bad:
+        bad = [s for s in students if any(excluded(s, x) for x in assignments[s]) or
+               len(set(assignments[s])) != len(assignments[s])] + bad
+        if debug:
+            print("No valid assignment: " + str(len(bad)) + " students (e.g. " + str(bad[0]) +
+                  ") have an invalid cover or fewer than " + str(k) + " submissions to review.")
+        return -1
+
+    # bucket queue of submissions by load (number of reviewers so far),
+    # each bucket in random order.
+    buckets = []
+
+    def push(load, x):
+        while len(buckets) <= load:
+            buckets.append([])
+        bucket = buckets[load]
+        bucket.append(x)
+        r = random.randrange(len(bucket))
+        bucket[r], bucket[-1] = bucket[-1], bucket[r]
+
+    for x in random.sample(submissions, len(submissions)):
+        push(state.load[x], x)
+
+    # give each student the least reviewed submissions they may review.
+    lo = 0
+    for s in random.sample(students, len(students)):
+        skipped = []
+        level = lo
+        while len(assignments[s]) < k:
+            while not buckets[level]:
+                level += 1
+            x = buckets[level].pop()
+            if not state.can_add(s, x):
+                skipped.append((level, x))
+            else:
+                state.add(s, x)
+                push(level + 1, x)
+        for (level, x) in skipped:
+            push(level, x)
+        while lo < len(buckets) and not buckets[lo]:
+            lo += 1
 
     # print the cover
     # here one can also output to file, etc.
@@ -194,9 +221,16 @@ def check_assignment(groups, assignments):
 
 
 # generates random reviews for assignments 
-#    (assignments as returned from peer_assignments())
+#    (assignments as returned from peer_assignments(), or a ReviewGraph)
 #   qualities: {i => number of draws from distribituion}
-def random_reviews(assignments, qualities = {}):
+#   rng: numpy generator for the ReviewGraph case (see review_noise())
+# returns reviews as a dict, or as a ReviewGraph (with the same structure)
+# if assignments is a ReviewGraph.
+def random_reviews(assignments, qualities = {}, rng=None):
+    if isinstance(assignments, ReviewGraph):
+        qs = [qualities.get(i, 1) for i in assignments.peers]
+        return assignments.with_scores(review_noise(assignments.ei, qs, 'uniform', rng))
+
     # fill in qualities if empty.
     # default quality is 1.
     qs = {i:1 for i in assignments.keys()}
@@ -30,22 +30,11 @@ def peer_assignment(groups,k,coverList=[],debug=False):
     # this is how many copies of random submission lists we need.
     load = int(math.ceil((len(students) * k) / len(submissions)))
     
-    # Repeat the submissions so that they each occur load times.
-    repeatedSubmissions = [x for x in submissions for i in range(load-1)]
-    
-    # initialize empty assignment and cover
-    assignments = {s : [] for s in students}
-    cover = {s : [] for s in students}
-    
-    # cover with the first few submissions. Every time a submission is used, remove it.
-    # This way, each submission is repeated at most load # of times.
-    for s in students:
-        for currentSubmission in repeatedSubmissions:
-            if currentSubmission not in exclude[s]:
-                assignments[s].append(currentSubmission);
-                repeatedSubmissions.remove(currentSubmission);
-                cover[s].append(currentSubmission);
-                break;
+    # cover with the first few submissions, each used at most load-1 times
+    # (the copies of it that peer_assignment_with_cover() hands out).
+    cover = cover_submissions(studentList,list(submissions),exclude,load-1,debug);
+    if cover == -1:
+        return -1;
     
     assignments = peer_assignment_with_cover(groups,k,cover,coverList);
     
@@ -78,24 +67,10 @@ def peer_assignment_with_cover_submissions(groups,k,coverSubmissions,coverList=[
     # this is how many copies of random submission lists we need.
     load = int(math.ceil((len(students) * k) / len(submissions)))
     
-    repeatedCoverSubmissions = [x for x in coverSubmissions for i in range(load-1)]
-    
-    # initialize empty cover
-    cover = {s : [] for s in students}
-    
-    # cover with the first few of coverSubmissions
-    for s in students:
-        for currentSubmission in repeatedCoverSubmissions:
-            if currentSubmission not in exclude[s]:
-                repeatedCoverSubmissions.remove(currentSubmission);
-                cover[s].append(currentSubmission);
-                break;
-    
-    for s in students:
-        if len(assignments[s]) == 0:
-            if (debug):
-                print("Error: Submissions cannot cover students!")
-            return -1;
+    # cover with as few of coverSubmissions as possible
+    cover = cover_submissions(studentList,coverSubmissions,exclude,load-1,debug);
+    if cover == -1:
+        return -1;
         
     assignments = peer_assignment_with_cover(groups,k,cover,coverList);
     
@@ -115,6 +90,23 @@ def peer_assignment_with_cover_submissions(groups,k,coverSubmissions,coverList=[
     
     return assignments;
     
+def cover_submissions(students,coverSubmissions,exclude,load,debug=False):
+    """Cover the students with coverSubmissions, each used at most load times (see cover_assignment)"""
+    """Returns {student: [submission]}, or -1 if no such cover exists"""
+    
+    # no copies to spare for a cover: leave it empty.
+    if load < 1:
+        return {s : [] for s in students}
+    
+    cover, certificate = cover_assignment(students,coverSubmissions,{s : [exclude[s]] for s in students},load);
+    if cover is None:
+        if (debug):
+            print("Error: Submissions cannot cover students! " + str(len(certificate[0])) + " students can only review "
+                  + str(len(certificate[1])) + " of them.")
+        return -1;
+    
+    return {s : [x] for (s, x) in cover.items()};
+    
 def peer_assignment_with_cover(groups,k,cover,coverList = [],debug=False):
     """Given an entire cover of (student,submission) pairs, generate the rest of the assignments"""
     
@@ -142,23 +134,38 @@ def peer_assignment_with_cover(groups,k,cover,coverList = [],debug=False):
         
     
         # Assign cover, and remove covered submissions from submissions list
-        assignments = cover;
+        # (the first occurrences of each, as list.remove() would).
+        state = AssignmentState(groups, cover)
+        assignments = state.assignments
+        covered = {}
         for s in students:
             for currentSubmission in assignments[s]:
-                repeatedSubmissions.remove(currentSubmission);
+                covered[currentSubmission] = covered.get(currentSubmission, 0) + 1
+        uncovered = []
+        for currentSubmission in repeatedSubmissions:
+            if covered.get(currentSubmission, 0) > 0:
+                covered[currentSubmission] -= 1
+            else:
+                uncovered.append(currentSubmission)
+        if any(covered.values()):
+            raise ValueError("cover uses a submission more often than it can be reviewed")
+        repeatedSubmissions = uncovered
         
         permutedSubmissions = random.sample(repeatedSubmissions,len(repeatedSubmissions));
         repeatedStudents = [x for x in studentList for i in range(k-1)]
         permutedStudents = random.sample(repeatedStudents,len(repeatedStudents));
     
+        # give each student the first remaining submission they may review
+        # (kept reversed, so taking one near the front is cheap).
+        remaining = permutedSubmissions[::-1]
         for s in permutedStudents:
-            for currentSubmission in permutedSubmissions:
-                assignments[s].append(currentSubmission);
-                if not(check_assignment(groups,assignments)):
-                    assignments[s].remove(currentSubmission);
-                else:
-                    permutedSubmissions.remove(currentSubmission);
-                    break;
+            if not state.is_valid():
+                break
+            for c in range(len(remaining) - 1, -1, -1):
+                if state.can_add(s, remaining[c]):
+                    state.add(s, remaining[c])
+                    del remaining[c]
+                    break
         
         done = True;
         
@@ -203,9 +210,16 @@ def check_assignment(groups,assignments):
 
 
 # generates random reviews for assignments 
-#    (assignments as returned from peer_assignments())
+#    (assignments as returned from peer_assignments(), or a ReviewGraph)
 #   qualities: {i => number of draws from distribituion}
-def random_reviews(assignments, qualities = {}):
+#   rng: numpy generator for the ReviewGraph case (see review_noise())
+# returns reviews as a dict, or as a ReviewGraph (with the same structure)
+# if assignments is a ReviewGraph.
+def random_reviews(assignments, qualities = {}, rng=None):
+    if isinstance(assignments, ReviewGraph):
+        qs = [qualities.get(i, 1) for i in assignments.peers]
+        return assignments.with_scores(review_noise(assignments.ei, qs, 'binomial', rng))
+
     # fill in qualities if empty.
     # default quality is 1.
     if len(qualities.keys()) < 1:
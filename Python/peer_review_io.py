@@ -0,0 +1,166 @@
+"""
+Loads real peer grades (LMS exports) into a ReviewGraph for Vancouver, and
+exclusion lists into an ExclusionIndex.
+
+The files are read in chunks of rows and the grader and submission ids are
+interned to dense integers as they stream by, so memory grows with the
+number of distinct reviews, not with the number of rows or columns.
+"""
+
+import csv
+import itertools
+from array import array
+
+import numpy as np
+
+from peer_review_util import ExclusionIndex, ReviewGraph
+
+
+# read peer grades into a ReviewGraph.
+#    filename:   a .csv file, or a .parquet file (needs pyarrow).
+#    columns:    (grader, submission, score) or (grader, submission, rubric,
+#                score) columns, as indices or as header names.
+#    header:     whether a csv file starts with a header row (needed to give
+#                its columns by name).
+#    chunksize:  number of rows handled at a time.
+# returns:
+#    ReviewGraph with graders as peers.  with a rubric column, every
+#    (submission, rubric element) is its own submission, named
+#    'submission_rubric' as in preprocess.R (read_ground_truth() names the
+#    truths read with a rubric column the same way).
+# NOTES:
+#    - if a grader graded the same submission twice, the last row counts.
+def read_peer_grades(filename, columns=(0, 1, 2), header=False, chunksize=100000):
+    peers = []
+    pindex = {}
+    submissions = []
+    sindex = {}
+    ei = array('l')
+    ej = array('l')
+    r = array('d')
+
+    for chunk in _read_chunks(filename, columns, header, chunksize):
+        if len(columns) == 4:
+            (graders, subs, rubrics, scores) = chunk
+            subs = ['%s_%s' % (s, e) for (s, e) in zip(subs, rubrics)]
+        else:
+            (graders, subs, scores) = chunk
+        ei.extend(_intern(graders, peers, pindex))
+        ej.extend(_intern(subs, submissions, sindex))
+        r.extend(float(score) for score in scores)
+
+    ei = np.frombuffer(ei, dtype=ei.typecode).astype(np.intp) if len(ei) else np.zeros(0, dtype=np.intp)
+    ej = np.frombuffer(ej, dtype=ej.typecode).astype(np.intp) if len(ej) else np.zeros(0, dtype=np.intp)
+    r = np.frombuffer(r, dtype=float) if len(r) else np.zeros(0)
+
+    # keep the last row of each (grader, submission)
+    key = ei * len(submissions) + ej
+    (_, last) = np.unique(key[::-1], return_index=True)
+    if len(last) < len(key):
+        keep = np.sort(len(key) - 1 - last)
+        (ei, ej, r) = (ei[keep], ej[keep], r[keep])
+
+    return ReviewGraph(peers, submissions, ei, ej, r)
+
+
+# read ground truth grades.
+#    filename:   a .csv or .parquet file, as in read_peer_grades().
+#    columns:    (submission, grade) or (submission, rubric, grade) columns,
+#                as indices or header names.
+# returns:
+#    {'submission name' => true grade}.  with a rubric column the names are
+#    'submission_rubric', as read_peer_grades() names them, so the grades
+#    join onto a graph read with rubrics (ground_truth_array()).  a file
+#    without one must already use those names for that, as the
+#    Processed_TA_groundtruth.csv of preprocess.R does.
+def read_ground_truth(filename, columns=(0, 1), header=False, chunksize=100000):
+    truth = {}
+    for chunk in _read_chunks(filename, columns, header, chunksize):
+        if len(columns) == 3:
+            (subs, rubrics, grades) = chunk
+            subs = ['%s_%s' % (s, e) for (s, e) in zip(subs, rubrics)]
+        else:
+            (subs, grades) = chunk
+        truth.update(zip(subs, (float(grade) for grade in grades)))
+    return truth
+
+
+# join ground truths onto the submissions of a graph (as
+# generate_TA_groundtruth_array in preprocess.R does).
+#    graph:      ReviewGraph
+#    truth:      {'submission name' => true grade}
+#    missing:    value for submissions without a ground truth.
+# returns:
+#    array with the true grade of each graph.submissions[j] (in order of
+#    first appearance in the grades file).
+def ground_truth_array(graph, truth, missing=-1.0):
+    return np.array([truth.get(j, missing) for j in graph.submissions], dtype=float)
+
+
+# read exclusions (conflicts of interest, teams, last round's assignments,
+# ...) into an ExclusionIndex.
+#    filename:    a .csv or .parquet file, as in read_peer_grades().
+#    peers:       [peer names] of the index.
+#    submissions: [submission names] of the index.
+#    columns:     (peer, excluded submission) columns, as indices or header
+#                 names.
+#    dense:       as in ExclusionIndex.
+# returns:
+#    ExclusionIndex.  rows with a peer or submission that is not in the
+#    index are skipped (names are matched by their str()).
+def read_exclusions(filename, peers, submissions, columns=(0, 1), header=False, chunksize=100000, dense=None):
+    index = ExclusionIndex(peers, submissions, dense=dense)
+    pnames = dict((str(p), i) for (i, p) in enumerate(index.peers))
+    snames = dict((str(s), j) for (j, s) in enumerate(index.submissions))
+    for (ps, ss) in _read_chunks(filename, columns, header, chunksize):
+        index.add_ids([pnames.get(str(p), -1) for p in ps], [snames.get(str(s), -1) for s in ss])
+    return index
+
+
+# map ids to dense integers, adding new ones to names/index.
+def _intern(ids, names, index):
+    out = []
+    for x in ids:
+        i = index.get(x)
+        if i is None:
+            i = index[x] = len(names)
+            names.append(x)
+        out.append(i)
+    return out
+
+
+# yield the given columns of a file, chunksize rows at a time, as a tuple
+# of lists (one per column).
+def _read_chunks(filename, columns, header, chunksize):
+    if filename.endswith('.parquet'):
+        for chunk in _read_parquet_chunks(filename, columns, chunksize):
+            yield chunk
+        return
+
+    if not header and not all(isinstance(c, int) for c in columns):
+        raise ValueError("columns can only be given by name for a file with a header row (header=True)")
+
+    with open(filename) as f:
+        rows = csv.reader(f)
+        if header:
+            names = next(rows)
+            columns = [names.index(c) if not isinstance(c, int) else c for c in columns]
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                return
+            chunk = [row for row in chunk if row]
+            yield tuple([row[c].strip() for row in chunk] for c in columns)
+
+
+def _read_parquet_chunks(filename, columns, chunksize):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("reading .parquet files needs pyarrow (pip install pyarrow)")
+
+    f = pq.ParquetFile(filename)
+    names = f.schema_arrow.names
+    columns = [names[c] if isinstance(c, int) else c for c in columns]
+    for batch in f.iter_batches(batch_size=chunksize, columns=columns):
+        yield tuple(batch.column(k).to_pylist() for k in range(len(columns)))
@@ -1,10 +1,21 @@
 import math 
 import random
 
+from peer_review_util import ExclusionIndex, cover_assignment
+
 #note this will only work on hashable objects
 def duplicates(tocheck):
   return len(tocheck) != len(set(tocheck))
 
+# excluded(p, s): whether peer p may not review submission s, in O(1).
+#    - excludes: {peer id : [excluded submission ids]}, or an ExclusionIndex
+#         (peer_review_util), which is queried as is.
+def exclusion_test(peers,excludes):
+    if isinstance(excludes, ExclusionIndex):
+        return excludes.is_excluded
+    excludes = {p : set(excludes[p] if p in excludes else []) for p in peers}
+    return lambda p, s: s in excludes[p]
+
 ####
 # GENERATE PEER ASSIGNMENT
 # Input:
@@ -12,7 +23,7 @@ def duplicates(tocheck):
 #    - submissions: [submission ids].
 #    - k: number of submissions to assign each peer.
 #    - cover: [submission ids] (PASS BY REFERENCE)
-#    - excludes: {peer id : [excluded submission ids]}
+#    - excludes: {peer id : [excluded submission ids]} (or an ExclusionIndex)
 #    - num_tries: attempts a random matching this many times
 #         (fails and returns {} if num_tries is exceeded)
 # Output:
@@ -21,12 +32,15 @@ def duplicates(tocheck):
 # Notes:
 #    - if 'cover' is [], then it will replace with a random cover.
 #      (pass by reference)
+#    - the submissions of 'cover' that the agents don't need are dropped
+#      from it (see cover_assignment() in peer_review_util).
 def peer_assignment_covered(peers,submissions,k,cover=[],excludes={},num_tries=1000):
     
     m = len(submissions)
     n = len(peers)
 
-    excludes = {p : (excludes[p] if p in excludes else []) for p in peers}
+    if not isinstance(excludes, ExclusionIndex):
+        excludes = {p : (excludes[p] if p in excludes else []) for p in peers}
     
     # load = ceil(n * k / m)
     # this is how many copies of random submission lists we need.
@@ -34,26 +48,33 @@ def peer_assignment_covered(peers,submissions,k,cover=[],excludes={},num_tries=1
 
     # extend cover to be the right length 
     # by adding random elements from 'submissions \ cover'
-    cover_len = math.ceil(n/load)
+    cover_len = int(math.ceil(float(n) / load))
     if len(cover) < cover_len:
         # get random elements from 'submissions \ cover'
-        gen_cover = random.sample(set(submissions).difference(set(cover)),int(math.ceil(n/load)))
+        taken = set(cover)
+        gen_cover = random.sample([s for s in submissions if s not in taken],cover_len - len(cover))
         # add to cover.
         cover.extend(gen_cover) 
 
 
-    # assign the agents to the cover. 
-    cover_assignments = peer_assignment(peers,submissions,1,excludes,num_tries)
-    if not cover_assignments:
+    # assign the agents to the cover: each to one cover submission, with as
+    # few of them as possible, each taking at most load agents.
+    (cover_assignments, certificate) = cover_assignment(peers,cover,excludes,load)
+    if cover_assignments is None:
         return {}
+    cover_assignments = {p: [cover_assignments[p]] for p in peers}
 
-    # add cover_assignment to excludes.
-    excludes = {p: excludes[p] + cover_assignments[p] for p in peers}
+    # only the cover submissions in use remain in the cover.
+    used = set(s for p in peers for s in cover_assignments[p])
+    cover[:] = [s for s in cover if s in used]
 
-    # the remaining submissions
-    residual_submissions = set(submissions).difference(set(cover))
+    # add cover_assignment to excludes.
+    if isinstance(excludes, ExclusionIndex):
+        excludes = excludes | ExclusionIndex(excludes.peers,excludes.submissions,cover_assignments)
+    else:
+        excludes = {p: excludes[p] + cover_assignments[p] for p in peers}
 
-    residual_assignments = peer_assignment(peers,submissions,1,excludes,num_tries)
+    residual_assignments = peer_assignment(peers,submissions,k - 1,excludes,num_tries) if k > 1 else {p: [] for p in peers}
     if not residual_assignments:
         return {}
     
@@ -68,16 +89,127 @@ def peer_assignment_covered(peers,submissions,k,cover=[],excludes={},num_tries=1
 #    - peers: [peer ids]
 #    - submissions: [submission ids].
 #    - k: number of submissions to assign each peer.
-#    - excludes: {peer id : [excluded submission ids]}
-#    - num_tries: attempts a random matching this many times
+#    - excludes: {peer id : [excluded submission ids]} (or an ExclusionIndex)
+#    - num_tries: gives up after num_tries * n * k swap attempts
 #         (fails and returns {} if num_tries is exceeded)
 # Output:
 #    - assignments: {peer id : [submission_ids]} 
 def peer_assignment(peers,submissions,k,excludes={},num_tries=1000):
+    return peer_assignment_swaps(peers,submissions,k,excludes,num_tries * len(peers) * k)
+
+####
+# GENERATE PEER ASSIGNMENT BY SWAP REPAIR
+# Input:
+#    - peers, submissions, k, excludes: as in peer_assignment.
+#    - max_swaps: swap attempts after which to give up and return {}
+#         (default 100 * n * k).
+#    - mixing: random swap attempts to make after the repair
+#         (default n * k).
+#    - full_output: also return the number of repair swaps.
+# Output:
+#    - assignments: {peer id : [submission_ids]}
+#    - (assignments, swaps) if full_output.
+#
+# Notes:
+#    - the n * k review slots (k per peer) get one shuffled pairing of the
+#      submission copies (load = ceil(n * k / m) copies each, one less for
+#      random ones, as peer_assignment_rejection ends up with). every slot
+#      whose peer has its submission twice, or excludes it, is then swapped
+#      with a random slot whose submission fits it (and the other way
+#      around), so it takes about one swap per conflict instead of a new
+#      matching.
+#    - the mixing swaps are a markov chain on valid assignments (random
+#      slot pairs, swapped if both still fit) whose stationary distribution
+#      is uniform, so they wash out the bias of the repair.
+def peer_assignment_swaps(peers,submissions,k,excludes={},max_swaps=None,mixing=None,full_output=False):
+    n = len(peers)
+    m = len(submissions)
+    slots = n * k
+
+    excluded = exclusion_test(peers,excludes)
+    if max_swaps is None:
+        max_swaps = 100 * slots
+    if mixing is None:
+        mixing = slots
+
+    # load = ceil(n * k / m)
+    # number of peers per submission (rounded up).
+    load = int(math.ceil(float(slots) / m))
+
+    # one copy less of (m * load - n * k) random submissions
+    fewer = set(random.sample(range(m), m * load - slots))
+    slot_peers = peers * k
+    slot_subs = [s for (j, s) in enumerate(submissions) for _ in range(load - (j in fewer))]
+    random.shuffle(slot_subs)
+
+    # held[p][s] = number of slots of peer p with submission s
+    held = {p : {} for p in peers}
+    for (p, s) in zip(slot_peers, slot_subs):
+        held[p][s] = held[p].get(s, 0) + 1
+
+    def conflict(x):
+        (p, s) = (slot_peers[x], slot_subs[x])
+        return held[p][s] > 1 or excluded(p, s)
+
+    def fits(p, s):
+        return s not in held[p] and not excluded(p, s)
+
+    # swap the submissions of slots x and y if both then fit.
+    def swap(x, y):
+        (p, s, q, t) = (slot_peers[x], slot_subs[x], slot_peers[y], slot_subs[y])
+        if not (fits(p, t) and fits(q, s)):
+            return False
+        for (a, b) in ((p, s), (q, t)):
+            held[a][b] -= 1
+            if not held[a][b]:
+                del held[a][b]
+        held[p][t] = 1
+        held[q][s] = 1
+        (slot_subs[x], slot_subs[y]) = (t, s)
+        return True
+
+    swaps = 0
+    attempts = 0
+    for x in [x for x in range(slots) if conflict(x)]:
+        # (the other copy of a duplicate may have been swapped away already)
+        while conflict(x):
+            attempts += 1
+            if attempts > max_swaps:
+                return ({}, swaps) if full_output else {}
+            if swap(x, random.randrange(slots)):
+                swaps += 1
+
+    for _ in range(mixing):
+        swap(random.randrange(slots), random.randrange(slots))
+
+    assignments = {p:[] for p in peers}
+    for (p, s) in zip(slot_peers, slot_subs):
+        assignments[p].append(s)
+
+    if full_output:
+        return (assignments, swaps)
+    return assignments
+
+####
+# GENERATE PEER ASSIGNMENT
+# Input:
+#    - peers: [peer ids]
+#    - submissions: [submission ids].
+#    - k: number of submissions to assign each peer.
+#    - excludes: {peer id : [excluded submission ids]} (or an ExclusionIndex)
+#    - num_tries: attempts a random matching this many times
+#         (fails and returns {} if num_tries is exceeded)
+# Output:
+#    - assignments: {peer id : [submission_ids]} 
+#
+# Notes:
+#    - rejection sampling: reshuffles everything until a matching has no
+#      conflicts. peer_assignment() is much faster for large k or excludes.
+def peer_assignment_rejection(peers,submissions,k,excludes={},num_tries=1000):
     n = len(peers)
     m = len(submissions)
 
-    excludes = {p : (excludes[p] if p in excludes else []) for p in peers}
+    excluded = exclusion_test(peers,excludes)
 
     # load = ceil(n * k / m)
     # number of peers per submission (rounded up).
@@ -110,11 +242,11 @@ def peer_assignment(peers,submissions,k,excludes={},num_tries=1000):
             assignments[p].append(s)
 
         # check for duplicates or excludesd assignemnts
-        if any(duplicates(assignments[p] + excludes[p]) for p in peers):
+        if any(duplicates(assignments[p]) or any(excluded(p, s) for s in assignments[p]) for p in peers):
             continue
 
 
-        print "finished with " + str(count) + " tries."
+        print("finished with " + str(count) + " tries.")
         return assignments
  
     # we failed to find an assignment given the in num_tries tries.
@@ -125,9 +257,9 @@ def peer_assignment(peers,submissions,k,excludes={},num_tries=1000):
 #    - peers are not assigned to review the same submission multiple times.
 #    - peers are not assigned to review any submissions in their excludes list.
 def peer_assignment_check(peers,assignments,excludes):
-    excludes = {p : (excludes[p] if p in excludes else []) for p in peers}
+    excluded = exclusion_test(peers,excludes)
 
-    return not any(duplicates(assignments[p] + excludes[p]) for p in peers)
+    return not any(duplicates(assignments[p]) or any(excluded(p, s) for s in assignments[p]) for p in peers)
 
 
 
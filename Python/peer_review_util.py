@@ -1,9 +1,745 @@
+import copy
+
+import numpy as np
+
+
 # invert a dictionary of lists (assuming no duplicates)
 def invert_dictlist(d):
     return dict( (v,k) for k in d for v in d[k] )
 
 # invert a dictionary of lists (with duplicates)
 def invert_dictlist_dup(d):
-    values = set(a for b in d.values() for a in b)
-    reverse_d = dict((new_key, [key for key,value in d.items() if new_key in value]) for new_key in values)
+    reverse_d = {}
+    for key in d:
+        for value in d[key]:
+            keys = reverse_d.setdefault(value, [])
+            # a key lists a value at most once, even if it has it repeatedly.
+            if not keys or keys[-1] != key:
+                keys.append(key)
     return reverse_d
+
+
+# peer assignment under construction: keeps, for each student, the set of
+# assigned submissions and the excluded (own) submission, so that adding or
+# removing an edge and checking it are O(1).
+#    groups:      {submission => [students]}
+#    assignments: {student => [submissions]} to start from.
+#                 (updated in place; every student in groups gets a list.)
+#    exclusions:  ExclusionIndex of the submissions to exclude instead of
+#                 the own one (e.g. for team submissions or conflicts).
+class AssignmentState:
+    def __init__(self, groups, assignments=None, exclusions=None):
+        # lookup for which submissions to exclude from a particular student.
+        self.exclude = invert_dictlist(groups)
+        self.exclusions = exclusions
+        self.assignments = {} if assignments is None else assignments
+        # count[s][j] = times j is assigned to s; load[j] = reviewers of j
+        self.count = {}
+        self.load = dict.fromkeys(groups, 0)
+        # number of edges that are duplicates or a student's own submission
+        self.invalid = 0
+        for s in self.exclude:
+            js = self.assignments.setdefault(s, [])
+            self.count[s] = {}
+            for j in js:
+                self._count(s, j, 1)
+
+    def _count(self, s, j, c):
+        old = self.count[s].get(j, 0)
+        self.count[s][j] = old + c
+        self.load[j] = self.load.get(j, 0) + c
+        if self._excluded(s, j):
+            self.invalid += c
+        elif (c > 0 and old > 0) or (c < 0 and old > 1):
+            self.invalid += c
+
+    def _excluded(self, s, j):
+        if self.exclusions is None:
+            return j == self.exclude[s]
+        return self.exclusions.is_excluded(s, j)
+
+    # true if assigning j to s keeps s's list valid (no duplicates, not own).
+    def can_add(self, s, j):
+        return not self.count[s].get(j, 0) and not self._excluded(s, j)
+
+    def add(self, s, j):
+        self.assignments[s].append(j)
+        self._count(s, j, 1)
+
+    def remove(self, s, j):
+        self.assignments[s].remove(j)
+        self._count(s, j, -1)
+
+    # same as check_assignment(groups, assignments), in O(1).
+    def is_valid(self):
+        return self.invalid == 0
+
+
+# number of set bits of each byte value.
+_POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+# exclusions of peers from submissions: own and team submissions, declared
+# conflicts of interest, submissions reviewed in an earlier round, etc.
+# kept as one bitset per peer over the submission ids (dense), or, if those
+# would take more than max_bytes, as one set per peer (sparse), so that
+# checking a (peer, submission) pair is O(1) either way.
+#    peers:       [peer names]; peer i is peers[i]
+#    submissions: [submission names]; submission j is submissions[j]
+#    excludes:    {peer name => [excluded submission names]} to start from.
+#    dense:       True or False to force either kind (None: by max_bytes).
+# NOTES:
+#    - reads like an excludes dictionary (index[p], index.get(p), p in
+#      index), so it can be passed wherever one is expected.
+#    - read_exclusions() in peer_review_io loads one from a file.
+#    - exclusions of unknown peers or submissions are ignored (they can't
+#      be assigned anyway).
+#    - combine sources with | (either), & (both) and - (the first but not
+#      the second), over the same peers and submissions.
+class ExclusionIndex:
+    def __init__(self, peers, submissions, excludes=None, dense=None, max_bytes=1 << 28):
+        self.peers = list(peers)
+        self.submissions = list(submissions)
+        self.pindex = dict((p, i) for (i, p) in enumerate(self.peers))
+        self.sindex = dict((s, j) for (j, s) in enumerate(self.submissions))
+        width = (len(self.submissions) + 7) // 8
+        if dense is None:
+            dense = len(self.peers) * width <= max_bytes
+        # bits[i, j >> 3] & (128 >> (j & 7)) is set if peer i excludes submission j
+        self.bits = np.zeros((len(self.peers), width), dtype=np.uint8) if dense else None
+        # sets[i] = excluded submission ids of peer i
+        self.sets = None if dense else [set() for _ in self.peers]
+        self._keys = None
+        if excludes:
+            for p in excludes:
+                self.add(p, excludes[p])
+
+    # one peer in each of its groups (several for team submissions).
+    #    groups:      {submission => [students]}
+    @classmethod
+    def from_groups(cls, groups, dense=None, max_bytes=1 << 28):
+        excludes = {}
+        for (x, students) in groups.items():
+            for s in students:
+                excludes.setdefault(s, []).append(x)
+        return cls(list(excludes), list(groups), excludes, dense, max_bytes)
+
+    def add(self, peer, submissions):
+        i = self.pindex.get(peer)
+        if i is not None:
+            self.add_ids([i] * len(submissions), [self.sindex.get(s, -1) for s in submissions])
+
+    # add exclusions by peer and submission id (ids < 0 are skipped).
+    def add_ids(self, ei, ej):
+        ei = np.asarray(ei, dtype=np.intp)
+        ej = np.asarray(ej, dtype=np.intp)
+        keep = (ei >= 0) & (ej >= 0)
+        (ei, ej) = (ei[keep], ej[keep])
+        if self.bits is not None:
+            np.bitwise_or.at(self.bits, (ei, ej >> 3), (128 >> (ej & 7)).astype(np.uint8))
+        else:
+            for (i, j) in zip(ei.tolist(), ej.tolist()):
+                self.sets[i].add(self.submissions[j])
+        self._keys = None
+
+    # true if peer excludes submission.
+    def is_excluded(self, peer, submission):
+        i = self.pindex.get(peer)
+        if i is None:
+            return False
+        if self.bits is None:
+            return submission in self.sets[i]
+        j = self.sindex.get(submission)
+        return j is not None and bool(self.bits[i, j >> 3] & (128 >> (j & 7)))
+
+    # is_excluded() by peer and submission ids, for arrays of them (which
+    # broadcast against each other).
+    def excluded_ids(self, ei, ej):
+        (ei, ej) = np.broadcast_arrays(np.asarray(ei, dtype=np.intp), np.asarray(ej, dtype=np.intp))
+        if self.bits is not None:
+            return (self.bits[ei, ej >> 3] & (128 >> (ej & 7))) != 0
+        # sparse: look the pairs up in the sorted pair keys i * m + j
+        if self._keys is None:
+            m = len(self.submissions)
+            self._keys = np.sort(np.array([i * m + self.sindex[s] for (i, js) in enumerate(self.sets) for s in js],
+                                          dtype=np.intp))
+        keys = ei * len(self.submissions) + ej
+        at = np.minimum(np.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        return self._keys[at] == keys if len(self._keys) else np.zeros(keys.shape, dtype=bool)
+
+    # number of excluded submissions of each peer (by id).
+    def counts(self):
+        if self.bits is not None:
+            return _POPCOUNT[self.bits].sum(axis=1, dtype=np.intp)
+        return np.array([len(js) for js in self.sets], dtype=np.intp)
+
+    def __getitem__(self, peer):
+        i = self.pindex[peer]
+        if self.bits is not None:
+            # unpack only the nonzero bytes of the row
+            row = self.bits[i]
+            nonzero = np.flatnonzero(row)
+            (k, bit) = np.nonzero(np.unpackbits(row[nonzero]).reshape(-1, 8))
+            return [self.submissions[j] for j in (nonzero[k] * 8 + bit).tolist()]
+        return list(self.sets[i])
+
+    def get(self, peer, default=None):
+        return self[peer] if peer in self.pindex else default
+
+    def __contains__(self, peer):
+        return peer in self.pindex
+
+    def __iter__(self):
+        return iter(self.peers)
+
+    def __len__(self):
+        return len(self.peers)
+
+    # {peer => [excluded submissions]}
+    def as_dict(self):
+        return dict((p, self[p]) for p in self.peers)
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or, set.union)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and, set.intersection)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a & ~b, set.difference)
+
+    def _combine(self, other, bit_op, set_op):
+        if self.peers != other.peers or self.submissions != other.submissions:
+            raise ValueError("can only combine exclusions over the same peers and submissions")
+        result = ExclusionIndex(self.peers, self.submissions, dense=self.bits is not None and other.bits is not None)
+        if result.bits is not None:
+            result.bits = bit_op(self.bits, other.bits)
+        else:
+            result.sets = [set_op(set(self[p]), set(other[p])) for p in self.peers]
+        return result
+
+
+# cover the peers with candidate submissions: give every peer one candidate
+# that it may review, each candidate to at most load peers, using as few
+# candidates as possible.
+#    peers:       [peer ids]
+#    candidates:  [submission ids] to cover with (in order of preference).
+#    excludes:    {peer id => [excluded submission ids]}
+#    load:        number of peers each candidate can take.
+# returns:
+#    (cover, None), with cover = {peer id => submission id}, or
+#    (None, (peers, submissions)) if no cover exists: a certificate of
+#    peers that may only review the given submissions, more of them than
+#    load times the submissions (so no cover can take them all).
+# NOTES:
+#    - linear in the number of peers, candidates and exclusions, except
+#      for the peers that the greedy pass leaves out (see below).
+#    - opens the ceil(n / load) least excluded candidates (the fewest that
+#      can do), and gives the peers, most excluded first, the opened
+#      candidate with the fewest peers so far (from a bucket queue).
+#    - peers left out get an augmenting path (a chain of peers that move
+#      to other candidates) to an opened candidate with room, by a search
+#      that visits every candidate once.  only if there is none is another
+#      candidate opened, and if none can be the search found a certificate.
+#    - if that opened more than ceil(n / load) candidates, a closing pass
+#      moves the peers of the least used ones, by the same search, to the
+#      others.  the fewest candidates is a capacitated set cover, so this
+#      is a heuristic: usually, but not always, the minimum.
+def cover_assignment(peers, candidates, excludes, load):
+    n = len(peers)
+    num_candidates = len(candidates)
+    if not n:
+        return ({}, None)
+    index = dict((x, c) for (c, x) in enumerate(candidates))
+    # excl[i] = candidate indices excluded by peer i
+    excl = [set(index[x] for x in excludes.get(p, ()) if x in index) for p in peers]
+
+    if n > load * num_candidates:
+        return (None, (list(peers), list(candidates)))
+    for (i, p) in enumerate(peers):
+        if len(excl[i]) == num_candidates:
+            return (None, ([p], []))
+
+    # bucket queue: candidates by the number of peers that exclude them
+    excluded_by = [0] * num_candidates
+    for e in excl:
+        for c in e:
+            excluded_by[c] += 1
+    by_count = [[] for _ in range(n + 1)]
+    for c in range(num_candidates):
+        by_count[excluded_by[c]].append(c)
+    preferred = [c for bucket in by_count for c in bucket]
+    opened = [False] * num_candidates
+    for c in preferred[:-(-n // load)]:
+        opened[c] = True
+
+    # greedy pass: buckets[l] = opened candidates with l peers
+    members = [set() for _ in range(num_candidates)]
+    buckets = [[c for c in preferred if opened[c]]] + [[] for _ in range(load)]
+    where = dict((c, h) for (h, c) in enumerate(buckets[0]))
+    assigned = [-1] * n
+    left_out = []
+    by_excl = [[] for _ in range(num_candidates + 1)]
+    for i in range(n):
+        by_excl[len(excl[i])].append(i)
+    lo = 0
+    for i in (i for bucket in reversed(by_excl) for i in bucket):
+        c = -1
+        level = lo
+        while c < 0 and level < load:
+            for x in buckets[level]:
+                if x not in excl[i]:
+                    c = x
+                    break
+            else:
+                level += 1
+        if c < 0:
+            left_out.append(i)
+            continue
+        # move c up one bucket (swapping it with the last of its bucket)
+        bucket = buckets[level]
+        last = bucket[-1]
+        bucket[where[c]] = last
+        where[last] = where[c]
+        bucket.pop()
+        where[c] = len(buckets[level + 1])
+        buckets[level + 1].append(c)
+        assigned[i] = c
+        members[c].add(i)
+        while lo < load and not buckets[lo]:
+            lo += 1
+
+    # search from root: a peer reaches every candidate in pool it may review,
+    # a candidate reaches its peers.  returns (via, reached, spare): via[c]
+    # is the peer that reached candidate c, and spare an opened candidate
+    # with room (-1 if none was reached).
+    def search(root, pool):
+        via = {}
+        reached = [root]
+        spare = -1
+        h = 0
+        while h < len(reached) and spare < 0:
+            i = reached[h]
+            h += 1
+            kept = []
+            for c in pool:
+                if c in excl[i]:
+                    kept.append(c)
+                    continue
+                via[c] = i
+                if opened[c] and len(members[c]) < load:
+                    spare = c
+                    break
+                reached.extend(members[c])
+            pool = kept
+        return (via, reached, spare)
+
+    # augment: every peer on the path to c moves to the candidate it reached.
+    def move(c, via):
+        while True:
+            i = via[c]
+            old = assigned[i]
+            members[c].add(i)
+            assigned[i] = c
+            if old < 0:
+                return
+            members[old].discard(i)
+            c = old
+
+    for root in left_out:
+        (via, reached, spare) = search(root, preferred)
+        if spare < 0:
+            closed = [c for c in via if not opened[c]]
+            if not closed:
+                return (None, ([peers[i] for i in reached], [candidates[c] for c in preferred if c in via]))
+            spare = closed[0]
+            opened[spare] = True
+        move(spare, via)
+
+    # with more candidates in use than ceil(n / load), try to empty the
+    # least used ones into the others.
+    used = [c for c in preferred if members[c]]
+    for x in sorted(used, key=lambda c: len(members[c])):
+        if len(used) <= -(-n // load):
+            break
+        saved = (list(assigned), [set(m) for m in members])
+        opened[x] = False
+        pool = [c for c in preferred if c != x]
+        for i in list(members[x]):
+            members[x].discard(i)
+            assigned[i] = -1
+            (via, _, spare) = search(i, pool)
+            if spare < 0:
+                (assigned, members) = saved
+                opened[x] = True
+                break
+            move(spare, via)
+        else:
+            used.remove(x)
+
+    return (dict((peers[i], candidates[assigned[i]]) for i in range(n)), None)
+
+
+# reviews as a bipartite graph over integer ids, built once in linear time.
+#    peers:       [peer names]; peer i is peers[i]
+#    submissions: [submission names]; submission j is submissions[j]
+#    ei, ej, r:   peer id, submission id and score of each edge (r may be
+#                 (E, D) for D rubric elements), grouped by
+#                 peer (edges of peer i are iptr[i]:iptr[i+1]; the edges
+#                 are reordered if they are not grouped already)
+#    jorder:      edge ids grouped by submission (edges of submission j are
+#                 jorder[jptr[j]:jptr[j+1]])
+# (use review_graph() or assignment_graph() to build one.)
+class ReviewGraph:
+    def __init__(self, peers, submissions, ei, ej, r=None):
+        self.peers = peers
+        self.submissions = submissions
+        self.ei = np.asarray(ei, dtype=np.intp)
+        self.ej = np.asarray(ej, dtype=np.intp)
+        self.r = np.full(len(self.ei), np.nan) if r is None else np.asarray(r, dtype=float)
+
+        # group the edges by peer (keeping their order within a peer)
+        if np.any(self.ei[1:] < self.ei[:-1]):
+            order = np.argsort(self.ei, kind='stable')
+            self.ei = self.ei[order]
+            self.ej = self.ej[order]
+            self.r = self.r[order]
+
+        # forward and reverse adjacency (CSR)
+        self.iptr = np.concatenate(([0], np.cumsum(np.bincount(self.ei, minlength=len(peers)))))
+        self.jptr = np.concatenate(([0], np.cumsum(np.bincount(self.ej, minlength=len(submissions)))))
+        self.jorder = np.argsort(self.ej, kind='stable')
+
+    # the same graph with other scores (the structure is shared).
+    def with_scores(self, r):
+        g = copy.copy(self)
+        g.r = np.asarray(r, dtype=float)
+        return g
+
+    # iassign(i) = submission ids assigned to peer i
+    def iassign(self, i):
+        return self.ej[self.iptr[i]:self.iptr[i + 1]]
+
+    # jassign(j) = peer ids assigned to review submission j
+    def jassign(self, j):
+        return self.ei[self.jorder[self.jptr[j]:self.jptr[j + 1]]]
+
+    # as {'peer name' => {'submission name' => score}}
+    def to_reviews(self):
+        reviews = {p: {} for p in self.peers}
+        for (i, j, score) in zip(self.ei.tolist(), self.ej.tolist(), self.r.tolist()):
+            reviews[self.peers[i]][self.submissions[j]] = score
+        return reviews
+
+    # as {'peer name' => ['submission names']}
+    def to_assignments(self):
+        return {p: [self.submissions[j] for j in self.iassign(i).tolist()] for (i, p) in enumerate(self.peers)}
+
+
+# build a ReviewGraph from {'peer name' => {'submission name' => score}}
+def review_graph(reviews):
+    return _graph([(p, list(reviews[p].keys())) for p in reviews],
+                  [score for p in reviews for score in reviews[p].values()])
+
+
+# build a ReviewGraph (without scores) from {'peer name' => ['submission names']}
+def assignment_graph(assignments):
+    return _graph(list(assignments.items()), None)
+
+
+def _graph(peer_lists, r):
+    peers = [p for (p, _) in peer_lists]
+    submissions = []
+    sindex = {}
+    ei = []
+    ej = []
+    for (i, (p, js)) in enumerate(peer_lists):
+        for j in js:
+            if j not in sindex:
+                sindex[j] = len(submissions)
+                submissions.append(j)
+            ei.append(i)
+            ej.append(sindex[j])
+    return ReviewGraph(peers, submissions, ei, ej, r)
+
+
+# connected components of a bipartite graph, by union-find on the edge
+# arrays: all edges hook the root of one end to the smaller root of the other
+# at once, then the trees are flattened by pointer jumping, until every edge
+# is within one tree.
+#    ei, ej:      peer id and submission id of each edge.
+#    n, m:        number of peers and submissions.
+# returns:
+#    (ilabel, jlabel, count): component of each peer and submission,
+#    numbered 0..count-1 in order of their smallest peer (then submission).
+def connected_components(ei, ej, n, m):
+    # nodes 0..n-1 are the peers, n..n+m-1 the submissions
+    u = np.asarray(ei, dtype=np.intp)
+    v = np.asarray(ej, dtype=np.intp) + n
+    parent = np.arange(n + m)
+    while True:
+        (pu, pv) = (parent[u], parent[v])
+        split = pu != pv
+        if not split.any():
+            break
+        (pu, pv) = (pu[split], pv[split])
+        np.minimum.at(parent, np.maximum(pu, pv), np.minimum(pu, pv))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    (_, label) = np.unique(parent, return_inverse=True)
+    label = label.reshape(-1)
+    return (label[:n], label[n:], int(label.max()) + 1 if len(label) else 0)
+
+
+# split a ReviewGraph into its connected components.
+# returns:
+#    [ReviewGraph], one per component (numbered as in connected_components()),
+#    with the peers, submissions and edges of the component in graph order.
+def component_graphs(graph):
+    n = len(graph.peers)
+    m = len(graph.submissions)
+    (ilabel, jlabel, count) = connected_components(graph.ei, graph.ej, n, m)
+
+    # local ids: position of a peer (submission) among those of its component
+    ilocal = _rank_within(ilabel, count)
+    jlocal = _rank_within(jlabel, count)
+    iorder = np.argsort(ilabel, kind='stable')
+    jorder = np.argsort(jlabel, kind='stable')
+    ibounds = np.concatenate(([0], np.cumsum(np.bincount(ilabel, minlength=count))))
+    jbounds = np.concatenate(([0], np.cumsum(np.bincount(jlabel, minlength=count))))
+
+    elabel = ilabel[graph.ei]
+    eorder = np.argsort(elabel, kind='stable')
+    ebounds = np.concatenate(([0], np.cumsum(np.bincount(elabel, minlength=count))))
+
+    graphs = []
+    for c in range(count):
+        es = eorder[ebounds[c]:ebounds[c + 1]]
+        graphs.append(ReviewGraph([graph.peers[i] for i in iorder[ibounds[c]:ibounds[c + 1]].tolist()],
+                                  [graph.submissions[j] for j in jorder[jbounds[c]:jbounds[c + 1]].tolist()],
+                                  ilocal[graph.ei[es]], jlocal[graph.ej[es]], graph.r[es]))
+    return graphs
+
+
+# position of each element among the elements with the same label.
+def _rank_within(label, count):
+    order = np.argsort(label, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(np.bincount(label, minlength=count))))
+    rank = np.empty(len(label), dtype=np.intp)
+    rank[order] = np.arange(len(label)) - np.repeat(starts[:-1], np.bincount(label, minlength=count))
+    return rank
+
+
+# draw the reviews of all edges at once.
+#    ei:          peer id of each edge.
+#    quality:     quality of each peer (indexed by peer id), an integer >= 1:
+#                 the number of draws a review of that peer averages.
+#    model:       'uniform':  mean of quality uniform draws on [0, 1]
+#                             (as random_reviews() in peer_review.py)
+#                 'binomial': binomial(quality, 0.5) / quality
+#                             (as random_reviews() in peer_review_assignments.py)
+#                 'gaussian': normal with the variance of 'uniform',
+#                             1 / (12 quality)
+#                 'biased':   'uniform' shifted by the bias of the peer
+#    rng:         np.random.Generator (or RandomState) to draw from; the
+#                 global numpy generator (np.random.seed()) by default.
+#    truth:       true score of each edge's submission (or one for all);
+#                 the draws above are centered on 0.5 and shifted to it.
+#    bias:        bias of each peer (indexed by peer id), for 'biased'.
+# returns:
+#    array with the score of each edge (e.g. for ReviewGraph.with_scores()).
+def review_noise(ei, quality, model='uniform', rng=None, truth=0.5, bias=None):
+    if rng is None:
+        # the np.random functions draw from the global generator
+        rng = np.random
+    ei = np.asarray(ei, dtype=np.intp)
+    qs = np.asarray(quality, dtype=np.intp)[ei]
+    if len(qs) and qs.min() < 1:
+        raise ValueError("review_noise needs a quality of at least 1 for every peer")
+
+    if model in ('uniform', 'biased'):
+        # one draw per unit of quality, summed per edge
+        starts = np.cumsum(qs) - qs
+        draws = rng.uniform(0.0, 1.0, int(qs.sum()))
+        scores = np.add.reduceat(draws, starts) / qs if len(qs) else np.zeros(0)
+        if model == 'biased':
+            if bias is None:
+                raise ValueError("the 'biased' model needs a bias for every peer")
+            scores += np.asarray(bias, dtype=float)[ei]
+    elif model == 'binomial':
+        scores = rng.binomial(qs, 0.5) / qs.astype(float)
+    elif model == 'gaussian':
+        scores = 0.5 + rng.normal(0.0, 1.0, len(qs)) / np.sqrt(12.0 * qs)
+    else:
+        raise ValueError("unknown review noise model: %r" % (model,))
+
+    return scores + (np.asarray(truth, dtype=float) - 0.5)
+
+
+# draw many random peer assignments (with covers) at once: in every trial,
+# each peer gets one review of a cover submission and k - 1 others, and no
+# peer reviews its own submission or one submission twice.
+#    num_trials:  number of independent assignments T.
+#    own:         own[i] = submission id of peer i (-1 for none).
+#    m:           number of submissions.
+#    k:           number of submissions to assign each peer.
+#    rng:         np.random.Generator (or RandomState) to draw from; the
+#                 global numpy generator (np.random.seed()) by default.
+#    mixing:      rounds of random valid swaps after the repair.
+#    exclusions:  ExclusionIndex (over peer ids 0..n-1 and submission ids
+#                 0..m-1) of other submissions the peers may not review.
+# returns:
+#    (assignments, cover): assignments[t, i] are the k submission ids of
+#    peer i in trial t (assignments[t, i, 0] is its cover submission);
+#    cover[t] are the c = ceil(n / load) cover submissions of trial t.
+# NOTES:
+#    - as randomAdjacency.m: every submission is copied load = ceil(n k / m)
+#      times, and a random permutation of the copies fills the n k slots
+#      (taking as even a share of every submission as possible).  the cover
+#      slots get the copies of c random submissions.
+#    - randomAdjacency.m redraws a trial with any conflict, which almost
+#      never succeeds for a class.  instead every conflicting slot is
+#      swapped with a random slot of the same kind (cover or not) whenever
+#      both submissions then fit, for all trials at once, until no trial
+#      has a conflict.  only trials that this does not fix (in tight cases,
+#      such as k = m - 1) are drawn again.  the mixing swaps (as peer_assignment_swaps() in
+#      peer_review_lib) wash out the bias of the repair.
+def random_assignments(num_trials, own, m, k, rng=None, mixing=1, exclusions=None):
+    rng = _generator(rng)
+    own = np.asarray(own, dtype=np.intp)
+    n = len(own)
+
+    # excluded(i, j) = peers i may not review submissions j (arrays of ids)
+    def excluded(i, j):
+        if exclusions is None:
+            return j == own[i]
+        return (j == own[i]) | exclusions.excluded_ids(i, j)
+
+    peer_ids = np.arange(n)
+    num_excluded = own >= 0
+    if exclusions is not None:
+        num_excluded = exclusions.counts() + (num_excluded & ~exclusions.excluded_ids(peer_ids, np.maximum(own, 0)))
+    if n and k > m - num_excluded.max():
+        raise ValueError("random_assignments needs at least k submissions for every peer")
+
+    (assignments, cover) = _draw_assignments(num_trials, own, m, k, rng)
+    for _ in range(100):
+        failed = _repair_assignments(assignments, excluded, rng)
+        if not len(failed):
+            break
+        # (rare, in tight cases) draw the trials that did not get repaired again
+        (assignments[failed], cover[failed]) = _draw_assignments(len(failed), own, m, k, rng)
+    else:
+        raise RuntimeError("random_assignments could not find valid assignments")
+
+    slots = num_trials * n * k
+    for _ in range(mixing):
+        t = rng.integers(0, num_trials, slots)
+        i = rng.integers(0, n, slots)
+        col = rng.integers(0, k, slots)
+        _swap_slots(assignments, excluded, rng, t, i, col)
+
+    return (assignments, np.sort(cover, axis=1))
+
+
+# the random assignment routines draw with the np.random.Generator methods
+# (integers, random); a RandomState (or the np.random functions, drawing
+# from the global one, by default) is wrapped to provide them, drawing the
+# same numbers as randint and random_sample.
+def _generator(rng):
+    if rng is None:
+        rng = np.random
+    if hasattr(rng, 'integers'):
+        return rng
+    return _RandomStateGenerator(rng)
+
+
+class _RandomStateGenerator:
+    # state: RandomState, or the np.random module
+    def __init__(self, state):
+        self.state = state
+
+    def integers(self, low, high, size=None):
+        return self.state.randint(low, high, size)
+
+    def random(self, size=None):
+        return self.state.random_sample(size)
+
+
+def _draw_assignments(num_trials, own, m, k, rng):
+    n = len(own)
+    load = -(-n * k // m)
+    c = -(-n // load)
+
+    # cover slots: the first n copies of c random submissions, shuffled
+    cover = rng.random((num_trials, m)).argsort(axis=1)[:, :c]
+    cover_slots = _shuffle_rows(np.repeat(cover, load, axis=1)[:, :n], rng)
+
+    # other slots: the remaining copies, lowest copy numbers first (so the
+    # copies left over are spread over the submissions), shuffled
+    rest = n * (k - 1)
+    counts = np.full(num_trials * m, load)
+    np.subtract.at(counts, (cover_slots + m * np.arange(num_trials)[:, None]).ravel(), 1)
+    copies = np.repeat(np.tile(np.arange(m), num_trials), counts).reshape(num_trials, -1)
+    number = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = number.reshape(num_trials, -1) + rng.random(copies.shape)
+    keep = np.argpartition(keys, rest - 1, axis=1)[:, :rest] if rest else np.zeros((num_trials, 0), dtype=np.intp)
+    other_slots = _shuffle_rows(np.take_along_axis(copies, keep, axis=1), rng)
+
+    assignments = np.concatenate((cover_slots[:, :, None], other_slots.reshape(num_trials, n, k - 1)), axis=2)
+    return (assignments, cover)
+
+
+# swap conflicting slots away for up to rounds rounds.  a few swaps (kick)
+# only need to fit the conflicting slot, moving the conflict elsewhere, so
+# tight cases don't get stuck where no single swap fits both slots.
+# returns:
+#    the trials that still have conflicts.
+def _repair_assignments(assignments, excluded, rng, rounds=100, kick=0.1):
+    for _ in range(rounds):
+        (t, i, col) = np.nonzero(_assignment_conflicts(assignments, excluded))
+        if not len(t):
+            break
+        _swap_slots(assignments, excluded, rng, t, i, col, rng.random(len(t)) < kick)
+    return np.unique(t)
+
+
+def _shuffle_rows(x, rng):
+    return np.take_along_axis(x, rng.random(x.shape).argsort(axis=1), axis=1)
+
+
+# slots whose peer reviews an excluded submission, or the same submission
+# in an earlier slot.
+def _assignment_conflicts(assignments, excluded):
+    bad = excluded(np.arange(assignments.shape[1])[None, :, None], assignments)
+    order = assignments.argsort(axis=2, kind='stable')
+    ordered = np.take_along_axis(assignments, order, axis=2)
+    dup = np.zeros(assignments.shape, dtype=bool)
+    np.put_along_axis(dup, order[:, :, 1:], ordered[:, :, 1:] == ordered[:, :, :-1], axis=2)
+    return bad | dup
+
+
+# swap the submissions of slots (t, i, col) with random slots of the same
+# trial and kind, where both then fit (or, where kick, where the first
+# fits), at most one swap per peer at a time.
+def _swap_slots(assignments, excluded, rng, t, i, col, kick=False):
+    (num_trials, n, k) = assignments.shape
+    i2 = rng.integers(0, n, len(t))
+    col2 = np.where(col == 0, 0, rng.integers(1, max(k, 2), len(t)))
+    s = assignments[t, i, col]
+    s2 = assignments[t, i2, col2]
+    ok = ((i != i2) & ~excluded(i, s2) & ~(assignments[t, i] == s2[:, None]).any(axis=1) &
+          (kick | (~excluded(i2, s) & ~(assignments[t, i2] == s[:, None]).any(axis=1))))
+    (t, i, col, i2, col2, s, s2) = (t[ok], i[ok], col[ok], i2[ok], col2[ok], s[ok], s2[ok])
+
+    # every peer is claimed by one of its swaps; keep the swaps that hold
+    # the claims of both of their peers
+    (a, b, swap) = (t * n + i, t * n + i2, np.arange(len(t)))
+    claim = np.empty(num_trials * n, dtype=np.intp)
+    claim[np.concatenate((a, b))] = np.concatenate((swap, swap))
+    keep = (claim[a] == swap) & (claim[b] == swap)
+    assignments[t[keep], i[keep], col[keep]] = s2[keep]
+    assignments[t[keep], i2[keep], col2[keep]] = s[keep]
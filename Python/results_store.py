@@ -0,0 +1,122 @@
+"""
+An append-only, on-disk store for the results of simulation sweeps, so that an interrupted sweep can resume where it
+stopped and plots can be re-rendered without running the trials again.
+
+A store is a directory with two files: values.f8, the raw float64 values of all results back to back, and index.bin,
+one fixed-size record (key, offset, size) per result. Results are only ever appended (values first, then the index
+record), so a crash can at worst leave a partial record at the end, which is ignored when the store is opened again.
+"""
+
+import functools
+import hashlib
+import os
+
+import numpy as np
+
+
+INDEX_DTYPE = np.dtype([('key', 'S40'), ('offset', '<i8'), ('size', '<i8')])
+
+
+def canonical(value):
+    """
+    Turns a sweep parameter into a representation that is the same in every run: functions (such as a grading
+    algorithm, or the function of a peer_quality tuple) are replaced by their module and name, and partials by their
+    function and arguments. Lambdas, functions defined inside other functions and closures can't be told apart by name,
+    so they raise a ValueError (define them at module level, or bind their values with functools.partial).
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, canonical(v)) for (k, v) in value.items()))
+    if isinstance(value, (tuple, list)):
+        return tuple(canonical(v) for v in value)
+    if isinstance(value, functools.partial):
+        return ('partial', canonical(value.func), canonical(value.args), canonical(value.keywords or {}))
+    if callable(value):
+        if not hasattr(value, '__name__'):
+            return repr(value)
+        qualname = getattr(value, '__qualname__', value.__name__)
+        if '<lambda>' in qualname or '<locals>' in qualname or getattr(value, '__closure__', None):
+            raise ValueError("can't key %r by name: use a module-level function or functools.partial" % (value,))
+        return '%s.%s' % (getattr(value, '__module__', None), value.__name__)
+    return value
+
+
+def result_key(params, seed, trial):
+    """
+    :param params: a dictionary of the parameters of a sweep point (e.g. evaluate_vancouver keyword arguments)
+    :param seed: the seed of the sweep
+    :param trial: the trial index
+    :return the key of the result of one trial of a point (40 hex digits, as bytes)
+    """
+    return hashlib.sha1(repr((canonical(params), seed, trial)).encode('utf-8')).hexdigest().encode('ascii')
+
+
+class ResultsStore:
+    """
+    Maps result keys (see result_key) to results, each a list of 1-D float arrays (such as the error arrays of one
+    trial, or its means, medians and maxes).
+
+    :param path: the directory of the store (created if it does not exist)
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.values_path = os.path.join(path, 'values.f8')
+        self.index_path = os.path.join(path, 'index.bin')
+        for name in (self.values_path, self.index_path):
+            if not os.path.exists(name):
+                open(name, 'wb').close()
+
+        # drop partial records left by a crash
+        for (name, itemsize) in ((self.index_path, INDEX_DTYPE.itemsize), (self.values_path, 8)):
+            size = os.path.getsize(name)
+            if size % itemsize:
+                with open(name, 'r+b') as f:
+                    f.truncate(size - size % itemsize)
+        values_end = os.path.getsize(self.values_path) // 8
+        records = np.fromfile(self.index_path, dtype=INDEX_DTYPE)
+        self.index = {}
+        for (key, offset, size) in records.tolist():
+            if offset + size <= values_end:
+                self.index[key] = (offset, size)
+        self._values = None
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        """
+        :return the stored result of key (a list of arrays), or None
+        """
+        if key not in self.index:
+            return None
+        offset, size = self.index[key]
+        if self._values is None or len(self._values) < offset + size:
+            self._values = np.memmap(self.values_path, dtype='<f8', mode='r')
+        record = np.array(self._values[offset:offset + size])
+
+        # a record is [number of arrays, their lengths..., their values...]
+        num_arrays = int(record[0])
+        bounds = np.cumsum(np.concatenate(([1 + num_arrays], record[1:1 + num_arrays]))).astype(int)
+        return [record[bounds[k]:bounds[k + 1]] for k in range(num_arrays)]
+
+    def put(self, key, arrays):
+        """
+        Appends the result of key (a list of 1-D arrays, or of lists of numbers), unless it is already stored.
+        """
+        if key in self.index:
+            return
+        arrays = [np.asarray(a, dtype=float).ravel() for a in arrays]
+        record = np.concatenate([[len(arrays)], [len(a) for a in arrays]] + arrays).astype('<f8')
+        offset = os.path.getsize(self.values_path) // 8
+        with open(self.values_path, 'ab') as f:
+            f.write(record.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        entry = np.array([(key, offset, len(record))], dtype=INDEX_DTYPE)
+        with open(self.index_path, 'ab') as f:
+            f.write(entry.tobytes())
+        self.index[key] = (offset, len(record))
@@ -0,0 +1,64 @@
+"""
+Tests of peer_review_io.py (run with python -m pytest from this directory).
+"""
+
+import pytest
+
+from peer_review_io import ground_truth_array, read_exclusions, read_ground_truth, read_peer_grades
+
+
+def write_csv(path, rows):
+    path.write_text(u''.join(','.join(str(x) for x in row) + '\n' for row in rows))
+    return str(path)
+
+
+@pytest.mark.parametrize('dense', [True, False])
+def test_read_exclusions(tmp_path, dense):
+    peers = ['alice', 'bob', 'carol']
+    submissions = [1, 2, 3, 4]
+    rows = [('peer', 'submission'), ('alice', 1), ('bob', 2), ('bob', 3), ('alice', 4), ('dave', 1), ('carol', 5),
+            ('bob', 2)]
+    filename = write_csv(tmp_path / 'exclusions.csv', rows)
+    # read in chunks smaller than the file, by header name
+    index = read_exclusions(filename, peers, submissions, columns=('peer', 'submission'), header=True,
+                            chunksize=2, dense=dense)
+    assert (index.bits is not None) == dense
+    assert dict((p, sorted(js)) for (p, js) in index.as_dict().items()) == {'alice': [1, 4], 'bob': [2, 3], 'carol': []}
+    assert index.counts().tolist() == [2, 2, 0]
+    assert index.is_excluded('bob', 3) and not index.is_excluded('carol', 1)
+
+    # by column index, without the header row
+    again = read_exclusions(write_csv(tmp_path / 'plain.csv', rows[1:]), peers, submissions, dense=dense)
+    assert again.counts().tolist() == [2, 2, 0]
+
+
+def test_read_peer_grades(tmp_path):
+    rows = [('grader', 'submission', 'score'), ('alice', 'x', 3), ('bob', 'x', 4), ('alice', 'y', 5),
+            ('carol', 'z', 1), ('alice', 'x', 6)]
+    filename = write_csv(tmp_path / 'grades.csv', rows)
+    graph = read_peer_grades(filename, columns=('grader', 'submission', 'score'), header=True, chunksize=2)
+    # ids are interned in order of first appearance, and the last of the duplicate rows counts
+    assert graph.peers == ['alice', 'bob', 'carol']
+    assert graph.submissions == ['x', 'y', 'z']
+    reviews = sorted(zip(graph.ei.tolist(), graph.ej.tolist(), graph.r.tolist()))
+    assert reviews == [(0, 0, 6.0), (0, 1, 5.0), (1, 0, 4.0), (2, 2, 1.0)]
+
+    truth = read_ground_truth(write_csv(tmp_path / 'truth.csv', [('z', 2), ('x', 7), ('w', 1)]))
+    assert ground_truth_array(graph, truth).tolist() == [7.0, -1.0, 2.0]
+
+
+def test_read_peer_grades_rubric(tmp_path):
+    rows = [('alice', 'x', 'r1', 3), ('alice', 'x', 'r2', 4), ('bob', 'y', 'r1', 5)]
+    graph = read_peer_grades(write_csv(tmp_path / 'grades.csv', rows), columns=(0, 1, 2, 3))
+    assert graph.submissions == ['x_r1', 'x_r2', 'y_r1']
+    # truths with a rubric column join onto the (submission, rubric) pseudo-submissions
+    truth = read_ground_truth(write_csv(tmp_path / 'truth.csv', [('x', 'r2', 8), ('y', 'r1', 9)]), columns=(0, 1, 2))
+    assert ground_truth_array(graph, truth).tolist() == [-1.0, 8.0, 9.0]
+
+
+def test_read_peer_grades_names_need_header(tmp_path):
+    filename = write_csv(tmp_path / 'grades.csv', [('alice', 'x', 3)])
+    with pytest.raises(ValueError):
+        read_peer_grades(filename, columns=('grader', 'submission', 'score'))
+    with pytest.raises(ValueError):
+        read_ground_truth(filename, columns=('submission', 'grade'))
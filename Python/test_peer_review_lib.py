@@ -0,0 +1,72 @@
+"""
+Tests of peer_review_lib.py (run with python -m pytest from this directory).
+"""
+
+import math
+import random
+from collections import Counter
+
+import pytest
+
+from peer_review_lib import peer_assignment, peer_assignment_check, peer_assignment_swaps
+from peer_review_util import ExclusionIndex
+
+
+def class_instance(num_submissions=10, team_size=3):
+    submissions = ['s%d' % j for j in range(num_submissions)]
+    peers = ['p%d' % i for i in range(num_submissions * team_size)]
+    excludes = {p: [submissions[i // team_size]] for (i, p) in enumerate(peers)}
+    return (peers, submissions, excludes)
+
+
+def assert_valid(peers, submissions, k, assignments, excludes):
+    assert set(assignments) == set(peers)
+    for p in peers:
+        assert len(assignments[p]) == k
+        assert len(set(assignments[p])) == k
+        assert not set(assignments[p]) & set(excludes.get(p, []))
+    load = int(math.ceil(float(len(peers) * k) / len(submissions)))
+    assert max(Counter(s for p in peers for s in assignments[p]).values()) <= load
+    assert peer_assignment_check(peers, assignments, excludes)
+
+
+@pytest.mark.parametrize('k', [1, 3, 9])
+def test_peer_assignment_swaps_valid(k):
+    random.seed(k)
+    (peers, submissions, excludes) = class_instance()
+    (assignments, swaps) = peer_assignment_swaps(peers, submissions, k, excludes, full_output=True)
+    assert_valid(peers, submissions, k, assignments, excludes)
+    assert swaps >= 0
+    assert_valid(peers, submissions, k, peer_assignment(peers, submissions, k, excludes), excludes)
+
+
+def test_peer_assignment_swaps_exclusion_index():
+    random.seed(1)
+    (peers, submissions, excludes) = class_instance()
+    index = ExclusionIndex(peers, submissions, excludes)
+    assignments = peer_assignment_swaps(peers, submissions, 4, index)
+    assert_valid(peers, submissions, 4, assignments, excludes)
+
+
+def test_peer_assignment_swaps_count():
+    # one slot per peer and nothing excluded: the first pairing has no conflicts
+    random.seed(2)
+    (peers, submissions, _) = class_instance()
+    (_, swaps) = peer_assignment_swaps(peers, submissions, 1, {}, full_output=True)
+    assert swaps == 0
+
+    # every peer excludes a third of the submissions: the repair has to swap
+    excludes = {p: submissions[i % 3::3] for (i, p) in enumerate(peers)}
+    (assignments, swaps) = peer_assignment_swaps(peers, submissions, 4, excludes, full_output=True)
+    assert_valid(peers, submissions, 4, assignments, excludes)
+    assert swaps > 0
+
+
+def test_peer_assignment_swaps_infeasible():
+    random.seed(3)
+    (peers, submissions, _) = class_instance()
+    excludes = {p: submissions[2:] for p in peers}
+    (assignments, swaps) = peer_assignment_swaps(peers, submissions, 3, excludes, max_swaps=500, full_output=True)
+    assert assignments == {}
+    assert swaps <= 500
+    assert peer_assignment(peers, submissions, 3, excludes, num_tries=1) == {}
@@ -0,0 +1,239 @@
+"""
+Tests of peer_review_util.py (run with python -m pytest from this directory).
+"""
+
+import itertools
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from peer_review_util import (ExclusionIndex, ReviewGraph, assignment_graph, cover_assignment, random_assignments,
+                              review_graph, review_noise)
+
+
+def assert_valid_assignments(assignments, cover, own, m):
+    (num_trials, n, k) = assignments.shape
+    assert ((assignments >= 0) & (assignments < m)).all()
+    assert (assignments != own[None, :, None]).all()
+    rows = np.sort(assignments, axis=2)
+    assert (rows[:, :, 1:] != rows[:, :, :-1]).all()
+    for t in range(num_trials):
+        assert set(assignments[t, :, 0]) <= set(cover[t])
+
+
+@pytest.mark.parametrize('make_rng', [np.random.default_rng, np.random.RandomState])
+def test_random_assignments_rng(make_rng):
+    own = np.repeat(np.arange(20), 3)
+    (assignments, cover) = random_assignments(50, own, 20, 4, make_rng(1))
+    assert assignments.shape == (50, 60, 4)
+    assert_valid_assignments(assignments, cover, own, 20)
+
+    (again, again_cover) = random_assignments(50, own, 20, 4, make_rng(1))
+    assert (again == assignments).all()
+    assert (again_cover == cover).all()
+
+
+def test_random_assignments_global_rng():
+    own = np.repeat(np.arange(10), 2)
+    np.random.seed(7)
+    (assignments, cover) = random_assignments(5, own, 10, 3)
+    assert_valid_assignments(assignments, cover, own, 10)
+    # the same draws as the global RandomState
+    np.random.seed(7)
+    (again, again_cover) = random_assignments(5, own, 10, 3)
+    assert (again == assignments).all() and (again_cover == cover).all()
+    (again, _) = random_assignments(5, own, 10, 3, np.random.RandomState(7))
+    assert (again == assignments).all()
+
+
+def assert_valid_cover(peers, candidates, excludes, load, cover):
+    assert set(cover) == set(peers)
+    for p in peers:
+        assert cover[p] in candidates
+        assert cover[p] not in excludes.get(p, ())
+    assert max(Counter(cover.values()).values()) <= load
+
+
+def minimal_cover_size(peers, candidates, excludes, load):
+    # brute force: the fewest candidates whose load slots can take every peer
+    def place(i, taken, room):
+        if i == len(peers):
+            return True
+        for c in taken:
+            if room[c] and c not in excludes.get(peers[i], ()):
+                room[c] -= 1
+                if place(i + 1, taken, room):
+                    return True
+                room[c] += 1
+        return False
+    for size in range(len(candidates) + 1):
+        for taken in itertools.combinations(candidates, size):
+            if place(0, taken, dict((c, load) for c in taken)):
+                return size
+    return None
+
+
+def test_cover_assignment_feasible():
+    peers = ['p%d' % i for i in range(30)]
+    candidates = ['s%d' % j for j in range(10)]
+    excludes = dict((p, [candidates[i // 3]]) for (i, p) in enumerate(peers))
+    for (load, size) in ((3, 10), (4, 8), (7, 5), (30, 2)):
+        (cover, certificate) = cover_assignment(peers, candidates, excludes, load)
+        assert certificate is None
+        assert_valid_cover(peers, candidates, excludes, load, cover)
+        assert len(set(cover.values())) == size
+
+
+def test_cover_assignment_minimal():
+    # the least excluded candidates are A and C, but p1 can take neither
+    # with p2 and p3 on C: the two that do are B and C
+    peers = ['p1', 'p2', 'p3']
+    excludes = {'p1': ['A', 'B'], 'p2': ['C'], 'p3': ['C']}
+    (cover, certificate) = cover_assignment(peers, ['A', 'B', 'C'], excludes, 2)
+    assert certificate is None
+    assert_valid_cover(peers, ['A', 'B', 'C'], excludes, 2, cover)
+    assert len(set(cover.values())) == 2
+
+
+def test_cover_assignment_infeasible():
+    peers = ['p%d' % i for i in range(6)]
+    candidates = ['A', 'B', 'C', 'D']
+    # five peers may only review A or B, which take four of them
+    excludes = dict((p, ['C', 'D']) for p in peers[:5])
+    (cover, (some_peers, some_candidates)) = cover_assignment(peers, candidates, excludes, 2)
+    assert cover is None
+    assert len(some_peers) > 2 * len(some_candidates)
+    for p in some_peers:
+        assert set(candidates) - set(some_candidates) <= set(excludes.get(p, ()))
+
+
+def test_cover_assignment_small_instances():
+    rng = random.Random(0)
+    (found, minimal) = (0, 0)
+    for _ in range(300):
+        peers = ['p%d' % i for i in range(rng.randint(1, 6))]
+        candidates = ['s%d' % c for c in range(rng.randint(1, 4))]
+        load = rng.randint(1, 3)
+        excludes = dict((p, rng.sample(candidates, rng.randint(0, len(candidates)))) for p in peers)
+        (cover, certificate) = cover_assignment(peers, candidates, excludes, load)
+        size = minimal_cover_size(peers, candidates, excludes, load)
+        if cover is None:
+            assert size is None
+            (some_peers, some_candidates) = certificate
+            assert len(some_peers) > load * len(some_candidates)
+        else:
+            assert_valid_cover(peers, candidates, excludes, load, cover)
+            found += 1
+            minimal += len(set(cover.values())) == size
+    # a heuristic, but rarely off the minimum
+    assert minimal >= 0.95 * found
+
+
+def random_excludes(rng, peers, submissions, p):
+    return dict((x, [s for s in submissions if rng.random() < p]) for x in peers)
+
+
+@pytest.mark.parametrize('num_submissions', [1, 8, 13, 70])
+def test_exclusion_index_dense_matches_sparse(num_submissions):
+    rng = random.Random(num_submissions)
+    peers = ['p%d' % i for i in range(25)]
+    submissions = ['s%d' % j for j in range(num_submissions)]
+    excludes = random_excludes(rng, peers, submissions, 0.3)
+    # exclusions of unknown peers and submissions are ignored
+    excludes['nobody'] = submissions[:1]
+    excludes[peers[0]] = excludes[peers[0]] + ['unknown']
+    dense = ExclusionIndex(peers, submissions, excludes, dense=True)
+    sparse = ExclusionIndex(peers, submissions, excludes, dense=False)
+    assert dense.bits is not None and sparse.bits is None
+
+    expected = np.array([[s in excludes[p] for s in submissions] for p in peers])
+    (ei, ej) = np.meshgrid(np.arange(len(peers)), np.arange(num_submissions), indexing='ij')
+    for index in (dense, sparse):
+        assert (index.excluded_ids(ei, ej) == expected).all()
+        assert (index.counts() == expected.sum(axis=1)).all()
+        for (i, p) in enumerate(peers):
+            assert sorted(index[p]) == sorted(s for s in submissions if s in excludes[p])
+            assert [index.is_excluded(p, s) for s in submissions] == expected[i].tolist()
+        assert not index.is_excluded('nobody', submissions[0])
+        assert not index.is_excluded(peers[0], 'unknown')
+        assert 'nobody' not in index
+
+
+def test_exclusion_index_combine():
+    rng = random.Random(5)
+    peers = ['p%d' % i for i in range(20)]
+    submissions = ['s%d' % j for j in range(30)]
+    (a, b) = (random_excludes(rng, peers, submissions, 0.4), random_excludes(rng, peers, submissions, 0.4))
+    expected = {'|': set.union, '&': set.intersection, '-': set.difference}
+    for (dense_a, dense_b) in itertools.product([True, False], repeat=2):
+        x = ExclusionIndex(peers, submissions, a, dense=dense_a)
+        y = ExclusionIndex(peers, submissions, b, dense=dense_b)
+        for (op, result) in (('|', x | y), ('&', x & y), ('-', x - y)):
+            assert (result.bits is not None) == (dense_a and dense_b)
+            for p in peers:
+                assert set(result[p]) == expected[op](set(a[p]), set(b[p]))
+            assert (result.counts() == [len(expected[op](set(a[p]), set(b[p]))) for p in peers]).all()
+
+    with pytest.raises(ValueError):
+        ExclusionIndex(peers, submissions, a) | ExclusionIndex(peers[1:], submissions, b)
+
+
+def test_review_graph():
+    reviews = {'p2': {'x': 1.0, 'y': 2.0}, 'p0': {'y': 3.0}, 'p1': {}, 'p3': {'z': 4.0, 'x': 5.0}}
+    g = review_graph(reviews)
+    assert g.peers == ['p2', 'p0', 'p1', 'p3']
+    assert g.submissions == ['x', 'y', 'z']
+    assert g.to_reviews() == reviews
+    assert g.to_assignments() == {'p2': ['x', 'y'], 'p0': ['y'], 'p1': [], 'p3': ['z', 'x']}
+    assert g.iassign(1).tolist() == [1] and g.iassign(2).tolist() == []
+    assert sorted(g.jassign(0).tolist()) == [0, 3] and sorted(g.jassign(1).tolist()) == [0, 1]
+
+    # edges out of peer order are grouped by peer, keeping their order within a peer
+    g = ReviewGraph(['a', 'b'], ['x', 'y', 'z'], [1, 0, 1, 0], [2, 1, 0, 0], [1.0, 2.0, 3.0, 4.0])
+    assert g.ei.tolist() == [0, 0, 1, 1]
+    assert g.ej.tolist() == [1, 0, 2, 0]
+    assert g.r.tolist() == [2.0, 4.0, 1.0, 3.0]
+    assert g.iptr.tolist() == [0, 2, 4] and g.jptr.tolist() == [0, 2, 3, 4]
+
+    h = g.with_scores([5.0, 6.0, 7.0, 8.0])
+    assert h.to_reviews() == {'a': {'y': 5.0, 'x': 6.0}, 'b': {'z': 7.0, 'x': 8.0}}
+    assert g.r.tolist() == [2.0, 4.0, 1.0, 3.0]
+    assert np.isnan(assignment_graph({'a': ['x']}).r).all()
+
+
+@pytest.mark.parametrize('model', ['uniform', 'binomial', 'gaussian', 'biased'])
+def test_review_noise(model):
+    quality = np.array([1, 4, 16])
+    bias = np.array([0.0, 0.1, -0.2])
+    ei = np.repeat(np.arange(3), 20000)
+    truth = np.tile([0.2, 0.7], 30000)
+    scores = review_noise(ei, quality, model, np.random.default_rng(0), truth, bias)
+    assert scores.shape == ei.shape
+    # centered on the truth (plus the bias), with variance 1 / (12 quality) (binomial: 1 / (4 quality))
+    shift = bias if model == 'biased' else np.zeros(3)
+    scale = 4.0 if model == 'binomial' else 12.0
+    for i in range(3):
+        error = (scores - truth)[ei == i]
+        assert error.mean() == pytest.approx(shift[i], abs=0.01)
+        assert error.var() == pytest.approx(1.0 / (scale * quality[i]), rel=0.05)
+
+
+def test_review_noise_generators():
+    (ei, quality) = (np.arange(10) % 3, [1, 2, 3])
+    # the global generator by default
+    np.random.seed(4)
+    scores = review_noise(ei, quality)
+    np.random.seed(4)
+    assert (review_noise(ei, quality) == scores).all()
+    assert (review_noise(ei, quality, rng=np.random.RandomState(4)) == scores).all()
+    assert (review_noise(ei, quality, rng=np.random.default_rng(4)) == review_noise(
+        ei, quality, rng=np.random.default_rng(4))).all()
+
+    with pytest.raises(ValueError):
+        review_noise(ei, [1, 0, 1])
+    with pytest.raises(ValueError):
+        review_noise(ei, quality, 'biased')
+    with pytest.raises(ValueError):
+        review_noise(ei, quality, 'cauchy')
@@ -0,0 +1,33 @@
+"""
+Tests of results_store.py (run with python -m pytest from this directory).
+"""
+
+import functools
+import random
+
+import pytest
+
+from results_store import canonical, result_key
+
+
+def scale(x, factor):
+    return x * factor
+
+
+def test_result_key_functions():
+    params = {'peer_quality': (random.randint, 1, 5), 'grading': scale}
+    assert result_key(params, 0, 1) == result_key(dict(params), 0, 1)
+    assert result_key(params, 0, 1) != result_key(params, 0, 2)
+    assert canonical(functools.partial(scale, factor=2)) != canonical(functools.partial(scale, factor=3))
+
+
+def test_canonical_rejects_lambdas_and_closures():
+    def make_scale(factor):
+        return lambda x: x * factor
+
+    def nested(x):
+        return x
+
+    for value in (lambda x: x, make_scale(2), nested):
+        with pytest.raises(ValueError):
+            result_key({'grading': value}, 0, 0)
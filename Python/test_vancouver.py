@@ -0,0 +1,202 @@
+"""
+Tests of vancouver.py (run with python -m pytest from this directory).
+"""
+
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+import peer_review
+from vancouver import (SolveCache, VancouverState, simple_vancouver, solve_key, vancouver, vancouver_batch,
+                       vancouver_components)
+
+
+def class_reviews(seed, num_submissions=30, k=3):
+    random.seed(seed)
+    np.random.seed(seed)
+    groups = {'s%d' % z: ['s%d_%d' % (z, x) for x in range(3)] for z in range(num_submissions)}
+    assignments = peer_review.peer_assignment(groups, k)
+    return peer_review.random_reviews(assignments, {i: random.randint(1, 5) for i in assignments})
+
+
+def assert_matches_vancouver(state, reviews, truth):
+    (scores, quality, (iterations, _)) = vancouver(reviews, truth, 100000, tol=1e-13, damping=state.damping,
+                                                   full_output=True)
+    assert iterations < 100000
+    assert state.converged
+    (state_scores, state_quality) = state.results()
+    assert set(state_scores) == set(scores)
+    for j in scores:
+        assert state_scores[j][0] == pytest.approx(scores[j][0], abs=1e-5)
+        assert state_scores[j][1] == pytest.approx(scores[j][1], abs=1e-5)
+    for i in quality:
+        assert state_quality[i] == pytest.approx(quality[i], abs=1e-5)
+
+
+def test_vancouver_state_matches_vancouver():
+    reviews = class_reviews(2)
+    truth = {'s0': 0.5, 's1': 0.5}
+    state = VancouverState(reviews, truth, tol=1e-8)
+    assert_matches_vancouver(state, reviews, truth)
+
+    peer = 's3_0'
+    submission = [j for j in sorted(reviews['s4_1']) if j not in reviews[peer] and j != 's3'][0]
+    state.add_review(peer, submission, 0.7)
+    reviews[peer][submission] = 0.7
+    assert_matches_vancouver(state, reviews, truth)
+
+    state.remove_review(peer, submission)
+    del reviews[peer][submission]
+    assert_matches_vancouver(state, reviews, truth)
+
+    state.add_truth('s7', 0.5)
+    truth['s7'] = 0.5
+    assert_matches_vancouver(state, reviews, truth)
+
+
+def test_vancouver_state_reports_no_convergence():
+    with pytest.warns(RuntimeWarning):
+        state = VancouverState(class_reviews(0, 300), {'s0': 0.5}, t=5)
+    assert not state.converged
+
+
+@pytest.mark.parametrize('damping', [0.0, 0.5])
+def test_vancouver_backends_agree(damping):
+    pytest.importorskip('numba')
+    reviews = class_reviews(1)
+    truth = {'s0': 0.5, 's5': 0.25}
+    results = [vancouver(reviews, truth, 30, damping=damping, full_output=True, backend=backend)
+               for backend in ('numpy', 'numba')]
+    (numpy_scores, numpy_quality, (_, numpy_state)) = results[0]
+    (numba_scores, numba_quality, (_, numba_state)) = results[1]
+    assert numba_scores == numpy_scores
+    assert numba_quality == numpy_quality
+    assert all(np.array_equal(a, b) for (a, b) in zip(numba_state, numpy_state))
+
+
+def test_vancouver_reports_no_convergence():
+    reviews = class_reviews(2)
+    with pytest.warns(RuntimeWarning):
+        vancouver(reviews, {'s0': 0.5}, 50, tol=1e-12)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        (_, _, (iterations, _)) = vancouver(reviews, {'s0': 0.5}, 100000, tol=1e-12, damping=0.5, full_output=True)
+    assert iterations < 100000
+
+
+def renamed(reviews, prefix):
+    return dict((prefix + i, dict((prefix + j, score) for (j, score) in reviews[i].items())) for i in reviews)
+
+
+def assert_same_results(results, expected, rel=1e-12):
+    (scores, quality) = results[:2]
+    (expected_scores, expected_quality) = expected[:2]
+    assert set(scores) == set(expected_scores) and set(quality) == set(expected_quality)
+    for j in expected_scores:
+        assert scores[j] == pytest.approx(expected_scores[j], rel=rel)
+    for i in expected_quality:
+        assert quality[i] == pytest.approx(expected_quality[i], rel=rel)
+
+
+def test_vancouver_batch_matches_vancouver():
+    # names repeat across the graphs, which only need to be unique within one
+    reviews_list = [class_reviews(seed, num_submissions) for (seed, num_submissions) in ((3, 10), (4, 25), (5, 10))]
+    truth_list = [{'s0': 0.5}, {}, {'s1': 0.2, 's2': 0.9}]
+    results = vancouver_batch(reviews_list, truth_list, 20, full_output=True)
+    assert len(results) == 3
+    for (reviews, truth, result) in zip(reviews_list, truth_list, results):
+        expected = vancouver(reviews, truth, 20, full_output=True)
+        assert_same_results(result, expected)
+        (iterations, (ivars, jmeans)) = result[2]
+        assert iterations == 20
+        assert np.allclose(ivars, expected[2][1][0], rtol=1e-12) and np.allclose(jmeans, expected[2][1][1], rtol=1e-12)
+
+    # continuing from the states gives the same as continuing each graph
+    states = [result[2][1] for result in results]
+    for (reviews, truth, result, state) in zip(reviews_list, truth_list, vancouver_batch(
+            reviews_list, truth_list, 5, states=states), states):
+        assert_same_results(result, vancouver(reviews, truth, 5, state=state))
+
+
+def test_solve_key():
+    reviews = class_reviews(6, 10)
+    key = solve_key(reviews, {'s0': 0.5}, 20)
+    assert solve_key(class_reviews(6, 10), {'s0': 0.5}, 20) == key
+    assert solve_key(reviews, {'s0': 0.5}, 20, tol=None) == key
+    changed = dict((i, dict(reviews[i])) for i in reviews)
+    some_peer = sorted(changed)[0]
+    changed[some_peer][sorted(changed[some_peer])[0]] += 0.01
+    others = [solve_key(changed, {'s0': 0.5}, 20), solve_key(reviews, {'s0': 0.4}, 20),
+              solve_key(reviews, {'s1': 0.5}, 20), solve_key(reviews, {'s0': 0.5}, 21),
+              solve_key(reviews, {'s0': 0.5}, 20, tol=1e-6)]
+    assert len(set(others + [key])) == len(others) + 1
+
+
+def test_solve_cache_lru():
+    (a, b, c) = [class_reviews(seed, 10) for seed in (7, 8, 9)]
+    truth = {'s0': 0.5}
+    cache = SolveCache(maxsize=2)
+    (ra, rb) = cache.batch([a, b], [truth, truth], 20)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert_same_results(ra, vancouver(a, truth, 20), rel=0)
+    assert_same_results(rb, vancouver(b, truth, 20), rel=0)
+
+    # a is used again, so c evicts b
+    assert cache.batch([a], [truth], 20)[0] == ra
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.batch([c, c], [truth, truth], 20)
+    assert (cache.hits, cache.misses) == (2, 3)
+    assert list(cache.results) == [solve_key(a, truth, 20), solve_key(c, truth, 20)]
+    assert cache.get(solve_key(b, truth, 20)) is None
+
+    # full output from the cache, as vancouver() gives it
+    (scores, quality, (iterations, (ivars, jmeans))) = cache.batch([a], [truth], 20, full_output=True)[0]
+    expected = vancouver(a, truth, 20, full_output=True)
+    assert_same_results((scores, quality), expected, rel=0)
+    assert iterations == 20 and np.array_equal(ivars, expected[2][1][0]) and np.array_equal(jmeans, expected[2][1][1])
+
+    # a solve put() without its state is solved again for full output
+    key = solve_key(b, truth, 20)
+    cache.put(key, vancouver(b, truth, 20))
+    misses = cache.misses
+    assert len(cache.batch([b], [truth], 20, full_output=True)[0]) == 3
+    assert cache.misses == misses + 1
+    assert len(cache.results[key]) == 3
+
+
+def test_vancouver_components_matches_vancouver():
+    (a, b) = (renamed(class_reviews(10, 12), 'a'), renamed(class_reviews(11, 20), 'b'))
+    reviews = dict(list(a.items()) + list(b.items()))
+    truth = {'as0': 0.5, 'bs3': 0.8}
+    (scores, quality, invalid) = vancouver_components(reviews, truth, 20)
+    assert invalid == []
+    assert_same_results((scores, quality), vancouver(reviews, truth, 20))
+
+    # a component with a single review is reported and not solved
+    reviews['loner'] = {'lonely': 0.5}
+    (scores, quality, invalid) = vancouver_components(reviews, truth, 20)
+    assert invalid == [(['loner'], ['lonely'])]
+    assert 'lonely' not in scores and 'loner' not in quality
+    del reviews['loner']
+
+    # with a cache, only the component that changed is solved again
+    cache = SolveCache()
+    vancouver_components(reviews, truth, 20, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 2)
+    truth['bs4'] = 0.1
+    (scores, quality, _) = vancouver_components(reviews, truth, 20, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert_same_results((scores, quality), vancouver(reviews, truth, 20))
+
+
+@pytest.mark.parametrize('seed, truth, t', [(12, {}, 1), (13, {'s0': 0.5}, 10), (14, {'s0': 0.2, 's3': 0.9}, 40)])
+def test_vancouver_matches_dict_version(seed, truth, t):
+    # the per-edge message passing over the edge arrays does what the dict comprehensions of
+    # peer_review.vancouver() (and the per-node updates of peer_review.simple_vancouver()) do
+    reviews = class_reviews(seed, 20, k=4)
+    assert_same_results(vancouver(reviews, truth, t), peer_review.vancouver(reviews, truth, t), rel=1e-9)
+    assert_same_results(simple_vancouver(reviews, truth, t), peer_review.simple_vancouver(reviews, truth, t),
+                        rel=1e-9)
+
@@ -0,0 +1,125 @@
+"""
+Tests of vancouver_simulations.py (run with python -m pytest from this directory).
+"""
+
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+import vancouver_simulations
+from results_store import ResultsStore
+from vancouver import vancouver
+from vancouver_simulations import (ErrorDistribution, TruthStrategy, highest_grade_error, highest_variance,
+                                   highest_variance_error, random_priority, random_trial, run_sweep)
+
+
+def test_run_sweep_store_keeps_points_apart(tmp_path):
+    params = {'num_assignments': 10, 'num_reviews': 3, 'num_truths': 2, 'peer_quality': (random.randint, 1, 5)}
+    expected = run_sweep([params, params], 2, seed=3)
+    assert expected[0] != expected[1]
+    store = ResultsStore(str(tmp_path))
+    assert run_sweep([params, params], 2, seed=3, store=store) == expected
+    assert run_sweep([params, params], 2, seed=3, store=store) == expected
+
+
+def test_error_distribution_empty():
+    dist = ErrorDistribution()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert np.isnan(dist.mean())
+        assert np.isnan(dist.cdf(0.5))
+        assert np.isnan(dist.quantile(0.5))
+        assert np.isnan(dist.quantile([0.25, 0.75])).all()
+        assert np.isnan(dist.cdf_curve(5)[1]).all()
+        assert (dist.histogram()[0] == 0).all()
+
+
+def test_error_distribution_fixed_bins_merge_exactly():
+    edges = np.linspace(0.0, 4.0, 17)
+    samples = [np.random.RandomState(seed).exponential(size=500) for seed in range(6)]
+    parts = [ErrorDistribution(compression=20, edges=edges) for _ in range(3)]
+    for (k, values) in enumerate(samples):
+        parts[k % 3].add(values)
+    dist = parts[0].merge(parts[1]).merge(parts[2])
+    (counts, bin_edges) = dist.histogram()
+    assert (bin_edges == edges).all()
+    assert (counts == np.histogram(np.concatenate(samples), edges)[0]).all()
+    # the sketch still estimates other bins
+    assert dist.histogram(4)[0].sum() == pytest.approx(dist.count)
+    with pytest.raises(ValueError):
+        dist.merge(ErrorDistribution(edges=edges[:-1]))
+    with pytest.raises(ValueError):
+        dist.merge(ErrorDistribution())
+
+
+def test_error_distribution_summaries():
+    dist = ErrorDistribution(compression=20)
+    for seed in range(10):
+        dist.add(np.random.RandomState(seed).exponential(size=1000))
+    (values, cdf) = dist.cdf_curve(50)
+    assert len(values) == 50
+    assert values[0] == dist.min and values[-1] == dist.max
+    assert cdf[0] == 0.0 and cdf[-1] == 1.0
+    assert (np.diff(cdf) >= 0).all()
+
+
+def strategy_trial(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    (groups, cover, true_qualities, reviews) = random_trial(12, 3, (random.randint, 1, 5))
+    truths = {j: 0.5 for j in groups}
+    visible = {j: 0.5 for j in cover}
+    (scores, qualities, (_, state)) = vancouver(reviews, visible, 10, full_output=True)
+    actual = (vancouver(reviews, truths, 10)[0], true_qualities)
+    return (reviews, truths, visible, (scores, qualities), actual, state)
+
+
+@pytest.mark.parametrize('priority', [random_priority, highest_variance, highest_grade_error, highest_variance_error])
+@pytest.mark.parametrize('per_round, resolve', [(None, False), (1, False), (2, True), (3, True)])
+def test_truth_strategy_rounds(priority, per_round, resolve):
+    (reviews, truths, visible, init, actual, state) = strategy_trial(1)
+    rounds = []
+
+    def counted(arrays):
+        rounds.append(arrays['visible'].sum())
+        return priority(arrays)
+
+    num_truths = len(visible) + 5
+    selected = TruthStrategy(counted, per_round, resolve).select(reviews, truths, visible, num_truths, 10, init,
+                                                                 actual, state)
+    assert len(selected) == num_truths
+    assert set(visible) <= set(selected) <= set(truths)
+    assert len(rounds) == (1 if per_round is None else -(-5 // per_round))
+    assert rounds[0] == len(visible)
+
+
+def test_truth_strategy_resolve_warm_starts(monkeypatch):
+    (reviews, truths, visible, init, actual, state) = strategy_trial(2)
+    states = []
+    vancouver_arrays = vancouver_simulations.vancouver_arrays
+
+    def recording(*args, **kwargs):
+        states.append(kwargs['state'])
+        return vancouver_arrays(*args, **kwargs)
+
+    monkeypatch.setattr(vancouver_simulations, 'vancouver_arrays', recording)
+    TruthStrategy(highest_variance, 1, resolve=True).select(reviews, truths, visible, len(visible) + 3, 10, init,
+                                                            actual, state)
+    # one re-solve between every two rounds, the first from the initial run
+    assert len(states) == 2
+    assert states[0] is state
+    assert states[1] is not state
+
+
+def test_truth_strategy_picks_by_priority():
+    (reviews, truths, visible, init, actual, state) = strategy_trial(3)
+    selected = TruthStrategy(highest_variance).select(reviews, truths, visible, len(visible) + 2, 10, init, actual)
+    hidden = sorted((j for j in init[0] if j not in visible), key=lambda j: -init[0][j][1])
+    assert set(selected) - set(visible) == set(hidden[:2])
+
+
+def test_truth_strategy_rejects_empty_rounds():
+    with pytest.raises(ValueError):
+        TruthStrategy(highest_variance, per_round=0)
@@ -1,126 +1,883 @@
+import hashlib
+import json
+import multiprocessing
+import time
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
 from peer_review_util import *
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 MIN_VARIANCE = 0.001    # don't let 1/variance blow up if a peer is very accurate.
 DEFAULT_VARIANCE = 1.0  # this does not matter as long as it is the same.
 
 
 
 # assign students in groups to k submissions.
-#    reviews:     {'peer name' => {'submission name' => score} 
+#    reviews:     {'peer name' => {'submission name' => score} or a ReviewGraph
 #    truth:       {'submission name'=> score}
 #    t:           number of iterations after which to quit.
+#    tol:         if given, quit early once no grade or variance changes
+#                 by more than tol in an iteration.
+#    state:       (ivar, jmean) from a previous run on the same reviews
+#                 to start from (instead of DEFAULT_VARIANCE).
+#    full_output: also return the iterations used and the final state.
+#    observer:    if given, called as observer(stats) after every iteration
+#                 (see iteration_stats()).
 # returns:
 #    (scores,qualities): ({submission=>(score,var)},{peer=>var})
-def simple_vancouver(reviews, truth, t):
+#    (scores,qualities,(iterations,state)) if full_output.
+def simple_vancouver(reviews, truth, t, tol=None, state=None, full_output=False, observer=None):
     # i: peers; j: submissions
+    (peers, submissions, ei, ej, r) = review_edges(reviews)
+    n = len(peers)
+    m = len(submissions)
 
-    # strip scores 
-    #   iassign[i] = submissions assigned to peer i
-    #   jassign[j] = peers assigned to review submission j
-    iassign = {i: review.keys() for (i, review) in reviews.items()}
-    jassign = invert_dictlist_dup(iassign)
-
-    peers = iassign.keys()
-    submissions = jassign.keys()
+    (tmask, tvals) = truth_arrays(submissions, truth)
 
     # ivar[i] and jvar[j] are 1/variance
-    jvar = {j: 1.0 / DEFAULT_VARIANCE for j in submissions}
-    jmean = {j: 0.0 for j in submissions}
-    ivar = {i: 1.0 / DEFAULT_VARIANCE for i in peers}
+    if state is None:
+        jvar = np.full(m, 1.0 / DEFAULT_VARIANCE)
+        jmean = np.zeros(m)
+        ivar = np.full(n, 1.0 / DEFAULT_VARIANCE)
+    else:
+        (ivar, jmean) = state
+        jvar = np.bincount(ej, ivar[ei], m)
+
+    iterations = 0
+    while iterations < t:
+        iterations += 1
+        (old_ivar, old_jmean) = (ivar, jmean)
+        if observer is not None:
+            laps = [time.time()]
 
-    for _ in range(t):
         # update score ivariances: jvar[j] = sum_i ivar[i]
         #    notes: ignores old ivar
-        jvar = {j: sum([ivar[i] for i in jassign[j]]) for j in submissions}
+        jvar = np.bincount(ej, ivar[ei], m)
+        if observer is not None:
+            laps.append(time.time())
 
-        # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]] 
-        jmean = {j: sum([reviews[i][j] * ivar[i] for i in jassign[j]]) / jvar[j] for j in submissions}
+        # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]]
+        jmean = np.bincount(ej, r * ivar[ei], m) / jvar
 
         # reset the truth.
-        jmean.update(truth)
+        jmean[tmask] = tvals[tmask]
+        if observer is not None:
+            laps.append(time.time())
 
         # update qualities: ivar[i] = (sum_j jvar[j]) / (sum_j jvar[j](reviews[i][j]-jmean[j]))
-        ivar = {i: min(1 / MIN_VARIANCE,
-                       sum([jvar[j] for j in iassign[i]]) / \
-                       sum([jvar[j] * (reviews[i][j] - jmean[j]) ** 2 for j in iassign[i]])) \
-                for i in peers}
+        ivar = capped_precision(np.bincount(ei, jvar[ej], n),
+                                np.bincount(ei, jvar[ej] * (r - jmean[ej]) ** 2, n))
+        if observer is not None:
+            laps.append(time.time())
+            observer(iteration_stats(iterations, laps, old_jmean, jmean, old_ivar, ivar))
+
+        if tol is not None and converged(old_jmean, jmean, old_ivar, ivar, tol):
+            break
 
-    scores = {j: (jmean[j], 1.0 / jvar[j]) for j in submissions}
-    quality = {i: 1.0 / ivar[i] for i in peers}
+    scores = dict(zip(submissions, zip(jmean.tolist(), (1.0 / jvar).tolist())))
+    quality = dict(zip(peers, (1.0 / ivar).tolist()))
 
+    if full_output:
+        return (scores, quality, (iterations, (ivar, jmean)))
     return (scores, quality)
 
 
+# flatten reviews into edge arrays (one entry per review).
+#    reviews:     {'peer name' => {'submission name' => score} or a ReviewGraph
+# returns:
+#    (peers, submissions, ei, ej, r):
+#       peers, submissions: lists of names; position is the index used below.
+#       ei[e], ej[e], r[e]: peer index, submission index and score of edge e.
+def review_edges(reviews):
+    if not isinstance(reviews, ReviewGraph):
+        reviews = review_graph(reviews)
+    return (reviews.peers, reviews.submissions, reviews.ei, reviews.ej, reviews.r)
+
+
+# look up the true scores of submissions.
+#    submissions: [submission names]
+#    truth:       {'submission name'=> score}
+#    dims:        shape of a score, () or (D,) for D rubric elements.
+#                 (a scalar true score applies to all D elements.)
+# returns:
+#    (tmask, tvals): tmask[j] is True if submission j has a true score,
+#    tvals[j] is that score.
+def truth_arrays(submissions, truth, dims=()):
+    tmask = np.array([j in truth for j in submissions], dtype=bool)
+    tvals = np.zeros((len(submissions),) + tuple(dims))
+    for (j, name) in enumerate(submissions):
+        if tmask[j]:
+            tvals[j] = truth[name]
+    return (tmask, tvals)
+
+
+# vancouver on edge arrays (see review_edges()).
+#    ei, ej, r:   peer index, submission index and score for each edge.
+#                 r is (E,), or (E, D) to solve D rubric elements at once.
+#    n, m:        number of peers and submissions.
+#    tmask:       tmask[j] is True if submission j has a true score.
+#    tvals:       tvals[j] is the true score of submission j (if tmask[j]).
+#    t:           number of iterations after which to quit.
+#    tol:         if given, quit early once no edge's grade or variance
+#                 changes by more than tol in an iteration, and warn
+#                 (RuntimeWarning) if that doesn't happen within t.  the
+#                 plain updates often cycle instead of settling, so tol
+#                 needs damping to be reached.
+#    state:       (ivars, jmeans) edge arrays to start from.
+#    pool:        with D rubric elements, estimate one quality per peer from
+#                 all elements (instead of one per element).
+#    observer:    if given, called as observer(stats) after every iteration
+#                 (see iteration_stats()).
+#    damping:     move the edge 1/variances only (1 - damping) of the way to
+#                 their update in each iteration.  this has the same fixed
+#                 points, but gets to them where the plain updates cycle
+#                 around one (e.g. with peers at the MIN_VARIANCE cap).
+#    backend:     'numba' (one compiled loop over the edges per phase, see
+#                 edge_iteration()) or 'numpy'; by default DEFAULT_BACKEND.
+#                 both give the same results, to the bit.  rubric elements
+#                 and observers (which time the phases) always use 'numpy'.
+# returns:
+#    (jmean, jvar, ivar, iterations, state): arrays of submission scores,
+#    submission variances and peer variances, the number of iterations run,
+#    and the (ivars, jmeans) edge arrays to warm start another run.
+# NOTES:
+#    - the leave-one-out sums "over all edges of j except i" are computed as
+#      the segment total of j minus the edge's own term.
+#    - the rubric elements share the graph.  they are solved as (D, E) arrays
+#      (edges on the last axis), so each element's sums are contiguous and
+#      pooled (E,) variances broadcast over the elements.
+def vancouver_arrays(ei, ej, r, n, m, tmask, tvals, t, tol=None, state=None, pool=False, observer=None,
+                     damping=0.0, backend=None):
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in ('numba', 'numpy'):
+        raise ValueError("unknown vancouver backend: %r" % (backend,))
+    if backend == 'numba' and _edge_kernel is None:
+        raise ImportError("the 'numba' vancouver backend needs numba (pip install numba)")
+    multi = r.ndim == 2
+    fused = backend == 'numba' and not multi and observer is None
+    pool = pool and multi
+    d = r.shape[1] if pool else 1
+    if multi:
+        (r, tvals) = (np.ascontiguousarray(r.T), tvals.T)
+
+    # per_edge(x): (D, E) terms summed over the elements into a pooled quantity.
+    def per_edge(x):
+        return x.sum(axis=0) if pool else x
+
+    # edges whose submission mean is pinned to the truth.
+    etruth = tmask[ej]
+    evals = tvals.take(ej[etruth], axis=-1)
+
+    # maintain ivar, jvar, jmean for each edge in assignment
+    # ivar and jvar are 1/variance!
+    if state is None:
+        shape = r.shape[-1:] if pool else r.shape
+        ivars = np.full(shape, 1.0 / DEFAULT_VARIANCE)
+        jvars = np.full(shape, 1.0 / DEFAULT_VARIANCE)
+        jmeans = np.ones(r.shape)
+    else:
+        (ivars, jmeans) = state
+        if multi:
+            (ivars, jmeans) = (ivars.T, np.ascontiguousarray(jmeans.T))
+        jvars = segment_sum(ej, ivars, m).take(ej, axis=-1) - ivars
+
+    # every iteration writes its edge arrays into one of two buffers (the
+    # other holds the previous iteration, for the tol check), never into state.
+    wr = np.empty(r.shape)
+    buffers = [(np.empty(ivars.shape), np.empty(r.shape)) for _ in range(2)]
+
+    iterations = 0
+    while iterations < t:
+        iterations += 1
+        (old_ivars, old_jmeans) = (ivars, jmeans)
+        (ivars, jmeans) = buffers[iterations % 2]
+        if fused:
+            _edge_kernel(ei, ej, r, n, m, tmask, tvals, old_ivars, damping, jvars, jmeans, ivars)
+            if tol is not None and converged(old_jmeans, jmeans, old_ivars, ivars, tol):
+                break
+            continue
+        if observer is not None:
+            laps = [time.time()]
+
+        # update score inverse variances for submissions
+        # (take() buffers out unless mode is set; the indices are all in range)
+        segment_sum(ej, old_ivars, m).take(ej, axis=-1, out=jvars, mode='clip')
+        jvars -= old_ivars
+        if observer is not None:
+            laps.append(time.time())
+
+        # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]]
+        np.multiply(r, old_ivars, out=wr)
+        segment_sum(ej, wr, m).take(ej, axis=-1, out=jmeans, mode='clip')
+        jmeans -= wr
+        jmeans /= jvars
+        jmeans[..., etruth] = evals
+        if observer is not None:
+            laps.append(time.time())
+
+        # update qualities: ivar[i] = (sum_j jvar[j]) / (sum_j jvar[j](reviews[i][j]-jmean[j]))
+        sq = per_edge(jvars * (r - jmeans) ** 2)
+        capped_precision(d * (segment_sum(ei, jvars, n).take(ei, axis=-1) - jvars),
+                         segment_sum(ei, sq, n).take(ei, axis=-1) - sq, out=ivars)
+        if damping:
+            ivars *= 1 - damping
+            ivars += damping * old_ivars
+        if observer is not None:
+            laps.append(time.time())
+            observer(iteration_stats(iterations, laps, old_jmeans, jmeans, old_ivars, ivars))
+
+        if tol is not None and converged(old_jmeans, jmeans, old_ivars, ivars, tol):
+            break
+    else:
+        if tol is not None:
+            warnings.warn("vancouver did not converge within t=%d iterations (tol=%g, damping=%g)" % (t, tol, damping),
+                          RuntimeWarning)
+
+    # update score ivariances: jvar[j] = sum_i ivar[i]
+    jvar = segment_sum(ej, ivars, m)
+
+    # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]]
+    jmean = segment_sum(ej, r * ivars, m) / jvar
+
+    # reset the truth.
+    jmean[..., tmask] = tvals[..., tmask]
+
+    # update qualities: ivar[i] = (sum_j jvar[j]) / (sum_j jvar[j](reviews[i][j]-jmean[j]))
+    ivar = capped_precision(d * segment_sum(ei, jvars, n),
+                            segment_sum(ei, per_edge(jvars * (r - jmeans) ** 2), n))
+
+    if multi:
+        return (jmean.T, (1.0 / jvar).T, (1.0 / ivar).T, iterations, (ivars.T, jmeans.T))
+    return (jmean, 1.0 / jvar, 1.0 / ivar, iterations, (ivars, jmeans))
+
+
+# sum edge values over the edges of each peer (idx = ei) or submission (idx = ej).
+#    values: (E,) array, or (D, E) for D rubric elements.
+#    size:   number of peers or submissions.
+# returns:
+#    (size,) or (D, size) array of sums.
+def segment_sum(idx, values, size):
+    if values.ndim == 1:
+        return np.bincount(idx, values, size)
+    return np.array([np.bincount(idx, v, size) for v in values])
+
+
+# one iteration of vancouver_arrays() (one rubric element, no pooling) as
+# loops over the edges, for numba to compile: three passes over the edges
+# and per peer/submission totals, instead of the edge-sized temporaries of
+# the numpy code.
+#    ei, ej, r, n, m, tmask, tvals, damping: as in vancouver_arrays().
+#    ivars:       edge 1/variances of the peers before the iteration.
+#    jvars, jmeans, new_ivars: edge arrays that get the results.
+# NOTES:
+#    - every value is computed with the same operations, in the same order,
+#      as the numpy code (totals summed in edge order, as np.bincount does,
+#      minus the edge's own term), so the two agree to the bit.
+def edge_iteration(ei, ej, r, n, m, tmask, tvals, ivars, damping, jvars, jmeans, new_ivars):
+    # submission totals of ivar and ivar * r
+    ivar_total = np.zeros(m)
+    wr_total = np.zeros(m)
+    for e in range(len(ej)):
+        j = ej[e]
+        ivar_total[j] += ivars[e]
+        wr_total[j] += r[e] * ivars[e]
+
+    # leave-one-out jvar and jmean of each edge, and peer totals of jvar
+    # and jvar * (r - jmean)^2
+    jvar_total = np.zeros(n)
+    sq_total = np.zeros(n)
+    for e in range(len(ej)):
+        j = ej[e]
+        jvars[e] = ivar_total[j] - ivars[e]
+        if tmask[j]:
+            jmeans[e] = tvals[j]
+        else:
+            jmeans[e] = (wr_total[j] - r[e] * ivars[e]) / jvars[e]
+        d = r[e] - jmeans[e]
+        jvar_total[ei[e]] += jvars[e]
+        sq_total[ei[e]] += jvars[e] * (d * d)
+
+    # leave-one-out ivar of each edge (as capped_precision())
+    cap = 1 / MIN_VARIANCE
+    for e in range(len(ei)):
+        i = ei[e]
+        d = r[e] - jmeans[e]
+        weight = jvar_total[i] - jvars[e]
+        sqerr = sq_total[i] - jvars[e] * (d * d)
+        if sqerr < 0.0:
+            sqerr = 0.0
+        if sqerr != 0.0:
+            precision = weight / sqerr
+        elif weight != 0.0:
+            precision = np.inf if weight > 0.0 else -np.inf
+        else:
+            precision = np.nan
+        if precision > cap:
+            precision = cap
+        if damping:
+            precision = damping * ivars[e] + (1 - damping) * precision
+        new_ivars[e] = precision
+
+
+# edge_iteration() compiled, if numba is installed.
+_edge_kernel = None if numba is None else numba.njit(cache=True, error_model='numpy')(edge_iteration)
+
+# the backend vancouver_arrays() uses by default.
+DEFAULT_BACKEND = 'numpy' if numba is None else 'numba'
+
+
+# 1/variance of a peer from weighted sums, capped at 1/MIN_VARIANCE.
+#    (a zero, or round-off negative, squared error means a perfect peer.)
+def capped_precision(weight, sqerr, out=None):
+    with np.errstate(divide='ignore'):
+        return np.minimum(1 / MIN_VARIANCE, weight / np.maximum(sqerr, 0.0), out=out)
+
+
+# true if neither the grades nor the variances (1/ivar) moved by more than tol.
+def converged(old_jmean, jmean, old_ivar, ivar, tol):
+    if len(jmean) and np.max(np.abs(jmean - old_jmean)) > tol:
+        return False
+    if len(ivar) and np.max(np.abs(1.0 / ivar - 1.0 / old_ivar)) > tol:
+        return False
+    return True
+
+
+# statistics of one iteration, as passed to an observer.
+#    iteration:   iteration number (from 1).
+#    laps:        time.time() at the start of the iteration and after the
+#                 jvar, jmean and ivar phases.
+#    old_jmean, jmean, old_ivar, ivar: grades and 1/variances before and
+#                 after the iteration (edge or node arrays).
+# returns:
+#    {field => value} for the fields in TRACE_FIELDS:
+#       time_jvar, time_jmean, time_ivar: seconds spent in each phase.
+#       grade_change_max/mean:    max/mean abs change of the grades.
+#       variance_change_max/mean: max/mean abs change of the variances.
+#       clamped:  number of 1/variances capped at 1/MIN_VARIANCE.
+#       memory:   bytes traced by tracemalloc, or None if it is not tracing.
+def iteration_stats(iteration, laps, old_jmean, jmean, old_ivar, ivar):
+    dgrade = np.abs(jmean - old_jmean)
+    dvar = np.abs(1.0 / ivar - 1.0 / old_ivar)
+    return {
+        'iteration': iteration,
+        'time_jvar': laps[1] - laps[0],
+        'time_jmean': laps[2] - laps[1],
+        'time_ivar': laps[3] - laps[2],
+        'grade_change_max': float(dgrade.max()) if dgrade.size else 0.0,
+        'grade_change_mean': float(dgrade.mean()) if dgrade.size else 0.0,
+        'variance_change_max': float(dvar.max()) if dvar.size else 0.0,
+        'variance_change_mean': float(dvar.mean()) if dvar.size else 0.0,
+        'clamped': int(np.count_nonzero(ivar >= 1 / MIN_VARIANCE)),
+        'memory': _traced_memory(),
+    }
+
+
+TRACE_FIELDS = ('iteration', 'time_jvar', 'time_jmean', 'time_ivar',
+                'grade_change_max', 'grade_change_mean',
+                'variance_change_max', 'variance_change_mean', 'clamped', 'memory')
+
+
+def _traced_memory():
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+# records the iteration_stats() of vancouver runs, e.g.
+#    trace = VancouverTrace()
+#    vancouver(reviews, truth, t, observer=trace)
+#    trace.arrays()['grade_change_max']
+#    records:     [stats], one per iteration, in order (several runs append
+#                 to the same trace; iteration restarts at 1).
+class VancouverTrace:
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, stats):
+        self.records.append(stats)
+
+    # {field => array over the iterations}; memory is nan when not traced.
+    def arrays(self):
+        out = {}
+        for field in TRACE_FIELDS:
+            values = [rec[field] for rec in self.records]
+            if field in ('iteration', 'clamped'):
+                out[field] = np.array(values, dtype=int)
+            else:
+                out[field] = np.array([np.nan if v is None else v for v in values], dtype=float)
+        return out
+
+    # write one JSON object per iteration to f (a file name or a file).
+    def write_jsonl(self, f):
+        if isinstance(f, str):
+            with open(f, 'w') as out:
+                return self.write_jsonl(out)
+        for rec in self.records:
+            f.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    def clear(self):
+        del self.records[:]
+
+
 # assign students in groups to k submissions.
-#    reviews:     {'peer name' => {'submission name' => score} 
+#    reviews:     {'peer name' => {'submission name' => score} or a ReviewGraph
 #    truth:       {'submission name'=> score}
 #    t:           number of iterations after which to quit.
+#    tol:         if given, quit early once no grade or variance changes
+#                 by more than tol in an iteration.
+#    state:       (ivars, jmeans) from a previous run on the same reviews
+#                 to start from (instead of DEFAULT_VARIANCE).
+#    full_output: also return the iterations used and the final state.
+#    pool_quality: with D rubric elements, one quality per peer for all
+#                 elements instead of one per element.
+#    observer:    if given, called as observer(stats) after every iteration
+#                 (see iteration_stats() and VancouverTrace).
+#    damping:     see vancouver_arrays().
+#    backend:     see vancouver_arrays().
 # returns:
 #    (scores,qualities): ({submission=>(score,var)},{peer=>var})
+#    (scores,qualities,(iterations,state)) if full_output.
+#    with D rubric elements (scores are length D sequences, or r is (E, D)),
+#    score and var are lists of D values; var and the peer var are single
+#    values if pool_quality.
 # PRECONDITIONS:
 #    - peers assigned to at least two submissions.
 #    - submissions assigned to at least two peers.
 # NOTES:
-#    - runs exactly t iterations.  does not stop if no improvements.
-def vancouver(reviews, truth, t):
+#    - runs exactly t iterations unless tol is given (see vancouver_arrays()).
+#    - state holds edge arrays in review_edges(reviews) order, so it can only
+#      be reused with the same reviews (truth may change, e.g. after adding
+#      ground truths).
+def vancouver(reviews, truth, t, tol=None, state=None, full_output=False, pool_quality=False, observer=None,
+              damping=0.0, backend=None):
+    states = None if state is None else [state]
+    return vancouver_batch([reviews], [truth], t, tol, states, full_output, pool_quality, observer, damping,
+                           backend)[0]
+
+
+# run vancouver on many independent review graphs in one pass.
+#    reviews_list: [reviews], each as in vancouver()
+#    truth_list:   [truth], one for each reviews
+#    t, tol:       as in vancouver(); tol applies to all graphs together.
+#    states:       [state], one for each reviews, as in vancouver()
+#    full_output, pool_quality, observer, damping, backend: as in
+#                 vancouver(); the observer sees the iterations of the whole
+#                 batch.
+# returns:
+#    [(scores,qualities)], one for each reviews (as in vancouver())
+# NOTES:
+#    - the graphs are stacked block-diagonally (peer and submission indices
+#      are offset per graph), so one vancouver_arrays() call solves them all.
+#    - names only need to be unique within a graph.
+def vancouver_batch(reviews_list, truth_list, t, tol=None, states=None, full_output=False, pool_quality=False,
+                    observer=None, damping=0.0, backend=None):
     # i: peers; j: submissions
+    blocks = [review_edges(reviews) for reviews in reviews_list]
+
+    # offsets of each graph's peers, submissions and edges in the stacked arrays
+    noff = np.cumsum([0] + [len(peers) for (peers, _, _, _, _) in blocks])
+    moff = np.cumsum([0] + [len(submissions) for (_, submissions, _, _, _) in blocks])
+    eoff = np.cumsum([0] + [len(r) for (_, _, _, _, r) in blocks])
+    n = noff[-1]
+    m = moff[-1]
 
-    # strip scores 
-    #   iassign[i] = submissions assigned to peer i
-    #   jassign[j] = peers assigned to review submission j
-    iassign = {i: review.keys() for (i, review) in reviews.items()}
-    jassign = invert_dictlist_dup(iassign)
+    ei = np.concatenate([b[2] + noff[g] for (g, b) in enumerate(blocks)])
+    ej = np.concatenate([b[3] + moff[g] for (g, b) in enumerate(blocks)])
+    r = np.concatenate([b[4] for b in blocks])
 
     # make sure preconditions are met
-    kmin = min(len(subs) for (i, subs) in iassign.items())
+    kmin = np.bincount(ei, minlength=n).min()
     assert kmin >= 2, "Vancouver needs at least two submissions per peer!"
-    lmin = min(len(peers) for (j, peers) in jassign.items())
+    lmin = np.bincount(ej, minlength=m).min()
     assert lmin >= 2, "Vancouver needs at least two peers per submission!"
 
-    peers = iassign.keys()
-    submissions = jassign.keys()
+    truths = [truth_arrays(submissions, truth, r.shape[1:])
+              for ((_, submissions, _, _, _), truth) in zip(blocks, truth_list)]
+    tmask = np.concatenate([tm for (tm, _) in truths])
+    tvals = np.concatenate([tv for (_, tv) in truths])
 
-    # maintain ivar, jvar, jmean for each edge in assignment
-    # ivar and jvar are 1/variance!
-    ivars = {i: {j: 1.0 / DEFAULT_VARIANCE for j in iassign[i]} for i in peers}
-    jvars = {i: {j: 1.0 / DEFAULT_VARIANCE for j in iassign[i]} for i in peers}
-    # jmean = {i: {j: avg([reviews[ii][j] for ii in jassign[j] if ii != i]) for j in iassign[i]} for i in peers}
-    jmeans = {i: {j: 1.0 for j in iassign[i]} for i in peers}
+    state = None
+    if states is not None:
+        state = (np.concatenate([s[0] for s in states]), np.concatenate([s[1] for s in states]))
 
-    for _ in range(t):
-        # update score inverse variances for submissions
-        jvars = {i: {j: sum([ivars[ii][j] for ii in jassign[j] if ii != i]) for j in iassign[i]} for i in peers}
+    (jmean, jvar, ivar, iterations, (ivars, jmeans)) = \
+        vancouver_arrays(ei, ej, r, n, m, tmask, tvals, t, tol, state, pool_quality, observer, damping, backend)
 
-        # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]] 
-        jmeans = {i: {j: truth[j] if j in truth \
-            else sum([reviews[ii][j] * ivars[ii][j] for ii in jassign[j] if ii != i]) / jvars[i][j] \
-                      for j in iassign[i]} \
-                  for i in peers}
+    results = []
+    for (g, (peers, submissions, _, _, _)) in enumerate(blocks):
+        js = slice(moff[g], moff[g + 1])
+        scores = dict(zip(submissions, zip(jmean[js].tolist(), jvar[js].tolist())))
+        quality = dict(zip(peers, ivar[noff[g]:noff[g + 1]].tolist()))
+        if full_output:
+            es = slice(eoff[g], eoff[g + 1])
+            results.append((scores, quality, (iterations, (ivars[es], jmeans[es]))))
+        else:
+            results.append((scores, quality))
 
-        # update qualities: ivar[i] = (sum_j jvar[j]) / (sum_j jvar[j](reviews[i][j]-jmean[j]))
-        ivars = {i: {j: min(1 / MIN_VARIANCE,
-                            sum([jvars[i][jj] for jj in iassign[i] if jj != j]) / \
-                            sum([jvars[i][jj] * (reviews[i][jj] - jmeans[i][jj]) ** 2 for jj in iassign[i] if jj != j])) \
-                     for j in iassign[i]}
-                 for i in peers}
+    return results
 
-    # update score ivariances: jvar[j] = sum_i ivar[i]
-    #    notes: ignores old ivar
-    jvar = {j: sum([ivars[i][j] for i in jassign[j]]) for j in submissions}
 
-    # update score mean: jmean[j] = (sum_i reviews[i,j] ivar[i]) / jvar[j]] 
-    jmean = {j: sum([reviews[i][j] * ivars[i][j] for i in jassign[j]]) / jvar[j] for j in submissions}
+# content address of a vancouver(reviews, truth, t, tol) solve: the same graph
+# (names, edges and scores), truth, steps and tol always give the same key.
+def solve_key(reviews, truth, t, tol=None):
+    (peers, submissions, ei, ej, r) = review_edges(reviews)
+    h = hashlib.sha1()
+    if tol is None:
+        h.update(repr((peers, submissions, r.shape, t)).encode('utf-8'))
+    else:
+        h.update(repr((peers, submissions, r.shape, t, tol)).encode('utf-8'))
+    for a in (ei, ej, r):
+        h.update(np.ascontiguousarray(a).tobytes())
+    h.update(repr(sorted((repr(j), repr(truth[j])) for j in truth)).encode('utf-8'))
+    return h.hexdigest()
 
-    # reset the truth.
-    jmean.update(truth)
 
-    # update qualities: ivar[i] = (sum_j jvar[j]) / (sum_j jvar[j](reviews[i][j]-jmean[j]))
-    ivar = {i: min(1 / MIN_VARIANCE,
-                   sum([jvars[i][j] for j in iassign[i]]) / \
-                   sum([jvars[i][j] * (reviews[i][j] - jmeans[i][j]) ** 2 for j in iassign[i]])) \
-            for i in peers}
+# memoizes vancouver() solves by solve_key(), keeping the maxsize most
+# recently used.
+#    maxsize:     number of solves to keep.
+#    hits, misses: counts of lookups.
+# NOTES:
+#    - hits return the cached dicts themselves; don't modify them.
+#    - batch() caches each solve as vancouver(full_output=True) returns it,
+#      and get() returns a solve as it was cached (the scores and qualities
+#      are its first two entries either way).
+class SolveCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-    scores = {j: (jmean[j], 1.0 / jvar[j]) for j in submissions}
-    quality = {i: 1.0 / ivar[i] for i in peers}
+    # same as vancouver_batch(reviews_list, truth_list, t, full_output=...),
+    # solving only the solves that are not cached (in one batch).  the solves
+    # are cached with their final state, so full_output hits need no solve
+    # either (except for solves put() without one).
+    def batch(self, reviews_list, truth_list, t, full_output=False):
+        keys = [solve_key(reviews, truth, t) for (reviews, truth) in zip(reviews_list, truth_list)]
 
-    return (scores, quality)
+        found = {}
+        missing = []
+        for (g, key) in enumerate(keys):
+            if key in found:
+                self.hits += 1
+            elif key in self.results and (len(self.results[key]) == 3 or not full_output):
+                self.hits += 1
+                found[key] = self.results.pop(key)
+            else:
+                self.misses += 1
+                found[key] = None
+                missing.append(g)
+        if missing:
+            results = vancouver_batch([reviews_list[g] for g in missing], [truth_list[g] for g in missing], t,
+                                      full_output=True)
+            for (g, (scores, quality, (iterations, (ivars, jmeans)))) in zip(missing, results):
+                # (copies, so the cache doesn't hold on to the arrays of the whole batch)
+                found[keys[g]] = (scores, quality, (iterations, (ivars.copy(), jmeans.copy())))
+
+        # (re)insert as most recently used, evicting the least recently used
+        for key in found:
+            self.results[key] = found[key]
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+        if full_output:
+            return [found[key] for key in keys]
+        return [found[key][:2] for key in keys]
+
+    # the cached solve of key (now the most recently used), or None.
+    def get(self, key):
+        result = self.results.pop(key, None)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results[key] = result
+        return result
+
+    def put(self, key, result):
+        self.results[key] = result
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+
+
+# vancouver on each connected component of the review graph on its own.
+# the updates never cross components, so with tol=None this gives the same
+# scores as vancouver(), and components can be solved (or skipped) apart.
+#    reviews, truth, t: as in vancouver()
+#    tol:         as in vancouver(), but each component stops on its own.
+#    max_workers: number of processes to solve the components in (None: one
+#                 per cpu; 1: in this process).
+#    cache:       SolveCache; components whose reviews and truth did not
+#                 change since they were solved are not solved again.
+# returns:
+#    (scores,qualities,invalid): scores and qualities as in vancouver(), for
+#    the peers and submissions of the valid components; invalid is
+#    [(peers, submissions)], the names in each component that violates the
+#    preconditions of vancouver() (these are not solved).
+def vancouver_components(reviews, truth, t, tol=None, max_workers=1, cache=None):
+    graph = reviews if isinstance(reviews, ReviewGraph) else review_graph(reviews)
+    solves = []
+    invalid = []
+    for g in component_graphs(graph):
+        if not satisfies_preconditions(g):
+            invalid.append((g.peers, g.submissions))
+            continue
+        gtruth = dict((j, truth[j]) for j in g.submissions if j in truth)
+        key = None if cache is None else solve_key(g, gtruth, t, tol)
+        result = None if cache is None else cache.get(key)
+        solves.append([g, gtruth, key, result])
+
+    todo = [s for s in solves if s[3] is None]
+    units = [(g, gtruth, t, tol) for (g, gtruth, _, _) in todo]
+    if max_workers == 1 or len(units) < 2:
+        results = map(_solve_component, units)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_solve_component, units,
+                                        chunksize=max(1, len(units) // (4 * max_workers))))
+    for (s, result) in zip(todo, results):
+        s[3] = result
+        if cache is not None:
+            cache.put(s[2], result)
+
+    scores = {}
+    quality = {}
+    for (_, _, _, result) in solves:
+        (gscores, gquality) = result[:2]
+        scores.update(gscores)
+        quality.update(gquality)
+    return (scores, quality, invalid)
+
+
+# true if every peer reviewed, and every submission was reviewed by, at
+# least two (as vancouver() needs).
+def satisfies_preconditions(graph):
+    return (np.bincount(graph.ei, minlength=len(graph.peers)).min(initial=2) >= 2 and
+            np.bincount(graph.ej, minlength=len(graph.submissions)).min(initial=2) >= 2)
+
+
+def _solve_component(unit):
+    (graph, truth, t, tol) = unit
+    return vancouver(graph, truth, t, tol)
+
+
+# vancouver that absorbs reviews as they come in, updating only the part of
+# the graph they affect.
+#    reviews:     initial reviews, as in vancouver() (or None).
+#    truth:       initial {'submission name'=> score} (or None).
+#    tol:         a node's neighbours are only updated again if one of its
+#                 edge grades or variances moved by more than tol.
+#    t:           max number of iterations per change.
+#    damping:     as in vancouver_arrays().
+#    updates:     number of node updates done by the last change.
+#    converged:   False if the last change stopped at t iterations with
+#                 nodes still moving (a RuntimeWarning says so too).
+# NOTES:
+#    - keeps the per-edge state of vancouver_arrays() (ivar, jvar, jmean of
+#      every review) in {peer => {submission => edge}} and
+#      {submission => {peer => edge}} maps, and runs its updates on the
+#      dirty peers and submissions only, until nothing moves by more than
+#      tol.  an iteration is one of vancouver_arrays() (the same damping,
+#      after the same capping) on those nodes, so where vancouver(reviews,
+#      truth, t, tol, damping=damping) converges, the results match it
+#      (to about 50 tol), not vancouver() with a small t.
+#    - a peer whose grades did not change since its last (damped) move gets
+#      the rest of the way to its update at once, instead of closing half
+#      the gap again in every iteration: repeated damped moves with the
+#      same inputs end up there anyway.
+#    - vancouver() need not converge, with damping or not (large classes
+#      often don't), and then neither does this.
+#    - the preconditions of vancouver() need not hold while reviews come
+#      in: a review with no other review of its submission has no weight in
+#      its peer's quality, and a peer with no other reviews has
+#      DEFAULT_VARIANCE.
+class VancouverState:
+    # edge fields
+    R, IVAR, JVAR, JMEAN = range(4)
+
+    def __init__(self, reviews=None, truth=None, tol=1e-6, t=1000, damping=0.5):
+        self.tol = tol
+        self.t = t
+        self.damping = damping
+        self.peer_edges = {}
+        self.submission_edges = {}
+        self.truth = {}
+        self.updates = 0
+        self.converged = True
+        self.dirty_peers = set()
+        self.dirty_submissions = set()
+        # peers whose last damped move left them more than tol short of the
+        # update of their edges
+        self.settling_peers = set()
+        if reviews is not None:
+            (peers, submissions, ei, ej, r) = review_edges(reviews)
+            for (i, j, score) in zip(ei.tolist(), ej.tolist(), r.tolist()):
+                self._add(peers[i], submissions[j], score)
+        if truth is not None:
+            for j in truth:
+                self._set_truth(j, truth[j])
+        self.update()
+
+    # add (or change) the score peer gave submission.
+    def add_review(self, peer, submission, score):
+        self._add(peer, submission, float(score))
+        self.update()
+
+    def remove_review(self, peer, submission):
+        del self.peer_edges[peer][submission]
+        del self.submission_edges[submission][peer]
+        for (name, edges, dirty) in ((peer, self.peer_edges, self.dirty_peers),
+                                     (submission, self.submission_edges, self.dirty_submissions)):
+            if edges[name]:
+                dirty.add(name)
+            else:
+                del edges[name]
+                dirty.discard(name)
+        if peer not in self.peer_edges:
+            self.settling_peers.discard(peer)
+        self.update()
+
+    # fix the grade of submission to its true score.
+    def add_truth(self, submission, score):
+        self._set_truth(submission, float(score))
+        self.update()
+
+    # returns:
+    #    (score, var) of submission, as in vancouver().
+    def score(self, submission):
+        edges = self.submission_edges[submission].values()
+        jvar = sum(e[self.IVAR] for e in edges)
+        if submission in self.truth:
+            return (self.truth[submission], 1.0 / jvar)
+        return (sum(e[self.R] * e[self.IVAR] for e in edges) / jvar, 1.0 / jvar)
+
+    # returns:
+    #    var of peer, as in vancouver().
+    def quality(self, peer):
+        edges = self.peer_edges[peer].values()
+        weight = sum(e[self.JVAR] for e in edges)
+        sqerr = sum(e[self.JVAR] * (e[self.R] - e[self.JMEAN]) ** 2 for e in edges)
+        return 1.0 / _capped_precision(weight, sqerr)
+
+    # returns:
+    #    (scores,qualities): ({submission=>(score,var)},{peer=>var}), as in vancouver().
+    def results(self):
+        scores = dict((j, self.score(j)) for j in self.submission_edges)
+        quality = dict((i, self.quality(i)) for i in self.peer_edges)
+        return (scores, quality)
+
+    # update the dirty submissions, then the dirty peers (as one iteration
+    # of vancouver_arrays() does), until nothing moves by more than tol.
+    # returns:
+    #    True if it converged within t iterations (see converged).
+    def update(self):
+        self.updates = 0
+        rounds = 0
+        while self.dirty_submissions or self.dirty_peers or self.settling_peers:
+            if rounds == self.t:
+                self.converged = False
+                warnings.warn("VancouverState did not converge within t=%d iterations (tol=%g)" % (self.t, self.tol),
+                              RuntimeWarning)
+                return False
+            rounds += 1
+            (submissions, self.dirty_submissions) = (self.dirty_submissions, set())
+            for j in submissions:
+                self._update_submission(j)
+            (peers, self.dirty_peers) = (self.dirty_peers, set())
+            (settling, self.settling_peers) = (self.settling_peers - peers, set())
+            for i in peers:
+                self._update_peer(i, self.damping)
+            for i in settling:
+                self._update_peer(i, 0.0)
+            self.updates += len(submissions) + len(peers) + len(settling)
+        self.converged = True
+        return True
+
+    def _add(self, peer, submission, score):
+        edge = self.peer_edges.get(peer, {}).get(submission)
+        if edge is None:
+            # start from the peer's current quality
+            ivar = 1.0 / self.quality(peer) if peer in self.peer_edges else 1.0 / DEFAULT_VARIANCE
+            edge = [score, ivar, 0.0, 0.0]
+            self.peer_edges.setdefault(peer, {})[submission] = edge
+            self.submission_edges.setdefault(submission, {})[peer] = edge
+        edge[self.R] = score
+        self.dirty_submissions.add(submission)
+        self.dirty_peers.add(peer)
+
+    def _set_truth(self, submission, score):
+        self.truth[submission] = score
+        if submission in self.submission_edges:
+            self.dirty_submissions.add(submission)
+
+    # jvar and jmean of each review of submission from the other reviews.
+    def _update_submission(self, submission):
+        (R, IVAR, JVAR, JMEAN) = (self.R, self.IVAR, self.JVAR, self.JMEAN)
+        edges = self.submission_edges[submission]
+        total = sum(e[IVAR] for e in edges.values())
+        wtotal = sum(e[R] * e[IVAR] for e in edges.values())
+        truth = self.truth.get(submission)
+        for (peer, e) in edges.items():
+            jvar = total - e[IVAR]
+            if truth is not None:
+                jmean = truth
+            elif jvar > 0:
+                jmean = (wtotal - e[R] * e[IVAR]) / jvar
+            else:
+                jmean = 0.0
+            if abs(jmean - e[JMEAN]) > self.tol or _moved(e[JVAR], jvar, self.tol):
+                self.dirty_peers.add(peer)
+            (e[JVAR], e[JMEAN]) = (jvar, jmean)
+
+    # ivar of each review of peer from the peer's other reviews, damped
+    # (capped first, then damped, as in vancouver_arrays()).
+    def _update_peer(self, peer, damping):
+        (R, IVAR, JVAR, JMEAN) = (self.R, self.IVAR, self.JVAR, self.JMEAN)
+        edges = self.peer_edges[peer]
+        sq = dict((j, e[JVAR] * (e[R] - e[JMEAN]) ** 2) for (j, e) in edges.items())
+        total = sum(e[JVAR] for e in edges.values())
+        sqtotal = sum(sq.values())
+        for (submission, e) in edges.items():
+            target = _capped_precision(total - e[JVAR], sqtotal - sq[submission])
+            ivar = damping * e[IVAR] + (1 - damping) * target if damping else target
+            if _moved(e[IVAR], ivar, self.tol):
+                self.dirty_submissions.add(submission)
+            if _moved(ivar, target, self.tol):
+                self.settling_peers.add(peer)
+            e[IVAR] = ivar
+
+
+# scalar capped_precision(); DEFAULT_VARIANCE without any weight.
+def _capped_precision(weight, sqerr):
+    if weight <= 0:
+        return 1.0 / DEFAULT_VARIANCE
+    if sqerr <= 0:
+        return 1.0 / MIN_VARIANCE
+    return min(1.0 / MIN_VARIANCE, weight / sqerr)
+
+
+# true if the variances 1/old and 1/new (inf for 0) differ by more than tol.
+def _moved(old, new, tol):
+    if old == new:
+        return False
+    if old <= 0 or new <= 0:
+        return True
+    return abs(1.0 / new - 1.0 / old) > tol
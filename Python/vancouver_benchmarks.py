@@ -0,0 +1,343 @@
+"""
+Benchmarks of the peer assignment, review generation and Vancouver code, as scaling curves over the number of
+students, the number of reviews per student (k) and the number of iterations.
+
+Run as a script, e.g.
+
+    python vancouver_benchmarks.py --out results.json
+    python vancouver_benchmarks.py --baseline results.json
+    python vancouver_benchmarks.py --matlab-grid 5 3 --bench vancouver simple_vancouver
+
+The results are JSON (one record per benchmark and grid point, with the best of a few timed runs and the peak memory
+of a separate traced run). With --baseline, every point that is also in the baseline is compared with it, and the exit
+status is 1 if any got slower by more than --threshold.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from peer_review import peer_assignment, peer_assignment_return_cover, random_reviews
+from peer_review_util import ReviewGraph
+from vancouver import vancouver, simple_vancouver, DEFAULT_BACKEND
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STUDENTS = (100, 1000, 10000, 100000)
+REVIEWS = (3, 5)
+ITERATIONS = (10, 20)
+GROUP_SIZE = 3
+
+
+def random_groups(num_students, group_size=GROUP_SIZE):
+    """
+    Groups students into submissions of group_size students, as in vancouver_simulations.random_trial.
+
+    :return a dictionary from submission to the list of its students
+    """
+    num_groups = int(math.ceil(num_students / float(group_size)))
+    return {'g%d' % g: ['s%d' % s for s in range(g * group_size, min((g + 1) * group_size, num_students))]
+            for g in range(num_groups)}
+
+
+def regular_graph(num_students, k, l):
+    """
+    A review graph in which every student reviews k submissions and every submission gets (about) l reviews, for
+    num_students * k / l submissions (as runVancouver.m with n, k and l given). Student i reviews the k submissions
+    after floor(i * m / n), under a random relabeling of the submissions.
+
+    :return a ReviewGraph without scores
+    """
+    m = max(k, int(round(num_students * k / float(l))))
+    ei = np.repeat(np.arange(num_students), k)
+    ej = (np.repeat(np.arange(num_students) * m // num_students, k) + np.tile(np.arange(k), num_students)) % m
+    ej = np.random.permutation(m)[ej]
+    return ReviewGraph(['s%d' % i for i in range(num_students)], ['a%d' % j for j in range(m)], ei, ej)
+
+
+def scored_graph(num_students, k, l):
+    graph = regular_graph(num_students, k, l)
+    qualities = {p: random.randint(1, 5) for p in graph.peers}
+    return random_reviews(graph, qualities)
+
+
+def load_master():
+    """
+    Loads "Vancouver from Master.py" (the reference implementation).
+    """
+    path = os.path.join(HERE, 'Vancouver from Master.py')
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('vancouver_from_master', path)
+    spec = importlib.util.spec_from_file_location('vancouver_from_master', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_lib():
+    """
+    Loads peer_review_lib.
+    """
+    import peer_review_lib
+    return peer_review_lib
+
+
+# each benchmark is a function of (students, k, l, iterations) that does the untimed setup and returns the function
+# to time; in BENCHMARKS, uses_iterations says whether the iterations are a dimension of its grid (if not, they are
+# None).
+
+def bench_peer_assignment(n, k, l, t):
+    groups = random_groups(n, max(1, l // k))
+    return lambda: peer_assignment(groups, k)
+
+
+def bench_peer_assignment_return_cover(n, k, l, t):
+    groups = random_groups(n, max(1, l // k))
+    return lambda: peer_assignment_return_cover(groups, k)
+
+
+def bench_peer_assignment_lib(n, k, l, t):
+    lib = load_lib()
+    peers = ['s%d' % i for i in range(n)]
+    submissions = ['a%d' % j for j in range(max(k, int(round(n * k / float(l)))))]
+    return lambda: lib.peer_assignment(peers, submissions, k)
+
+
+def bench_random_reviews(n, k, l, t):
+    graph = regular_graph(n, k, l)
+    qualities = {p: random.randint(1, 5) for p in graph.peers}
+    return lambda: random_reviews(graph, qualities)
+
+
+def bench_vancouver(n, k, l, t):
+    reviews = scored_graph(n, k, l)
+    truth = {j: 0.5 for j in reviews.submissions[:max(1, len(reviews.submissions) // 10)]}
+    return lambda: vancouver(reviews, truth, t)
+
+
+def bench_simple_vancouver(n, k, l, t):
+    reviews = scored_graph(n, k, l)
+    truth = {j: 0.5 for j in reviews.submissions[:max(1, len(reviews.submissions) // 10)]}
+    return lambda: simple_vancouver(reviews, truth, t)
+
+
+def bench_evaluate_items(n, k, l, t):
+    master = load_master()
+    reviews = scored_graph(n, k, l)
+    graph = master.Graph()
+    for (i, j, score) in zip(reviews.ei.tolist(), reviews.ej.tolist(), reviews.r.tolist()):
+        graph.add_review(reviews.peers[i], reviews.submissions[j], score)
+    return lambda: graph.evaluate_items(t)
+
+
+# name => (benchmark, uses_iterations)
+BENCHMARKS = {
+    'peer_assignment': (bench_peer_assignment, False),
+    'peer_assignment_return_cover': (bench_peer_assignment_return_cover, False),
+    'peer_assignment_lib': (bench_peer_assignment_lib, False),
+    'random_reviews': (bench_random_reviews, False),
+    'vancouver': (bench_vancouver, True),
+    'simple_vancouver': (bench_simple_vancouver, True),
+    'evaluate_items': (bench_evaluate_items, True),
+}
+
+
+def peak_memory(func):
+    """
+    Runs func once, tracing allocations (Python objects and numpy arrays).
+
+    :return the peak of traced memory in MB, or None without tracemalloc (Python 2)
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss():
+    """
+    :return the peak resident set size of this process in MB (it only ever grows), or None
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+
+def run_point(name, n, k, l, t, repeat, seed):
+    """
+    Times one benchmark at one grid point.
+
+    :return a result record (a dictionary)
+    """
+    record = {'bench': name, 'students': n, 'k': k, 'l': l, 'iterations': t}
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        func = BENCHMARKS[name][0](n, k, l, t)
+    except (ImportError, SyntaxError) as e:
+        record.update(status='skipped', note='cannot load: %s' % e)
+        return record
+
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    record.update(status='ok', seconds=min(times), times=times, peak_mb=peak_memory(func), max_rss_mb=max_rss())
+    return record
+
+
+def grid(students, reviews, iterations, l):
+    """
+    :return the (students, k, l, iterations) grid points, smallest first; l is GROUP_SIZE * k unless given
+    """
+    return [(n, k, l if l else GROUP_SIZE * k, t) for k in reviews for t in iterations for n in sorted(students)]
+
+
+def run_benchmarks(names, points, repeat=3, seed=0, max_seconds=30.0, log=None):
+    """
+    Runs the benchmarks over the grid. Once a benchmark takes more than max_seconds at some point, its larger points
+    (with the same k, l and iterations) are skipped.
+
+    :return a list of result records
+    """
+    results = []
+    for name in names:
+        uses_iterations = BENCHMARKS[name][1]
+        too_slow = set()
+        done = set()
+        for (n, k, l, t) in points:
+            if not uses_iterations:
+                t = None
+            if (n, k, l, t) in done:
+                continue
+            done.add((n, k, l, t))
+            if (k, l, t) in too_slow:
+                record = {'bench': name, 'students': n, 'k': k, 'l': l, 'iterations': t, 'status': 'skipped',
+                          'note': 'a smaller size took more than %g s' % max_seconds}
+            else:
+                record = run_point(name, n, k, l, t, repeat, seed)
+                if record.get('seconds', 0) > max_seconds:
+                    too_slow.add((k, l, t))
+            if log:
+                log(record)
+            results.append(record)
+    return results
+
+
+def result_key(record):
+    return (record['bench'], record['students'], record['k'], record['l'], record['iterations'])
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Compares the timed points with the same points of a baseline.
+
+    :param threshold: the relative slowdown that counts as a regression
+    :return a list of (record, baseline seconds, ratio, regressed) for the points in both
+    """
+    base = {result_key(r): r for r in baseline['results'] if r.get('status') == 'ok'}
+    comparison = []
+    for record in results:
+        old = base.get(result_key(record))
+        if record.get('status') != 'ok' or old is None:
+            continue
+        ratio = record['seconds'] / max(old['seconds'], 1e-9)
+        comparison.append((record, old['seconds'], ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'machine': platform.machine(), 'vancouver_backend': DEFAULT_BACKEND,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def format_record(record):
+    point = '%-28s n=%-7d k=%-2d l=%-3d t=%-4s' % (record['bench'], record['students'], record['k'], record['l'],
+                                                 record['iterations'] if record['iterations'] is not None else '-')
+    if record['status'] != 'ok':
+        return point + ' skipped (%s)' % record['note']
+    peak = '%.1f MB' % record['peak_mb'] if record['peak_mb'] is not None else '-'
+    return point + ' %10.4f s  peak %s' % (record['seconds'], peak)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of peer assignment, review generation and Vancouver.')
+    parser.add_argument('--bench', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--students', nargs='+', type=int, default=list(STUDENTS))
+    parser.add_argument('--k', nargs='+', type=int, default=list(REVIEWS), help='reviews per student')
+    parser.add_argument('--l', type=int, default=None,
+                        help='reviews per submission (default: %d k, groups of %d)' % (GROUP_SIZE, GROUP_SIZE))
+    parser.add_argument('--iterations', nargs='+', type=int, default=list(ITERATIONS))
+    parser.add_argument('--matlab-grid', nargs=2, type=int, metavar=('L', 'K'),
+                        help='the grid of Matlab/main.m instead: students in L:L:500, with degrees L and K')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per point (the best counts)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-seconds', type=float, default=30.0,
+                        help='skip larger sizes of a benchmark once it takes longer than this')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown reported as a regression (default: 0.25)')
+    args = parser.parse_args(argv)
+
+    if args.matlab_grid:
+        (l, k) = args.matlab_grid
+        points = grid(range(l, 501, l), [k], args.iterations, l)
+    else:
+        points = grid(args.students, args.k, args.iterations, args.l)
+
+    results = run_benchmarks(args.bench, points, args.repeat, args.seed, args.max_seconds,
+                             log=lambda record: print(format_record(record)))
+    document = {'environment': environment(), 'arguments': vars(args), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(document, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare(results, baseline, args.threshold)
+        print('\ncompared with %s (%s, python %s):' % (args.baseline, baseline['environment']['date'],
+                                                      baseline['environment']['python']))
+        for (record, old, ratio, regressed) in comparison:
+            print('%s  was %10.4f s  x%.2f%s' % (format_record(record), old, ratio, '  REGRESSION' if regressed else ''))
+        if any(regressed for (_, _, _, regressed) in comparison):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,17 +2,140 @@
 This file is for code that can be used to run simulations of Vancouver.
 """
 
+from __future__ import print_function
+
+import hashlib
+import multiprocessing
+
 from peer_review import *
+from peer_review_util import ReviewGraph
+from results_store import result_key
+from vancouver import vancouver, vancouver_arrays, vancouver_batch, review_edges, SolveCache
 import numpy as np
 import matplotlib.pyplot as plt
 
 
 stat_ids = {'Submission Grade Error': 0, 'Submission Variance Error': 1, 'User Variance Error': 2}
 
+# the initial (cover truth) and omniscient solves of a graph don't depend on num_truths, so sweeps over the same graphs
+# look them up here instead of solving them again
+solve_cache = SolveCache(maxsize=4096)
+
+
+def random_submission(truths, init, actual):
+    """
+    The default grading algorithm: picks a random submission to see the ground truth of.
+
+    :param truths: a dictionary from every submission to its ground truth
+    :param init: a tuple of (qualities, scores) from the initial Vancouver run
+    :param actual: a tuple of (omniscient scores, true qualities)
+    """
+    return random.choice(list(truths))
+
+
+class TruthStrategy:
+    """
+    A ground-truth selection strategy that ranks all submissions at once, in rounds: each round picks the per_round
+    submissions of highest priority (with argpartition) that are not visible yet, and can re-solve Vancouver with the
+    new truths before the next round. Pass it as the grading_algorithm of evaluate_vancouver (or the plot functions).
+
+    :param priority: a function of a dictionary of arrays over the submissions of the trial (in the order of
+    reviews.submissions) that returns one priority per submission; the arrays are 'grades' and 'variances' (the current
+    estimates), 'omni_grades' and 'omni_variances' (the omniscient run), 'truths' and 'visible' (a boolean mask)
+    :param per_round: the number of truths picked per round (at least 1, or None for all in one round)
+    :param resolve: re-solve Vancouver after each round, warm-started from the previous solve (the first from the initial
+    run; otherwise every round ranks the initial estimates)
+    :param steps: the number of Vancouver iterations per re-solve (by default, the vancouver_steps of the evaluation)
+    """
+    def __init__(self, priority, per_round=None, resolve=False, steps=None):
+        if per_round is not None and per_round < 1:
+            raise ValueError('a TruthStrategy needs to pick at least one truth per round, not %r' % (per_round,))
+        self.priority = priority
+        self.per_round = per_round
+        self.resolve = resolve
+        self.steps = steps
+
+    def __repr__(self):
+        # also what result_key sees, so it must be the same in every run
+        return 'TruthStrategy(%s.%s, per_round=%r, resolve=%r, steps=%r)' % (
+            self.priority.__module__, self.priority.__name__, self.per_round, self.resolve, self.steps)
+
+    def select(self, reviews, truths, visible, num_truths, vancouver_steps, init, actual, init_state=None):
+        """
+        :param reviews: the ReviewGraph of the trial
+        :param truths: a dictionary from every submission to its ground truth
+        :param visible: a dictionary of the truths that are visible already (e.g. of the cover)
+        :param num_truths: the number of truths to end up with
+        :param init: a tuple of (scores, qualities) from the Vancouver run with the visible truths
+        :param actual: a tuple of (omniscient scores, true qualities)
+        :param init_state: the (ivars, jmeans) state of the initial Vancouver run (see vancouver), to warm-start the
+        first re-solve from (by default, it starts from scratch)
+
+        :return a dictionary of the visible truths, with num_truths entries (or all submissions, if fewer)
+        """
+        peers, submissions, ei, ej, r = review_edges(reviews)
+        index = {j: k for k, j in enumerate(submissions)}
+        (scores, _), (omni_scores, _) = init, actual
+        arrays = {
+            'grades': np.array([scores[j][0] for j in submissions]),
+            'variances': np.array([scores[j][1] for j in submissions]),
+            'omni_grades': np.array([omni_scores[j][0] for j in submissions]),
+            'omni_variances': np.array([omni_scores[j][1] for j in submissions]),
+            'truths': np.array([truths[j] for j in submissions], dtype=float),
+            'visible': np.zeros(len(submissions), dtype=bool),
+        }
+        visible_mask = arrays['visible']
+        visible_mask[[index[j] for j in visible]] = True
+
+        state = init_state
+        need = min(num_truths, len(submissions)) - visible_mask.sum()
+        while need > 0:
+            picks = need if self.per_round is None else min(self.per_round, need)
+            priority = np.array(self.priority(arrays), dtype=float)
+            priority[visible_mask] = -np.inf
+            visible_mask[np.argpartition(-priority, picks - 1)[:picks]] = True
+            need -= picks
+
+            if self.resolve and need > 0:
+                steps = vancouver_steps if self.steps is None else self.steps
+                jmean, jvar, _, _, state = vancouver_arrays(ei, ej, r, len(peers), len(submissions), visible_mask,
+                                                            arrays['truths'], steps, state=state)
+                arrays['grades'], arrays['variances'] = jmean, jvar
+
+        return {submissions[k]: truths[submissions[k]] for k in np.flatnonzero(visible_mask).tolist()}
+
+
+def random_priority(arrays):
+    """
+    A TruthStrategy priority: random submissions (as random_submission).
+    """
+    return np.random.rand(len(arrays['grades']))
+
+
+def highest_variance(arrays):
+    """
+    A TruthStrategy priority: the submissions with the highest estimated variance.
+    """
+    return arrays['variances']
+
+
+def highest_grade_error(arrays):
+    """
+    A TruthStrategy priority: the submissions whose estimated grade is furthest from their ground truth.
+    """
+    return np.abs(arrays['grades'] - arrays['truths'])
+
+
+def highest_variance_error(arrays):
+    """
+    A TruthStrategy priority: the submissions whose estimated variance is furthest from the omniscient one.
+    """
+    return np.abs(arrays['variances'] - arrays['omni_variances'])
+
 
 def evaluate_vancouver(num_assignments, num_reviews, num_truths, peer_quality, use_cover=True,
                        vancouver_steps=10,
-                       grading_algorithm=lambda x: random.choice(x[0])):
+                       grading_algorithm=random_submission, trial=None, cache=solve_cache):
     # generate random groups, assignments, qualities, and reviews
     """
     :param num_assignments: the number of submissions in the pool
@@ -22,62 +145,150 @@ def evaluate_vancouver(num_assignments, num_reviews, num_truths, peer_quality, u
     that grader's true quality. The function should return an integer, which will be used to determine how many samples
     that grader gets from the distribution (in our current model).
     :param vancouver_steps: the number of iterations before vancouver terminates
+    :param grading_algorithm: picks the submissions to see the ground truth of beyond the cover: a function like
+    random_submission, called once per truth, or a TruthStrategy
     :param peer_quality: tuple of (function, args) that returns an integer
+    :param trial: a trial from random_trial to evaluate (instead of generating a new one)
+    :param cache: a SolveCache for the initial and omniscient runs (None to always solve them)
 
     :return a tuple of three arrays, representing the submission grade errors, submission variance errors, and
     grader variance errors
     """
+    trials = None if trial is None else [trial]
+    return evaluate_vancouver_batch(1, num_assignments, num_reviews, num_truths, peer_quality, use_cover,
+                                    vancouver_steps, grading_algorithm, trials, cache)[0]
+
+
+def random_trial(num_assignments, num_reviews, peer_quality):
+    """
+    Generates the random groups, assignments, qualities and reviews for one trial.
+
+    :return a tuple of (groups, cover, true_qualities, reviews), with the reviews as a ReviewGraph
+    """
+    return random_trials(1, num_assignments, num_reviews, peer_quality)[0]
+
+
+def random_trials(num_trials, num_assignments, num_reviews, peer_quality):
+    """
+    Generates num_trials trials (as random_trial), with the assignments of all of them drawn in one vectorized pass
+    (see peer_assignment_trials).
+
+    :return a list of tuples of (groups, cover, true_qualities, reviews)
+    """
     groups = {sub: [sub + x for x in ['1', '2', '3']] for sub in [chr(ord('a') + z) for z in range(num_assignments)]}
-    assignments, cover = peer_assignment_return_cover(groups, num_reviews)
-    true_qualities = {i: peer_quality[0](*peer_quality[1:]) for i in assignments}
-    reviews = random_reviews(assignments, true_qualities)
+    students, submissions, assignments, covers = peer_assignment_trials(groups, num_reviews, num_trials)
+    ei = np.repeat(np.arange(len(students)), num_reviews)
+
+    trials = []
+    for (t, cover_ids) in enumerate(covers):
+        cover = {submissions[j]: [] for j in cover_ids}
+        for (i, j) in enumerate(assignments[t, :, 0].tolist()):
+            cover[submissions[j]].append(students[i])
+        true_qualities = {i: peer_quality[0](*peer_quality[1:]) for i in students}
+        graph = ReviewGraph(students, submissions, ei, assignments[t].ravel())
+        trials.append((groups, cover, true_qualities, random_reviews(graph, true_qualities)))
+    return trials
+
+
+def evaluate_vancouver_batch(num_trials, num_assignments, num_reviews, num_truths, peer_quality, use_cover=True,
+                             vancouver_steps=10,
+                             grading_algorithm=random_submission, trials=None, cache=solve_cache):
+    """
+    Runs num_trials independent trials of evaluate_vancouver. The Vancouver runs of all trials are stacked into
+    batched solves (one for the initial and omniscient runs, one for the final runs) instead of three solves per trial.
 
-    # generate a random ground truth value for all submissions
-    truths = {i: 0.5 for i in groups}
+    :param num_trials: the number of independent trials
+    :param trials: a list of trials from random_trial to evaluate (instead of generating num_trials new ones); reusing
+    them across calls lets the cache skip their initial and omniscient runs
+    (the other parameters are as in evaluate_vancouver)
+
+    :return a list with one tuple of (submission grade errors, submission variance errors, grader variance errors)
+    per trial
+    """
+    if trials is None:
+        trials = random_trials(num_trials, num_assignments, num_reviews, peer_quality)
+    num_trials = len(trials)
 
-    # run initial vancouver
-    truths_visible = {i: 0.5 for i in cover}
-    init_scores, init_qualities = vancouver(reviews, truths_visible, vancouver_steps)
-    omni_scores, omni_qualities = vancouver(reviews, truths, vancouver_steps)
+    # generate a random ground truth value for all submissions
+    all_truths = [{i: 0.5 for i in groups} for (groups, _, _, _) in trials]
+
+    # run initial and omniscient vancouver for every trial
+    init_truths = [{i: 0.5 for i in cover} for (_, cover, _, _) in trials]
+    reviews_list = [reviews for (_, _, _, reviews) in trials]
+    # (with their final states, to warm-start the re-solves of a TruthStrategy from)
+    if cache is None:
+        results = vancouver_batch(reviews_list + reviews_list, init_truths + all_truths, vancouver_steps,
+                                  full_output=True)
+    else:
+        results = cache.batch(reviews_list + reviews_list, init_truths + all_truths, vancouver_steps, full_output=True)
+    init_results = results[:num_trials]
+    omni_results = results[num_trials:]
 
     # make a truths_visible dictionary for the algorithm to have access to
-    if use_cover:
-        if len(cover) > num_truths:
-            truths_visible = {i[0]: 0.5 for i in random.sample(list(cover), num_truths)}
+    visible_truths = []
+    for ((groups, cover, true_qualities, reviews), truths, (init_scores, init_qualities, (_, init_state)),
+         (omni_scores, _, _)) in zip(trials, all_truths, init_results, omni_results):
+        if use_cover:
+            if len(cover) > num_truths:
+                truths_visible = {i[0]: 0.5 for i in random.sample(sorted(cover), num_truths)}
+            elif isinstance(grading_algorithm, TruthStrategy):
+                truths_visible = grading_algorithm.select(reviews, truths, {i: 0.5 for i in cover}, num_truths,
+                                                          vancouver_steps, (init_scores, init_qualities),
+                                                          (omni_scores, true_qualities), init_state)
+            else:
+                truths_visible = {i: 0.5 for i in cover}
+                while len(truths_visible.keys()) < num_truths:
+                    truths_visible[grading_algorithm(truths, (init_qualities, init_scores),
+                                                     (omni_scores, true_qualities))] = 0.5
         else:
-            truths_visible = {i: 0.5 for i in cover}
-            while len(truths_visible.keys()) < num_truths:
-                truths_visible[grading_algorithm(truths, (init_qualities, init_scores),
-                                                 (omni_scores, true_qualities))] = 0.5
-    else:
-        truths_visible = {i[0]: 0.5 for i in random.sample(list(truths), num_truths)}
+            truths_visible = {i[0]: 0.5 for i in random.sample(list(truths), num_truths)}
+        visible_truths.append(truths_visible)
 
-    # run vancouver and omniscient vancouver
-    scores, qualities = vancouver(reviews, truths_visible, vancouver_steps)
+    # run vancouver for every trial
+    final_results = vancouver_batch(reviews_list, visible_truths, vancouver_steps)
 
     # generate statistics on the data
-    sub_score_error = [abs(scores[submission][0] - 0.5) for submission in scores]
-    sub_var_error = [abs(scores[submission][1] - omni_scores[submission][1]) for submission in scores]
-    grader_var_error = [abs(qualities[grader] - true_qualities[grader]) for grader in qualities]
+    errors = []
+    for ((_, _, true_qualities, _), (scores, qualities), (omni_scores, _, _)) in \
+            zip(trials, final_results, omni_results):
+        sub_score_error = [abs(scores[submission][0] - 0.5) for submission in scores]
+        sub_var_error = [abs(scores[submission][1] - omni_scores[submission][1]) for submission in scores]
+        grader_var_error = [abs(qualities[grader] - true_qualities[grader]) for grader in qualities]
+        errors.append((sub_score_error, sub_var_error, grader_var_error))
 
-    return sub_score_error, sub_var_error, grader_var_error
+    return errors
 
 
 def vancouver_statistics(num_assignments, num_reviews, num_truths, num_runs, peer_quality,
                          use_cover=True, vancouver_steps=10):
     # generate each statistic for num_runs trials
-    means_acc = []
-    medians_acc = []
-    maxes_acc = []
-    for _ in range(num_runs):
-        errors = evaluate_vancouver(num_assignments, num_reviews, num_truths, peer_quality,
-                                    use_cover, vancouver_steps)
-        means = [np.mean(stat) for stat in errors]
-        means_acc.append(means)
-        medians = [np.median(stat) for stat in errors]
-        medians_acc.append(medians)
-        maxes = [max(stat) for stat in errors]
-        maxes_acc.append(maxes)
+    trial_stats = [trial_statistics(errors) for errors in
+                   evaluate_vancouver_batch(num_runs, num_assignments, num_reviews, num_truths, peer_quality,
+                                            use_cover, vancouver_steps)]
+    return summarize_statistics(trial_stats)
+
+
+def trial_statistics(errors):
+    """
+    Reduces the errors of one trial (as returned by evaluate_vancouver) to their means, medians and maxes.
+
+    :return a tuple of (means, medians, maxes), each a list with one entry per error type
+    """
+    means = [np.mean(stat) for stat in errors]
+    medians = [np.median(stat) for stat in errors]
+    maxes = [max(stat) for stat in errors]
+    return means, medians, maxes
+
+
+def summarize_statistics(trial_stats):
+    """
+    Averages per-trial statistics (as returned by trial_statistics) across the trials.
+
+    :return a dictionary of the form returned by vancouver_statistics
+    """
+    means_acc = [means for (means, _, _) in trial_stats]
+    medians_acc = [medians for (_, medians, _) in trial_stats]
+    maxes_acc = [maxes for (_, _, maxes) in trial_stats]
 
     # average the results of the statistics across the trials
     mean_average = np.mean(means_acc, axis=0)
@@ -92,32 +303,145 @@ def vancouver_statistics(num_assignments, num_reviews, num_truths, num_runs, pee
     return {'mean': mean_dict, 'median': median_dict, 'max': max_dict}
 
 
+def trial_seed(seed, point, trial):
+    """
+    Derives the random seed of one (parameter point, trial) work unit from the seed of a sweep, so that every unit
+    gets its own stream no matter which worker runs it.
+    """
+    digest = hashlib.sha1(('%d:%d:%d' % (seed, point, trial)).encode('ascii')).hexdigest()
+    return int(digest[:8], 16)
+
+
+def seeded_trial(seed, trial, num_assignments, num_reviews, peer_quality):
+    """
+    Generates the graph of one trial of a sweep (as random_trial), seeded from (seed, trial) only, so that every point
+    of the sweep, and every resumed run of it, gets the same graph for that trial.
+    """
+    graph_seed = trial_seed(seed, -1, trial)
+    random.seed(graph_seed)
+    np.random.seed(graph_seed)
+    return random_trial(num_assignments, num_reviews, peer_quality)
+
+
+def sweep_trial(unit):
+    """
+    Runs one (parameter point, trial) work unit of run_sweep.
+
+    :param unit: a tuple of (seed, point index, trial index, evaluate_vancouver keyword arguments, common trials)
+    :return a tuple of (point index, trial statistics)
+    """
+    seed, point, trial, params, common_trials = unit
+    # a peer_quality like (random.randint, 1, 5) arrives in a worker as a method of a pickled copy of the generator,
+    # so rebind it to the (just seeded) module generator to draw from the same stream as in this process.
+    quality_function = params['peer_quality'][0]
+    if isinstance(getattr(quality_function, '__self__', None), random.Random):
+        params = dict(params, peer_quality=(getattr(random, quality_function.__name__),) + params['peer_quality'][1:])
+    if common_trials:
+        params = dict(params, trial=seeded_trial(seed, trial, params['num_assignments'], params['num_reviews'],
+                                                 params['peer_quality']))
+    unit_seed = trial_seed(seed, point, trial)
+    random.seed(unit_seed)
+    np.random.seed(unit_seed)
+    return point, trial_statistics(evaluate_vancouver(**params))
+
+
+def run_sweep(points, num_trials, seed=None, max_workers=1, chunksize=None, common_trials=False, store=None):
+    """
+    Runs num_trials trials for each parameter point, spreading the (point, trial) work units over a process pool.
+    Each unit is seeded from (seed, point, trial), so the results only depend on seed, not on the number of workers.
+
+    :param points: a list of dictionaries of evaluate_vancouver keyword arguments, one per parameter point (with
+    max_workers > 1, all arguments must be picklable, i.e. no lambdas)
+    :param num_trials: the number of trials per point
+    :param seed: the seed of the sweep (random if None)
+    :param max_workers: the number of worker processes (1 runs the units in this process)
+    :param chunksize: the number of units sent to a worker at a time (by default, about four chunks per worker)
+    :param common_trials: evaluate every point on the same num_trials graphs (seeded from (seed, trial)), so the
+    initial and omniscient runs of a graph are solved once and then found in solve_cache; the points may then only
+    differ in num_truths, use_cover, vancouver_steps and grading_algorithm
+    :param store: a ResultsStore to keep the statistics of every finished unit in (keyed by its point index,
+    parameters, seed and trial); units found in it are not run again, so an interrupted sweep resumes where it stopped
+    (needs a seed)
+
+    :return a list with one dictionary per point, of the form returned by vancouver_statistics
+    """
+    if seed is None:
+        if store is not None:
+            raise ValueError('a sweep with a store needs a seed to resume from')
+        seed = random.getrandbits(32)
+    if common_trials:
+        # keep the units of a trial together, so they end up in the same worker (and its cache)
+        units = [(seed, point, trial, params, True) for trial in range(num_trials)
+                 for (point, params) in enumerate(points)]
+    else:
+        units = [(seed, point, trial, params, False) for (point, params) in enumerate(points)
+                 for trial in range(num_trials)]
+
+    trial_stats = [[] for _ in points]
+    keys = {}
+    if store is not None:
+        todo = []
+        for unit in units:
+            _, point, trial, params, _ = unit
+            # the same inputs as trial_seed, so that two points with the same parameters keep their own results
+            keys[point, trial] = result_key(dict(params, common_trials=common_trials, sweep_point=point), seed, trial)
+            stored = store.get(keys[point, trial])
+            if stored is None:
+                todo.append(unit)
+            else:
+                trial_stats[point].append(tuple(stats.tolist() for stats in stored))
+        units = todo
+
+    def finished(unit, stats):
+        point, trial = unit[1], unit[2]
+        if store is not None:
+            store.put(keys[point, trial], stats)
+        trial_stats[point].append(stats)
+
+    if max_workers == 1 or not units:
+        for unit in units:
+            finished(unit, sweep_trial(unit)[1])
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        if chunksize is None:
+            chunksize = max(1, len(units) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for unit, (_, stats) in zip(units, executor.map(sweep_trial, units, chunksize=chunksize)):
+                finished(unit, stats)
+
+    return [summarize_statistics(stats) for stats in trial_stats]
+
+
 def print_stats(stats):
-    print 'Expectation of the Error in a Given Trial', '\n'
+    print('Expectation of the Error in a Given Trial', '\n')
 
-    print 'Assignment Grades:'
-    print 'Mean Error: ', stats['mean']['sub_grade']
-    print 'Maximum Error: ', stats['max']['sub_grade']
-    print 'Median Error: ', stats['median']['sub_grade'], '\n'
+    print('Assignment Grades:')
+    print('Mean Error: ', stats['mean']['sub_grade'])
+    print('Maximum Error: ', stats['max']['sub_grade'])
+    print('Median Error: ', stats['median']['sub_grade'], '\n')
 
-    print 'Assignment Variances:'
-    print 'Mean Error: ', stats['mean']['sub_var']
-    print 'Maximum Error: ', stats['max']['sub_var']
-    print 'Median Error: ', stats['median']['sub_var'], '\n'
+    print('Assignment Variances:')
+    print('Mean Error: ', stats['mean']['sub_var'])
+    print('Maximum Error: ', stats['max']['sub_var'])
+    print('Median Error: ', stats['median']['sub_var'], '\n')
 
-    print 'Grader Variances:'
-    print 'Mean Error: ', stats['mean']['usr_var']
-    print 'Maximum Error: ', stats['max']['usr_var']
-    print 'Median Error: ', stats['median']['usr_var'], '\n', '\n'
+    print('Grader Variances:')
+    print('Mean Error: ', stats['mean']['usr_var'])
+    print('Maximum Error: ', stats['max']['usr_var'])
+    print('Median Error: ', stats['median']['usr_var'], '\n', '\n')
 
 
 def plot_stats(stat_type, stat_variable, peer_quality, use_cover=True,
-               vancouver_steps=10, num_subs=20, num_grades_per_sub=3, num_trials=10, step_size=1):
-    stats = []
-    for num_true_grades in range(0, num_subs + step_size, step_size):
-        # print(num_true_grades)
-        stats.append(vancouver_statistics(num_subs, num_grades_per_sub, num_true_grades, num_trials, peer_quality,
-                                          use_cover, vancouver_steps)[stat_type][stat_variable])
+               vancouver_steps=10, num_subs=20, num_grades_per_sub=3, num_trials=10, step_size=1,
+               seed=None, max_workers=1, common_trials=True, store=None):
+    points = [{'num_assignments': num_subs, 'num_reviews': num_grades_per_sub, 'num_truths': num_true_grades,
+               'peer_quality': peer_quality, 'use_cover': use_cover, 'vancouver_steps': vancouver_steps}
+              for num_true_grades in range(0, num_subs + step_size, step_size)]
+    stats = [point_stats[stat_type][stat_variable]
+             for point_stats in run_sweep(points, num_trials, seed=seed, max_workers=max_workers,
+                                          common_trials=common_trials, store=store)]
 
     plt.plot(range(0, num_subs + step_size, step_size), stats)
     plt.xlabel('Number of Ground-Truth Grades')
@@ -125,43 +449,220 @@ def plot_stats(stat_type, stat_variable, peer_quality, use_cover=True,
     plt.show()
 
 
+class ErrorDistribution:
+    """
+    A mergeable summary of a stream of errors: the exact count, sum, min and max, plus a t-digest-style quantile
+    sketch (clusters of sorted samples, small near the tails and large in the middle, stored as their means and
+    weights), and optionally exact counts in fixed bins. Memory stays bounded by the compression (and the bins), however
+    many samples are added, and distributions accumulated in different processes can be merged (the bin counts
+    exactly, if both have the same edges).
+
+    :param compression: the number of clusters is about this (more is more accurate)
+    :param edges: increasing bin edges (as np.histogram's) to count the samples in exactly, or None for no fixed bins;
+    samples outside of them are only counted in the sketch
+    """
+    def __init__(self, compression=200, edges=None):
+        self.compression = compression
+        self.edges = None if edges is None else np.asarray(edges, dtype=float)
+        self.bin_counts = None if edges is None else np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        """
+        :param values: an array (or list) of errors, e.g. one of the arrays returned by evaluate_vancouver
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.edges is not None:
+            self.bin_counts += np.histogram(values, self.edges)[0]
+        self._absorb(values, np.ones(len(values)))
+
+    def merge(self, other):
+        """
+        Adds the samples summarized by other (an ErrorDistribution) to this one.
+
+        :return self
+        """
+        if self.edges is not None and (other.edges is None or not np.array_equal(self.edges, other.edges)):
+            raise ValueError('only distributions with the same bin edges can be merged')
+        if other.count:
+            if self.edges is not None:
+                self.bin_counts += other.bin_counts
+            self.count += other.count
+            self.total += other.total
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._absorb(other.means, other.weights)
+        return self
+
+    def mean(self):
+        """
+        :return the mean of the samples (nan if there are none)
+        """
+        if not self.count:
+            return np.nan
+        return self.total / self.count
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def quantile(self, q):
+        """
+        :param q: a fraction (or array of fractions) in [0, 1]
+        :return the estimated q-quantile(s) of the samples (nan if there are none)
+        """
+        if not self.count:
+            return np.full(np.shape(q), np.nan)[()]
+        ranks, values = self._knots()
+        return np.interp(np.asarray(q) * self.count, ranks, values)
+
+    def cdf(self, x):
+        """
+        :param x: a value (or array of values)
+        :return the estimated fraction(s) of the samples below x (nan if there are none)
+        """
+        if not self.count:
+            return np.full(np.shape(x), np.nan)[()]
+        ranks, values = self._knots()
+        return np.interp(x, values, ranks, left=0.0, right=self.count) / self.count
+
+    def cdf_curve(self, resolution=100):
+        """
+        :return a tuple (values, cdf) of resolution evenly spaced values from min to max and the cdf at each (so the
+        curve ends at 1, the total weight of the samples over their count; nan if there are no samples)
+        """
+        if not self.count:
+            return np.full(resolution, np.nan), np.full(resolution, np.nan)
+        values = np.linspace(self.min, self.max, resolution)
+        return values, self.cdf(values)
+
+    def histogram(self, bins=None):
+        """
+        :param bins: the number of equal bins from min to max to estimate the counts in from the sketch (by default,
+        the fixed bins, or 10 without them)
+        :return a tuple (counts, edges), as np.histogram: the exact counts of the fixed bins (with bins None), or the
+        estimated counts in bins equal bins
+        """
+        if bins is None:
+            if self.edges is not None:
+                return self.bin_counts.copy(), self.edges.copy()
+            bins = 10
+        if not self.count:
+            return np.zeros(bins), np.full(bins + 1, np.nan)
+        edges = np.linspace(self.min, self.max, bins + 1)
+        counts = np.diff(self.cdf(edges) * self.count)
+        counts[-1] += self.count - counts.sum()
+        return counts, edges
+
+    def _knots(self):
+        # a cluster's mean sits at the middle of the ranks of its samples
+        mid_ranks = np.cumsum(self.weights) - self.weights / 2
+        return (np.concatenate(([0.0], mid_ranks, [self.count])),
+                np.concatenate(([self.min], self.means, [self.max])))
+
+    def _absorb(self, means, weights):
+        means = np.concatenate((self.means, means))
+        weights = np.concatenate((self.weights, weights))
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        if len(means) <= 2 * self.compression:
+            self.means, self.weights = means, weights
+            return
+
+        # merge neighbours whose middle ranks fall in the same unit of the t-digest scale function
+        # k(q) = compression / (2 pi) * asin(2q - 1), which is steep (so clusters are small) near q = 0 and q = 1
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        cluster = np.unique(k, return_inverse=True)[1].reshape(-1)
+        self.weights = np.bincount(cluster, weights)
+        self.means = np.bincount(cluster, weights * means) / self.weights
+
+
+def error_distribution(stat_type, num_trials, params, trials=None, seed=None, store=None, edges=None):
+    """
+    Runs num_trials trials of evaluate_vancouver_batch and accumulates one type of their errors.
+
+    :param stat_type: a key of stat_ids
+    :param params: a dictionary of evaluate_vancouver_batch keyword arguments (num_assignments, num_reviews,
+    num_truths, peer_quality, use_cover, vancouver_steps, grading_algorithm)
+    :param trials: a list of num_trials trials from random_trial (by default, new ones; with a store, seeded_trial ones)
+    :param seed: the seed of the trials (needed with a store)
+    :param store: a ResultsStore to keep the errors of every trial in (keyed by params, seed and trial); only the trials
+    that are not in it yet are run
+    :param edges: the fixed bin edges of the ErrorDistribution (see ErrorDistribution)
+
+    :return an ErrorDistribution of the errors of all trials
+    """
+    if store is None:
+        results = evaluate_vancouver_batch(num_trials, trials=trials, **params)
+    else:
+        if seed is None:
+            raise ValueError('errors kept in a store need a seed to be found again')
+        keys = [result_key(params, seed, trial) for trial in range(num_trials)]
+        missing = [trial for trial in range(num_trials) if keys[trial] not in store]
+        if missing:
+            if trials is None:
+                missing_trials = [seeded_trial(seed, trial, params['num_assignments'], params['num_reviews'],
+                                               params['peer_quality']) for trial in missing]
+            else:
+                missing_trials = [trials[trial] for trial in missing]
+            for trial, errors in zip(missing, evaluate_vancouver_batch(len(missing), trials=missing_trials, **params)):
+                store.put(keys[trial], errors)
+        results = [store.get(key) for key in keys]
+
+    dist = ErrorDistribution(edges=edges)
+    for errors in results:
+        dist.add(errors[stat_ids[stat_type]])
+    return dist
+
+
+def curve_params(num_subs, num_grades_per_sub, num_truths, peer_quality, use_cover, vancouver_steps,
+                 grading_algorithm):
+    """
+    :return the evaluate_vancouver_batch keyword arguments of one curve of the plot functions below
+    """
+    return {'num_assignments': num_subs, 'num_reviews': num_grades_per_sub, 'num_truths': num_truths,
+            'peer_quality': peer_quality, 'use_cover': use_cover, 'vancouver_steps': vancouver_steps,
+            'grading_algorithm': grading_algorithm}
+
+
 def plot_histogram(num_subs=20, num_grades_per_sub=3, num_truths=5, peer_quality=(random.randint, 1, 5), use_cover=True,
                    vancouver_steps=10, stat_type='Submission Grade Error', num_trials=20, cumulative=True,
-                   grading_algorithm=lambda x: random.choice(x[0])):
-    vancouver_bulk = []
-    for _ in range(num_trials):
-        vancouver_bulk.extend(evaluate_vancouver(num_subs, num_grades_per_sub, num_truths,
-                                                 peer_quality, use_cover, vancouver_steps,
-                                                 grading_algorithm=grading_algorithm)[stat_ids[stat_type]])
-    plt.hist(vancouver_bulk, cumulative=cumulative)
+                   grading_algorithm=random_submission, seed=None, store=None, edges=None):
+    # (with edges, the histogram counts the errors in those bins exactly; otherwise it estimates 10 bins from the
+    # sketch)
+    dist = error_distribution(stat_type, num_trials, curve_params(num_subs, num_grades_per_sub, num_truths, peer_quality,
+                                                                  use_cover, vancouver_steps, grading_algorithm),
+                              seed=seed, store=store, edges=edges)
+    counts, edges = dist.histogram()
+    plt.hist(edges[:-1], bins=edges, weights=counts, cumulative=cumulative)
     plt.xlabel(stat_type)
     plt.show()
 
 
 def plot_cdfs(num_subs=20, num_grades_per_sub=3, num_truths=(0, 5, 10, 15), peer_quality=(random.randint, 1, 5),
               use_cover=True, vancouver_steps=10, stat_type='Submission Grade Error', num_trials=50,
-              grading_algorithm=lambda x: random.choice(x[0]), resolution=100, xrange=[0, 0.4]):
+              grading_algorithm=random_submission, resolution=100, xrange=[0, 0.4], seed=None, store=None):
+    # every curve uses the same graphs, so their initial and omniscient runs are solved once (with a store, the graphs
+    # are seeded_trial ones, generated only for the trials that are not stored yet)
+    trials = None if store is not None else \
+        random_trials(num_trials, num_subs, num_grades_per_sub, peer_quality)
     for truth_num in num_truths:
-        vancouver_bulk = []
-        for _ in range(num_trials):
-            vancouver_bulk.extend(evaluate_vancouver(num_subs, num_grades_per_sub, truth_num,
-                                                     peer_quality, use_cover, vancouver_steps,
-                                                     grading_algorithm=grading_algorithm)[stat_ids[stat_type]])
-        vancouver_bulk.sort()
-        vmin = vancouver_bulk[0]
-        vmax = vancouver_bulk[-1]
-        step = (vmax - vmin) / resolution
-        hist = []
-        values = []
-        i = 0
-        for value in np.arange(vmin, vmax, step):
-            while vancouver_bulk[i] < value:
-                i += 1
-            hist.append(i)
-            values.append(value)
-        hist_max = hist[-1]
-        hist = [float(item) / hist_max for item in hist]
-        plt.plot(values, hist)
+        dist = error_distribution(stat_type, num_trials, curve_params(num_subs, num_grades_per_sub, truth_num,
+                                                                      peer_quality, use_cover, vancouver_steps,
+                                                                      grading_algorithm),
+                                  trials=trials, seed=seed, store=store)
+        plt.plot(*dist.cdf_curve(resolution))
     plt.legend(num_truths)
     plt.xlabel(stat_type)
     plt.ylabel('Normalized CDF')
@@ -171,34 +672,21 @@ def plot_cdfs(num_subs=20, num_grades_per_sub=3, num_truths=(0, 5, 10, 15), peer
 
 def plot_cdfs_2(num_subs=20, num_grades_per_sub=3, num_truths=(10,), peer_quality=(random.randint, 1, 5),
                 use_cover=True, vancouver_steps=(1, 10, 20), stat_type='Submission Grade Error', num_trials=50,
-                grading_algorithm=lambda x: random.choice(x[0]), resolution=100, xrange=[0, 0.4]):
+                grading_algorithm=random_submission, resolution=100, xrange=[0, 0.4], seed=None, store=None):
     """
     Allows plotting of multiple Vancouver iterations at once.
     :return:
     """
     legend = []
+    trials = None if store is not None else \
+        random_trials(num_trials, num_subs, num_grades_per_sub, peer_quality)
     for vs in vancouver_steps:
         for truth_num in num_truths:
-            vancouver_bulk = []
-            for _ in range(num_trials):
-                vancouver_bulk.extend(evaluate_vancouver(num_subs, num_grades_per_sub, truth_num,
-                                                         peer_quality, use_cover, vs,
-                                                         grading_algorithm=grading_algorithm)[stat_ids[stat_type]])
-            vancouver_bulk.sort()
-            vmin = vancouver_bulk[0]
-            vmax = vancouver_bulk[-1]
-            step = (vmax - vmin) / resolution
-            hist = []
-            values = []
-            i = 0
-            for value in np.arange(vmin, vmax, step):
-                while vancouver_bulk[i] < value:
-                    i += 1
-                hist.append(i)
-                values.append(value)
-            hist_max = hist[-1]
-            hist = [float(item) / hist_max for item in hist]
-            plt.plot(values, hist)
+            dist = error_distribution(stat_type, num_trials, curve_params(num_subs, num_grades_per_sub, truth_num,
+                                                                          peer_quality, use_cover, vs,
+                                                                          grading_algorithm),
+                                      trials=trials, seed=seed, store=store)
+            plt.plot(*dist.cdf_curve(resolution))
             legend.append(str(vs) + ' Steps, ' + str(truth_num) + ' True Grades')
     plt.legend(legend, loc=4)
     plt.xlabel(stat_type)
@@ -210,30 +698,18 @@ def plot_cdfs_2(num_subs=20, num_grades_per_sub=3, num_truths=(10,), peer_qualit
 
 def plot_cdfs_3(num_subs=20, num_grades_per_sub=3, num_truths=(0,), peer_quality=(random.randint, 1, 5),
                 use_cover=True, vancouver_steps=10, stat_type='Submission Grade Error', num_trials=50,
-                algs=(lambda x: random.choice(x[0]), ), alg_names=('Random', ), resolution=100, xrange=[0, 0.4]):
+                algs=(random_submission, ), alg_names=('Random', ), resolution=100, xrange=[0, 0.4], seed=None,
+                store=None):
     legend=[]
+    trials = None if store is not None else \
+        random_trials(num_trials, num_subs, num_grades_per_sub, peer_quality)
     for j, grading_algorithm in enumerate(algs):
         for truth_num in num_truths:
-            vancouver_bulk = []
-            for _ in range(num_trials):
-                vancouver_bulk.extend(evaluate_vancouver(num_subs, num_grades_per_sub, truth_num,
-                                                         peer_quality, use_cover, vancouver_steps,
-                                                         grading_algorithm=grading_algorithm)[stat_ids[stat_type]])
-            vancouver_bulk.sort()
-            vmin = vancouver_bulk[0]
-            vmax = vancouver_bulk[-1]
-            step = (vmax - vmin) / resolution
-            hist = []
-            values = []
-            i = 0
-            for value in np.arange(vmin, vmax, step):
-                while vancouver_bulk[i] < value:
-                    i += 1
-                hist.append(i)
-                values.append(value)
-            hist_max = hist[-1]
-            hist = [float(item) / hist_max for item in hist]
-            plt.plot(values, hist)
+            dist = error_distribution(stat_type, num_trials, curve_params(num_subs, num_grades_per_sub, truth_num,
+                                                                          peer_quality, use_cover, vancouver_steps,
+                                                                          grading_algorithm),
+                                      trials=trials, seed=seed, store=store)
+            plt.plot(*dist.cdf_curve(resolution))
             legend.append(alg_names[j] + ', ' + str(truth_num) + ' Ground Truths')
     plt.legend(legend, loc=4)
     plt.xlabel(stat_type)
@@ -244,30 +720,18 @@ def plot_cdfs_3(num_subs=20, num_grades_per_sub=3, num_truths=(0,), peer_quality
 
 def plot_cdfs_4(num_subs=20, num_grades_per_sub=3, num_truths=(0,), peer_qualities=((random.randint, 1, 5),),
                 use_cover=True, vancouver_steps=10, stat_type='Submission Grade Error', num_trials=50,
-                grading_algorithm=lambda x: random.choice(x[0]), pq_names=('Random on {1,2,3,4,5}',), resolution=100, xrange=[0, 0.4]):
+                grading_algorithm=random_submission, pq_names=('Random on {1,2,3,4,5}',), resolution=100, xrange=[0, 0.4],
+                seed=None, store=None):
     legend = []
     for j, peer_quality in enumerate(peer_qualities):
+        trials = None if store is not None else \
+            random_trials(num_trials, num_subs, num_grades_per_sub, peer_quality)
         for truth_num in num_truths:
-            vancouver_bulk = []
-            for _ in range(num_trials):
-                vancouver_bulk.extend(evaluate_vancouver(num_subs, num_grades_per_sub, truth_num,
-                                                         peer_quality, use_cover, vancouver_steps,
-                                                         grading_algorithm=grading_algorithm)[stat_ids[stat_type]])
-            vancouver_bulk.sort()
-            vmin = vancouver_bulk[0]
-            vmax = vancouver_bulk[-1]
-            step = (vmax - vmin) / resolution
-            hist = []
-            values = []
-            i = 0
-            for value in np.arange(vmin, vmax, step):
-                while vancouver_bulk[i] < value:
-                    i += 1
-                hist.append(i)
-                values.append(value)
-            hist_max = hist[-1]
-            hist = [float(item) / hist_max for item in hist]
-            plt.plot(values, hist)
+            dist = error_distribution(stat_type, num_trials, curve_params(num_subs, num_grades_per_sub, truth_num,
+                                                                          peer_quality, use_cover, vancouver_steps,
+                                                                          grading_algorithm),
+                                      trials=trials, seed=seed, store=store)
+            plt.plot(*dist.cdf_curve(resolution))
             legend.append(pq_names[j] + ', ' + str(truth_num) + ' Truths')
     plt.legend(legend, loc=4)
     plt.xlabel(stat_type)